@@ -1,8 +1,8 @@
 
 from pathlib import Path
 from template_utils import (
-    shelve_to_root,
-    shelve_to_pkl
+    store_to_root,
+    store_to_pkl
 )
 import argparse
 import os
@@ -15,11 +15,11 @@ def main(args):
     if args.save_templates:
         output_root_path = Path(args.outdir) / args.tag / f"fitting_{args.year}_msd.root"
         eos_path = f"/eos/uscms/store/group/lpchbbrun3/{os.getlogin()}/FITTING_TEMPLATES/"
-        shelve_to_root(eos_path, output_root_path)
+        store_to_root(eos_path, output_root_path)
 
     if args.save_plotting_pkl:
         eos_path = f"/eos/uscms/store/group/lpchbbrun3/{os.getlogin()}/PLOTTING_PICKLES/"
-        shelve_to_pkl(eos_path, args)
+        store_to_pkl(eos_path, args)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Unified Histogram Maker for Signal and CR")
@@ -0,0 +1,205 @@
+"""
+Histogram store for the templates and plotting histograms of make_hists_dask.
+
+A store file holds named histograms as (name, axes id, sumw, sumw2) arrays, including the flow bins.
+The file is append-only: histograms are buffered in memory (adding to a name already buffered just
+adds the arrays) and written in blocks of batch_size histograms. Each block has a json header, which
+is the index of the arrays in the block, and the axes (an empty pickled histogram per axes id), so
+a store is read by scanning the block headers. The same name may appear in several blocks or files
+(e.g. one file per condor task), reading sums them.
+
+    with HistStore("templates.hists") as store:
+        store.add("ggf_pass_bb_pt1_ggF_nominal", h)
+
+    store = HistStore.read(Path(eos_dir).glob("*.hists"))
+    store.to_root("templates.root")
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import pickle
+import struct
+from pathlib import Path
+
+import boost_histogram as bh
+import numpy as np
+import uproot
+
+MAGIC = b"HBBHIST1"
+_BLOCK = struct.Struct("<QQ")  # header and payload sizes
+
+
+def _arrays(h) -> tuple[np.ndarray, np.ndarray]:
+    """Sums of weights and of squared weights of all bins (with flow), sumw2 is None without variances"""
+    view = h.view(flow=True)
+    if issubclass(h.storage_type, bh.storage.Weight):
+        sumw = np.array(view.value, dtype=np.float64).ravel()
+        return sumw, np.array(view.variance, dtype=np.float64).ravel()
+    if issubclass(h.storage_type, (bh.storage.Double, bh.storage.Int64)):
+        return np.array(view, dtype=np.float64).ravel(), None
+    raise TypeError(f"Unsupported histogram storage {h.storage_type}")
+
+
+class HistStore:
+    """
+    Named histograms with the same axes stored once per axes id
+    :param path: file the histograms are appended to by flush, None for a store that is only read
+    :param batch_size: number of buffered histograms written as one block
+    """
+
+    def __init__(self, path=None, batch_size: int = 500):
+        self.path = Path(path) if path else None
+        self.batch_size = batch_size
+        # name -> [axes id, sumw, sumw2], for a writer only the histograms not written yet
+        self.hists = {}
+        # axes id -> empty histogram
+        self.templates = {}
+        self._written_templates = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def _axes_id(self, h) -> str:
+        # a few distinct axes per store, compared by value: ids written by other processes may differ
+        for axes_id, template in self.templates.items():
+            if template.storage_type is h.storage_type and template.axes == h.axes:
+                return axes_id
+        template = h.copy()
+        template.reset()
+        blob = pickle.dumps(template, protocol=pickle.HIGHEST_PROTOCOL)
+        axes_id = hashlib.sha1(blob).hexdigest()[:16]
+        self.templates[axes_id] = template
+        return axes_id
+
+    def add_arrays(self, name: str, axes_id: str, sumw: np.ndarray, sumw2: np.ndarray = None):
+        """Add the arrays of a histogram to the one with the same name (the arrays are copied)"""
+        entry = self.hists.get(name)
+        if entry is None:
+            sumw2 = None if sumw2 is None else np.array(sumw2, dtype=np.float64)
+            self.hists[name] = [axes_id, np.array(sumw, dtype=np.float64), sumw2]
+        else:
+            if entry[0] != axes_id:
+                raise ValueError(f"Histogram {name} added with different axes")
+            entry[1] += sumw
+            if entry[2] is not None and sumw2 is not None:
+                entry[2] += sumw2
+        if self.path is not None and len(self.hists) >= self.batch_size:
+            self.flush()
+
+    def add(self, name: str, h):
+        """Add a hist.Hist (or boost_histogram.Histogram) to the histogram with the same name"""
+        sumw, sumw2 = _arrays(h)
+        self.add_arrays(name, self._axes_id(h), sumw, sumw2)
+
+    def flush(self):
+        """Append the buffered histograms to the file as one block"""
+        if self.path is None or not self.hists:
+            return
+
+        chunks, offset = [], 0
+        header = {"templates": {}, "hists": []}
+
+        def append(data: bytes):
+            nonlocal offset
+            chunks.append(data)
+            offset += len(data)
+            return [offset - len(data), len(data)]
+
+        # the axes are written with the first block using them
+        new_templates = {entry[0] for entry in self.hists.values()} - self._written_templates
+        for axes_id in new_templates:
+            template = pickle.dumps(self.templates[axes_id], protocol=pickle.HIGHEST_PROTOCOL)
+            header["templates"][axes_id] = append(template)
+        for name, (axes_id, sumw, sumw2) in self.hists.items():
+            start, size = append(sumw.astype("<f8").tobytes())
+            start2 = None if sumw2 is None else append(sumw2.astype("<f8").tobytes())[0]
+            header["hists"].append([name, axes_id, start, size, start2])
+
+        header = json.dumps(header).encode()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = not self.path.exists() or self.path.stat().st_size == 0
+        with self.path.open("ab") as f:
+            if new_file:
+                f.write(MAGIC)
+            f.write(_BLOCK.pack(len(header), offset))
+            f.write(header)
+            for data in chunks:
+                f.write(data)
+
+        self._written_templates.update(new_templates)
+        self.hists = {}
+
+    def update_from_file(self, path):
+        """Add the histograms of a store file"""
+        data = Path(path).read_bytes()
+        if data[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a histogram store")
+
+        # axes ids of the file -> equal axes already in the store
+        ids = {}
+        pos = len(MAGIC)
+        while pos < len(data):
+            header_size, payload_size = _BLOCK.unpack_from(data, pos)
+            pos += _BLOCK.size
+            header = json.loads(data[pos : pos + header_size])
+            payload = pos + header_size
+
+            for axes_id, (start, size) in header["templates"].items():
+                if axes_id not in self.templates:
+                    template = pickle.loads(data[payload + start : payload + start + size])
+                    ids[axes_id] = self._axes_id(template)
+            for name, file_axes_id, start, size, start2 in header["hists"]:
+                axes_id = ids.get(file_axes_id, file_axes_id)
+                sumw = np.frombuffer(data, dtype="<f8", count=size // 8, offset=payload + start)
+                sumw2 = None
+                if start2 is not None:
+                    sumw2 = np.frombuffer(data, dtype="<f8", count=size // 8, offset=payload + start2)
+                self.add_arrays(name, axes_id, sumw, sumw2)
+            pos = payload + payload_size
+
+    @classmethod
+    def read(cls, paths) -> HistStore:
+        """Store with the sum of the histograms of the files"""
+        store = cls()
+        for path in [paths] if isinstance(paths, (str, Path)) else paths:
+            print(path)
+            store.update_from_file(path)
+        return store
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.hists
+
+    def __iter__(self):
+        return iter(self.hists)
+
+    def __len__(self) -> int:
+        return len(self.hists)
+
+    def __getitem__(self, name: str):
+        """hist.Hist of a stored histogram"""
+        axes_id, sumw, sumw2 = self.hists[name]
+        h = self.templates[axes_id].copy()
+        view = h.view(flow=True)
+        if sumw2 is not None:
+            view["value"] = sumw.reshape(view.shape)
+            view["variance"] = sumw2.reshape(view.shape)
+        else:
+            view[...] = sumw.reshape(view.shape)
+        return h
+
+    def to_root(self, output_root_path, names=None):
+        """Write the histograms (all by default) to a new ROOT file, in a single bulk update"""
+        names = list(self) if names is None else names
+        with uproot.recreate(output_root_path, compression=None) as fout:
+            fout.update({name: self[name] for name in names})
+
+    def to_pkl(self, output_pkl_path, names: dict):
+        """Pickle the histograms as {key: hist}, for names given as {key: stored name}"""
+        with Path(output_pkl_path).open("wb") as f:
+            pickle.dump({key: self[name] for key, name in names.items()}, f)
@@ -18,6 +18,7 @@ import subprocess
 from dask.distributed import Client, as_completed
 from lpcjobqueue import LPCCondorCluster
 
+from hbb.utils import skim_group
 from template_utils import (
     REGION_MAP,
     folder_systs,
@@ -44,21 +45,31 @@ def xrdcp_file(file, eos_path, redirector):
     subprocess.run(["xrdfs", str(redirector), "mkdir", "-p", str(eos_path).replace("/eos/uscms","")])
     subprocess.run(["xrdcp", "-fr", str(file), f"{redirector}{eos_path}",])
 
-def submit_task(process, dataset, data_dir, load_cols, region, region_key, variation, pq_filters, do_loadsys_sumw, scalevar_structure, setup, args, syst, template_outfile, plotting_outfile, eos_path):
+def submit_task(process, dataset, data_dir, load_cols, region, region_key, variation, pq_filters, do_loadsys_sumw, setup, args, syst, template_outfile, plotting_outfile, eos_path, region_flags=False, sumw_index_dir=None):
     set_xrootd_env()
 
     import utils
-    events = utils.load_samples(
-        data_dir=data_dir,
-        samples={process: [dataset]},
-        columns=load_cols,
-        region=region,
-        variation=variation,
-        filters=pq_filters,
-        load_sys_sumweights=do_loadsys_sumw,
-        scalevar_structure=scalevar_structure,
-        local_search_transfer=True
-    )
+    load_kwargs = {
+        "data_dir": data_dir,
+        "columns": load_cols,
+        "region": region,
+        "variation": variation,
+        "filters": pq_filters,
+        "load_sys_sumweights": do_loadsys_sumw,
+        "local_search_transfer": True,
+        "region_flags": region_flags,
+        "use_sumw_index": sumw_index_dir is not None,
+        "sumw_index_dir": sumw_index_dir,
+    }
+    if args.stream_batch_size:
+        # streaming: the templates are filled batch by batch, the memory use is bounded by the batch size
+        events = {
+            process: utils.iter_sample_batches(
+                process=process, dataset=dataset, batch_size=args.stream_batch_size, **load_kwargs
+            )
+        }
+    else:
+        events = utils.load_samples(samples={process: [dataset]}, **load_kwargs)
 
     if events:
         fill_binned_histogram(
@@ -74,14 +85,10 @@ def submit_task(process, dataset, data_dir, load_cols, region, region_key, varia
     redirector = "root://cmseos.fnal.gov/"
     template_eos_path = f"{eos_path}/FITTING_TEMPLATES/"
     plotting_eos_path = f"{eos_path}/PLOTTING_PICKLES/"
-    if Path(str(template_outfile)+".dat").exists():
-        xrdcp_file(f"{template_outfile}.dat", template_eos_path, redirector)
-        xrdcp_file(f"{template_outfile}.bak", template_eos_path, redirector)
-        xrdcp_file(f"{template_outfile}.dir", template_eos_path, redirector)
-    if Path(str(plotting_outfile)+".dat").exists():
-        xrdcp_file(f"{plotting_outfile}.dat", plotting_eos_path, redirector)
-        xrdcp_file(f"{plotting_outfile}.bak", plotting_eos_path, redirector)
-        xrdcp_file(f"{plotting_outfile}.dir", plotting_eos_path, redirector)
+    if template_outfile and Path(f"{template_outfile}.hists").exists():
+        xrdcp_file(f"{template_outfile}.hists", template_eos_path, redirector)
+    if plotting_outfile and Path(f"{plotting_outfile}.hists").exists():
+        xrdcp_file(f"{plotting_outfile}.hists", plotting_eos_path, redirector)
     
     return None
 
@@ -188,10 +195,10 @@ def main(args):
                     if process in scalevar_process:
                         do_loadsys_sumw = True
                         if "pdf_Higgs" in active_syst:
-                            col_systs_proc.extend(get_pdf_list(103))
+                            col_systs_proc.extend(get_pdf_list())
                             syst_loop.extend(["pdf_HiggsUp", "pdf_HiggsDown"])
                         if "QCDScale" in active_syst:
-                            col_systs_proc.extend(get_scale_list(scalevar_process[process]))
+                            col_systs_proc.extend(get_scale_list())
                             syst_loop.extend([f"scalevar{scalevar_process[process]}Up", f"scalevar{scalevar_process[process]}Down"])
 
                     #Our submission files technically only run over vjets files (HadLO + LepNLO) that get corrected, so the pmap should be ok
@@ -218,7 +225,9 @@ def main(args):
                         f"/eos/uscms/store/group/lpchbbrun3/skims/{args.tag}/{args.year}"
                     )
                     region = REGION_MAP[region_key] if not do_BDT_regions or "cr" in region_key else f"{REGION_MAP[region_key]}-BDT"
-                    search_path = Path(data_dir / dataset /  "parquet" / variation / region)
+                    # with region flags, all signal regions are stored together
+                    region_dir = skim_group(region) if args.region_flags else region
+                    search_path = Path(data_dir / dataset /  "parquet" / variation / region_dir)
 
                     if not eos_exists(str(search_path).replace("/eos/uscms", "")):
                         if args.debug:
@@ -229,8 +238,8 @@ def main(args):
                         if len(tasks) > 15:
                             break
 
-                    template_db = f"fitting_{args.year}_{region}_{process}_{dataset}_{variation}_{obs_name}_shelved"
-                    plotting_db = f"plotting_{args.year}_{region}_{process}_{dataset}_{variation}_{obs_name}_shelved"
+                    template_db = f"fitting_{args.year}_{region}_{process}_{dataset}_{variation}_{obs_name}"
+                    plotting_db = f"plotting_{args.year}_{region}_{process}_{dataset}_{variation}_{obs_name}"
                     tmp_eos_output = f"/store/group/lpchbbrun3/{os.getlogin()}"
                     if args.debug:
                         print(template_db)
@@ -244,13 +253,14 @@ def main(args):
                                 "variation" : variation, 
                                 "pq_filters" : pq_filters, 
                                 "do_loadsys_sumw" : do_loadsys_sumw, 
-                                "scalevar_structure" : scalevar_process[process] if do_loadsys_sumw else "", 
                                 "setup" : setup, 
                                 "args" : args, 
                                 "syst" : all_systs, 
                                 "template_outfile" : template_db if args.save_templates else "",
                                 "plotting_outfile" : plotting_db if args.save_plotting_pkl else "",
-                                "eos_path" : tmp_eos_output
+                                "eos_path" : tmp_eos_output,
+                                "region_flags" : args.region_flags,
+                                "sumw_index_dir" : None if args.no_sumw_index else data_dir / "sumw_index",
                                 })
 
     print(f"|{datetime.now()}| Number of tasks to submit: {len(tasks)}")
@@ -258,10 +268,11 @@ def main(args):
          transfer_input_files=[
              "../.env", 
              "../src/hbb/utils.py",
-             "template_utils.py"
+             "template_utils.py",
+             "hist_store.py",
              ],
         log_directory=f"/uscmst1b_scratch/lpc1/3DayLifetime/lzygala",
-        memory="14GB",  # Necessary for some 2024 QCD datasets, can get away with smaller for other years
+        memory=args.worker_memory,
         # job_script_prologue=[]
     )
     if args.debug:
@@ -325,6 +336,25 @@ if __name__ == "__main__":
     parser.add_argument("--save-templates", action="store_true", help="Actually write the ROOT file")
     parser.add_argument("--save-plotting-pkl", action="store_true", help="Actually write the PKL file")
     parser.add_argument("--debug", action="store_true", help="Enter debug mode")
+    parser.add_argument(
+        "--region-flags", action="store_true",
+        help="Skims were written with --skim-region-flags: read the skim group and select the region with its flag column",
+    )
+    parser.add_argument(
+        "--stream-batch-size", default=0, type=int,
+        help="Fill the templates from batches of this many rows of the skims instead of loading the whole dataset "
+             "(e.g. 200000), so that the worker memory does not depend on the dataset size. 0 to load the whole dataset",
+    )
+    parser.add_argument(
+        "--worker-memory", default=None,
+        help="Memory of the condor workers. Defaults to 14GB, necessary for some 2024 QCD datasets "
+             "when loading whole datasets, and 4GB with --stream-batch-size",
+    )
+    parser.add_argument(
+        "--no-sumw-index", action="store_true",
+        help="Read the pickles of every dataset for the normalization, instead of the index written by "
+             "src/build_sumw_index.py (entries of the index that are stale are always read from the pickles)",
+    )
     parser.add_argument(
         "--data-dir", default=None,
         help="Override the full path to the parquet directory for this year, "
@@ -336,6 +366,8 @@ if __name__ == "__main__":
 
     if args.tag is None and args.data_dir is None:
         parser.error("--tag is required when --data-dir is not provided.")
+    if args.worker_memory is None:
+        args.worker_memory = "4GB" if args.stream_batch_size else "14GB"
 
     main(args)
 
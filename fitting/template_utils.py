@@ -6,14 +6,12 @@ Lara Zygala March 2026
 """
 
 import numpy as np
-import uproot
-import pickle
 import hist
-import gc
-import shelve
 from pathlib import Path
 import subprocess
 
+from hist_store import HistStore
+
 
 # --- REGION DIRECTORY MAPPING ---
 # Maps the keys in setup.json to the actual directory names on EOS
@@ -53,161 +51,122 @@ scalevar_process = {
     "ttH": "7pt"
 }
 
-def get_pdf_list(n_var = 103):
+# PDF and QCD scale variations are stored as one column each, normalized in utils.load_samples
+theory_columns = {"pdf": "weight_pdf", "scalevar": "weight_scalevar"}
+theory_nvar = {"weight_pdf": 103, "weight_scalevar": 9}
+
+def get_pdf_list():
     #Collect columns for pdf analysis, sum_weights stored in pickle files
-    return [f"weight_pdf_{i}" for i in range(n_var)]
+    return [theory_columns["pdf"]]
     
-def get_scale_list(structure = "7pt"):
+def get_scale_list():
     #Collect columns for qcd scale analysis, sum_weights stored in pickle files
-    return [f"weight_scalevar_{structure}_{i}" for i in scalevar_map[structure]]
+    return [theory_columns["scalevar"]]
+
+def theory_matrix(data, column, selection):
+    #(events, variations) matrix of the selected events, from the column with one array per event
+    #Converted once per batch and reused for every systematic (see theory_matrices)
+    values = data[column].to_numpy()[np.asarray(selection, dtype=bool)]
+    if not len(values):
+        return np.zeros((0, theory_nvar[column]))
+    return np.vstack(values).astype(np.float64, copy=False)
+
+def theory_matrices(data, selection):
+    #{column: matrix} of the theory variation columns loaded
+    return {
+        column: theory_matrix(data, column, selection) for column in theory_nvar if column in data.columns
+    }
    
-def perform_analysis(data, selection, nom_weight, syst_analysis):
+def perform_analysis(data, selection, nom_weight, syst_analysis, theory=None):
     #Select which analysis to perform: QCDScale or PDF
     #Returns the scale factor to be applied to the histogram
+    #theory: matrices of the selected events from theory_matrices, built here if not given
+    if theory is None:
+        theory = theory_matrices(data, selection)
     sysdir = "Up" if "Up" in syst_analysis else "Down"
     if "pdf_Higgs" in syst_analysis:
-        rel_unc = pdf_analysis(data, nom_weight, selection)
+        rel_unc = pdf_analysis(theory, nom_weight, selection)
         factor = (1.0 + rel_unc) if sysdir == "Up" else (1.0 - rel_unc)
     elif "scalevar" in syst_analysis:
         if "7pt" in syst_analysis:
-            factor = scalevar_analysis(data, nom_weight, selection, "7pt", sysdir)
+            factor = scalevar_analysis(theory, nom_weight, selection, "7pt", sysdir)
         elif "3pt" in syst_analysis:
-            factor = scalevar_analysis(data, nom_weight, selection, "3pt", sysdir)
+            factor = scalevar_analysis(theory, nom_weight, selection, "3pt", sysdir)
 
     return factor
 
-def pdf_analysis(data, nom_weight, selection, n_var = 103):
+def pdf_analysis(theory, nom_weight, selection, n_var = 103):
     #Perform the PDF uncertainty analysis
     #Returns the relative uncertainty
-    pdfweights = []
-    for i in range(n_var):
-        ri = data[f"sumweight_pdf_{i}"][selection] / data["sum_genWeight"][selection]
-        pdfweights.append( data[f"weight_pdf_{i}"][selection] * nom_weight[selection] / ri )
+    #The variations are already divided by sumweight_pdf_i / sum_genWeight (see utils.load_samples)
+    nom = nom_weight[selection].to_numpy(dtype=np.float64).reshape(-1, 1)
+    pdfweights = theory[theory_columns["pdf"]][:, :n_var] * nom
 
-    pdfweights = np.swapaxes(np.array(pdfweights), 0, 1)
-    abs_unc = np.linalg.norm((pdfweights - nom_weight[selection].values.reshape(-1, 1)), axis=1)
-    rel_unc = np.clip(abs_unc / nom_weight[selection], 0, 1)
+    abs_unc = np.linalg.norm(pdfweights - nom, axis=1)
+    rel_unc = np.clip(abs_unc / nom[:, 0], 0, 1)
 
     return rel_unc
 
-def scalevar_analysis(data, nom_weight, selection, structure, direction):
+def scalevar_analysis(theory, nom_weight, selection, structure, direction):
     #Perform the QCD Scale uncertainty analysis
     #Returns the scale factor
-    r4 = data[f"sumweight_scalevar_{structure}_4"][selection] / data["sum_genWeight"][selection]
-    scale4 = data[f"weight_scalevar_{structure}_4"][selection] * nom_weight[selection] / r4
-
-    scaleweights = []
-    for var in scalevar_map[structure]:
-        if var == 4:
-            continue
-
-        ri = data[f"sumweight_scalevar_{structure}_{var}"][selection] / data["sum_genWeight"][selection]
-        scaleweights.append( data[f"weight_scalevar_{structure}_{var}"][selection] * nom_weight[selection] / ri )
-        
-    scaleweights = np.swapaxes(np.array(scaleweights), 0, 1)
+    #The variations are already divided by sumweight_scalevar_i / sum_genWeight (see utils.load_samples)
+    nom = nom_weight[selection].to_numpy(dtype=np.float64).reshape(-1, 1)
+    scaleweights = theory[theory_columns["scalevar"]] * nom
+    scale4 = scaleweights[:, 4]
+
+    variations = [var for var in scalevar_map[structure] if var != 4]
+    scaleweights = scaleweights[:, variations]
     scaleweights = np.max(scaleweights, axis=1) if direction=="Up" else np.min(scaleweights, axis=1)
 
     sf = scaleweights / scale4
 
     return sf
 
-def shelve_to_root(input_shelve_path, output_root_path):
+def store_to_root(input_store_path, output_root_path):
     # Ensure outdir exists
     output_root_path.parent.mkdir(parents=True, exist_ok=True)
 
     # Delete existing file to start fresh for this region
-    # (This avoids the errors by ensuring we never 'update' a corrupted or old file)
     if output_root_path.exists():
         print(f"Cleaning up existing file: {output_root_path}")
         output_root_path.unlink()
 
-    # Initialize a fresh ROOT file
-    uproot.recreate(output_root_path, compression=None).close()
-
-    for ps in [".dat", ".bak", ".dir"]:
-        f = Path(f"FINAL_TEMPLATES{ps}")
-        if f.exists():
-            print(f"Cleaning up existing file: {f}")
-            f.unlink()
-
-    with shelve.open("FINAL_TEMPLATES") as db_out:
-        for db_file in list((Path(input_shelve_path)).glob("*.dat")):
-            if Path(db_file).exists():
-                print(db_file)
-                with shelve.open(str(db_file).replace(".dat", "")) as db:
-                    for h_name in db:
-                        if h_name in db_out:
-                            db_out[h_name] = db_out[h_name] + db[h_name]
-                        else:
-                            db_out[h_name] = db[h_name]
-
-    with uproot.update(output_root_path) as fout:
-        if Path("FINAL_TEMPLATES.dat").exists():
-            with shelve.open("FINAL_TEMPLATES") as db:
-                for h_name in db:
-                    fout[h_name] = db[h_name]
-
-def shelve_to_pkl(input_shelve_path, args):
-
-    for ps in [".dat", ".bak", ".dir"]:
-        f = Path(f"FINAL_PLOTTING{ps}")
-        if f.exists():
-            print(f"Cleaning up existing file: {f}")
-            f.unlink()
+    # the histograms of all the tasks are summed in memory and written in one bulk update
+    store = HistStore.read(sorted(Path(input_store_path).glob("*.hists")))
+    store.to_root(output_root_path)
+
+def store_to_pkl(input_store_path, args):
+
+    store = HistStore.read(sorted(Path(input_store_path).glob("*.hists")))
 
     all_systs = []
     all_reg = []
-    all_procs = []
-    with shelve.open("FINAL_PLOTTING") as db_out:
-        for db_file in list((Path(input_shelve_path)).glob("*.dat")):
-            if Path(db_file).exists():
-                print(db_file)
-                with shelve.open(str(db_file).replace(".dat", "")) as db:
-                    for h_name in db:
-                        proc = h_name.split("|")[0]
-                        reg = h_name.split("|")[1]
-                        syst = h_name.split("|")[2]
-                        if not proc in all_procs:
-                            all_procs.append(proc)
-                        if not reg in all_reg:
-                            all_reg.append(reg)
-                        if not syst in all_systs:
-                            all_systs.append(syst)
-                        if h_name in db_out:
-                            db_out[h_name] = db_out[h_name] + db[h_name]
-                        else:
-                            db_out[h_name] = db[h_name]
-
-    with shelve.open("FINAL_PLOTTING") as db:
-        for region in all_reg:
-            for sys in all_systs:
-                dict_sys = {}
-                for h_name in db:
-                    proc = h_name.split("|")[0]
-                    reg = h_name.split("|")[1]
-                    syst = h_name.split("|")[2]
-                    if sys == syst and reg == region:
-                        dict_sys[proc] = db[h_name]
-
-                pickle_path = (
-                        Path(args.outdir) / f"hists_{args.year}_{region}_msd_{sys}.pkl"
-                    ) 
-                if pickle_path.exists():
-                    print(f"Cleaning up existing file: {pickle_path}")
-                    pickle_path.unlink()           
-                with pickle_path.open("wb") as f:
-                    pickle.dump(dict_sys, f)
-
-def export_h_to_shelve(in_hist, h_name, output_pkl_path):
-    # Ensure directory exists
-    Path((output_pkl_path+".dat")).parent.mkdir(parents=True, exist_ok=True)
-    print("saving: ", output_pkl_path)
-
-    with shelve.open(str(output_pkl_path), writeback=True) as db:
-        if h_name in db:
-            db[h_name] = db[h_name] + in_hist
-        else:
-            db[h_name] = in_hist
+    names = {}
+    for h_name in store:
+        proc, reg, syst = h_name.split("|")[:3]
+        if not reg in all_reg:
+            all_reg.append(reg)
+        if not syst in all_systs:
+            all_systs.append(syst)
+        names.setdefault((reg, syst), {})[proc] = h_name
+
+    for region in all_reg:
+        for sys in all_systs:
+            pickle_path = (
+                    Path(args.outdir) / f"hists_{args.year}_{region}_msd_{sys}.pkl"
+                ) 
+            if pickle_path.exists():
+                print(f"Cleaning up existing file: {pickle_path}")
+                pickle_path.unlink()           
+            store.to_pkl(pickle_path, names.get((region, sys), {}))
+
+def open_hist_store(output_path):
+    """Histogram store of a task, None if the histograms are not saved"""
+    if not output_path:
+        return None
+    print("saving: ", output_path)
+    return HistStore(f"{output_path}.hists")
 
 def eos_exists(path):
     result = subprocess.run(
@@ -217,37 +176,67 @@ def eos_exists(path):
     )
     return result.returncode == 0
 
-def fill_binned_histogram(
-    events, region_key, setup, args, systs=["nominal"], template_outfile_path="", plotting_outfile_path=""
-):
-    samples_qq = setup.get("samples_qq", [])
-    
-    reg_cfg = setup["categories"][region_key]
-    bin_branch = reg_cfg.get("bin_branch", "FatJet0_pt")
-    bin_prefix = reg_cfg.get("bin_prefix", "pt")
-    bins_list = reg_cfg["bins"]
-
-    obs = setup["observable"]
-    axis_var = hist.axis.Regular(obs["nbins"], obs["min"], obs["max"], name=obs["name"], label=obs["name"])
-    axis_bin = hist.axis.Variable(np.array(bins_list), name=bin_prefix)  # Replaced axis_pt
-    axis_cat = hist.axis.StrCategory(["pass_bb", "pass_cc", "fail", "pass", "inclusive"], name="category")
-    axis_flav = hist.axis.IntCategory([0, 1, 2, 3], name="genflavor")
-
-    h_plotting = hist.Hist(axis_var, axis_bin, axis_cat, axis_flav)
-
-    for process_name, data in events.items():
+# Events are assigned once to a cell: an exclusive category, a bin of the bin variable and a flavour,
+# and filled into one histogram (observable x cell x systematic) per process, with one fill per systematic.
+# The categories and flavour splits of the templates are unions of cells, sliced out afterwards.
+CELL_CATEGORIES = ["pass_bb", "pass_cc", "pass_other", "fail", "other"]
+CATEGORY_CELLS = {
+    "pass_bb": [0],
+    "pass_cc": [1],
+    "fail": [3],
+    "pass": [0, 1, 2],  # pass_other: Txbb == Txcc
+    "inclusive": [0, 1, 2, 3, 4],  # other: neither pass nor fail (e.g. NaN discriminant), or zmumu CR
+}
+# flavour cells: GenFlavor 0-3, and 4 for any other value
+N_FLAVOR_CELLS = 5
+FLAVOR_CELLS = {"": [1, 2], "bb": [3], "c": [2], "light": [1]}
+
+
+class TemplateFiller:
+    """
+    Fills the templates and plotting histograms of a region, process by process (or chunk by chunk
+    of a process), and exports them to histogram stores
+    """
+
+    def __init__(self, region_key, setup, args, systs=None):
+        self.region_key = region_key
+        self.setup = setup
+        self.args = args
+        self.systs = list(dict.fromkeys(systs if systs is not None else ["nominal"]))
+
+        reg_cfg = setup["categories"][region_key]
+        self.bin_branch = reg_cfg.get("bin_branch", "FatJet0_pt")
+        self.bin_prefix = reg_cfg.get("bin_prefix", "pt")
+        self.bins = np.array(reg_cfg["bins"], dtype=np.float64)
+        self.n_bins = len(self.bins) - 1
+
+        # Only inclusive category for zmumu CR — no Txbb pass/fail
+        self.categories = ["inclusive"] if "zmmcr" in region_key else list(CATEGORY_CELLS)
+
+        obs = setup["observable"]
+        self.axis_var = hist.axis.Regular(
+            obs["nbins"], obs["min"], obs["max"], name=obs["name"], label=obs["name"]
+        )
+        self.axis_bin = hist.axis.Variable(self.bins, name=self.bin_prefix)  # Replaced axis_pt
+        self.axis_cat = hist.axis.StrCategory(list(CATEGORY_CELLS), name="category")
+        self.axis_flav = hist.axis.IntCategory([0, 1, 2, 3], name="genflavor")
+        self.axis_syst = hist.axis.StrCategory(self.systs, name="syst")
+
+        # per process: observable x cell x syst, and observable x bin x category cell x genflavor x syst
+        self.h_templates = {}
+        self.h_plotting = {}
+
+    def _selection(self, process_name, data):
+        """Observable, preselection, category cell and genflavor of the events"""
+        setup = self.setup
+        region_key = self.region_key
+        obs = setup["observable"]
         is_data = "data" in process_name.lower()
-        should_split = any(s in process_name for s in samples_qq) and not is_data
-
 
         # --- VARIABLE EXTRACTION ---
         var_col = obs["branch_name"]
         pt = data["FatJet0_pt"]
 
-        Txcc = data["FatJet0_ParTPXccVsQCD"]
-        Txbb = data["FatJet0_ParTPXbbVsQCD"]
-        Txbbxcc = data["FatJet0_ParTPXbbXcc"]
-
         pt_min = setup.get("pt_min_scale", 450.0)
         working_point = setup.get("working_point", 0.82)
 
@@ -264,7 +253,7 @@ def fill_binned_histogram(
         var_series = dphi if var_col == "delta_phi_photon_jet" else data[var_col]
 
         genflavordata = (
-            np.zeros(len(data), dtype=np.int8) if is_data else data["GenFlavor"].astype(np.int8)
+            np.zeros(len(data), dtype=np.int8) if is_data else data["GenFlavor"].to_numpy().astype(np.int8)
         )
 
         # --- SELECTION LOGIC ---
@@ -278,39 +267,65 @@ def fill_binned_histogram(
             pre_selection = basic_cuts & topo_cuts & trigger & (pt > pt_min)
         elif "zmmcr" in region_key:
             # Z(mumu) CR: observable is mll, bin variable is dimuon pair pt
-            pre_selection = basic_cuts & (data[bin_branch] > pt_min)
-
-        if "zmmcr" in region_key:
-            # Only inclusive category for zmumu CR — no Txbb pass/fail
-            selection_dict = {"inclusive": pre_selection}
-        else:
-            Txcc = data["FatJet0_ParTPXccVsQCD"]
-            Txbb = data["FatJet0_ParTPXbbVsQCD"]
+            pre_selection = basic_cuts & (data[self.bin_branch] > pt_min)
+
+        category = np.full(len(data), CELL_CATEGORIES.index("other"), dtype=np.int64)
+        if "zmmcr" not in region_key:
+            Txcc = data["FatJet0_ParTPXccVsQCD"].to_numpy()
+            Txbb = data["FatJet0_ParTPXbbVsQCD"].to_numpy()
             if setup.get("use_modified_disc", False):
                 # Modified discriminant: (Xbb+Xcc) / (Xbb+Xcc+QCD+Xcs)
                 # Penalises W→cs events in the denominator
                 _num = data["FatJet0_ParTPXbb"] + data["FatJet0_ParTPXcc"]
                 _den = (_num + data["FatJet0_ParTPQCD"] + data["FatJet0_ParTPXcs"]).replace(0, np.nan)
-                Txbbxcc = (_num / _den).fillna(0.0)
+                Txbbxcc = (_num / _den).fillna(0.0).to_numpy()
             else:
-                Txbbxcc = data["FatJet0_ParTPXbbXcc"]
+                Txbbxcc = data["FatJet0_ParTPXbbXcc"].to_numpy()
 
-            selection_dict = {
-                "pass_bb": pre_selection & (Txbbxcc > working_point) & (Txbb > Txcc),
-                "pass_cc": pre_selection & (Txbbxcc > working_point) & (Txcc > Txbb),
-                "fail": pre_selection & (Txbbxcc <= working_point),
-                "pass": pre_selection & (Txbbxcc > working_point),
-                "inclusive": pre_selection,
-            }
+            passing = Txbbxcc > working_point
+            category[passing] = CELL_CATEGORIES.index("pass_other")
+            category[passing & (Txbb > Txcc)] = CELL_CATEGORIES.index("pass_bb")
+            category[passing & (Txcc > Txbb)] = CELL_CATEGORIES.index("pass_cc")
+            category[Txbbxcc <= working_point] = CELL_CATEGORIES.index("fail")
 
-        flavor_cuts = {
-            "": ((genflavordata == 1) | (genflavordata == 2)),
-            "bb": (genflavordata == 3),
-            "c": (genflavordata == 2),
-            "light": (genflavordata == 1)
-        }
+        var = np.asarray(var_series, dtype=np.float64)
+        return var, np.asarray(pre_selection, dtype=bool), category, genflavordata
 
-        for in_syst in systs:
+    def fill(self, process_name, data):
+        """Fill the events of a process (DataFrame), can be called several times per process"""
+        args = self.args
+        is_data = "data" in process_name.lower()
+
+        var, sel, category, genflavor = self._selection(process_name, data)
+        var, category, genflavor = var[sel], category[sel], genflavor[sel]
+        bin_values = data[self.bin_branch].to_numpy(dtype=np.float64)[sel]
+
+        # bins of the templates, excluding the bin edges as in (bin_lo < x < bin_hi)
+        bin_index = np.searchsorted(self.bins, bin_values, side="right") - 1
+        lower_edge = self.bins[np.clip(bin_index, 0, self.n_bins - 1)]
+        in_bins = (bin_index >= 0) & (bin_index < self.n_bins) & (bin_values > lower_edge)
+        flavor = np.where((genflavor >= 0) & (genflavor <= 3), genflavor, N_FLAVOR_CELLS - 1)
+        cell = ((category * self.n_bins + bin_index) * N_FLAVOR_CELLS + flavor)[in_bins]
+
+        if args.save_templates and process_name not in self.h_templates:
+            n_cells = len(CELL_CATEGORIES) * self.n_bins * N_FLAVOR_CELLS
+            self.h_templates[process_name] = hist.Hist(
+                self.axis_var,
+                hist.axis.Integer(0, n_cells, underflow=False, overflow=False, name="cell"),
+                self.axis_syst,
+                storage=hist.storage.Weight(),
+            )
+        if args.save_plotting_pkl and process_name not in self.h_plotting:
+            self.h_plotting[process_name] = hist.Hist(
+                self.axis_var,
+                self.axis_bin,
+                hist.axis.IntCategory(range(len(CELL_CATEGORIES)), name="category_cell"),
+                self.axis_flav,
+                self.axis_syst,
+            )
+
+        theory = None
+        for in_syst in self.systs:
 
             is_folder = any(fs in in_syst for fs in folder_systs)
             is_analysis_syst = any(ts in in_syst for ts in analysis_systs)
@@ -324,49 +339,86 @@ def fill_binned_histogram(
                 # load_samples already calculated finalWeight (weight / sum_genWeight)
                 weight_val = data["finalWeight"].astype(float)
 
+            factor = 1.0
+            if is_analysis_syst:
+                if theory is None:
+                    # converted once per batch, for all the theory systematics
+                    theory = theory_matrices(data, sel)
+                factor = perform_analysis(data, sel, weight_val, in_syst, theory)
+            if args.debug:
+                print(process_name, in_syst, is_analysis_syst, np.size(factor), np.ravel(factor)[:1])
+            weight = weight_val.to_numpy(dtype=np.float64)[sel] * factor
+
             # --- FILLING ---
-            def fill_h(name, sel, cat, flag_template=False):
-                factor = perform_analysis(data, sel, weight_val, in_syst) if is_analysis_syst else np.ones_like(data[bin_branch][sel])
-                if args.debug:
-                    print(name, in_syst, is_analysis_syst, len(factor), (next(iter(factor), None)))
-
-                if flag_template:
-                    h_template = hist.Hist(axis_var, storage=hist.storage.Weight())
-                    h_template.fill(
-                        var_series[sel],
-                        weight=weight_val[sel] * factor,
-                    )
-                    export_h_to_shelve(h_template, name, template_outfile_path)
-                    del h_template
-                    gc.collect()
-
-                else:
-                    h_plotting.fill(
-                        var_series[sel],
-                        data[bin_branch][sel],  # using dynamic bin data here
-                        category=cat,
-                        genflavor=genflavordata[sel],
-                        weight=weight_val[sel] * factor,
-                    )
-
-            for category, selection in selection_dict.items():
-                if args.save_plotting_pkl:
-                    if category in axis_cat:
-                        fill_h(f"{process_name}|{region_key}|{in_syst}", selection, category)
-
-                if args.save_templates:
-                    for i in range(len(bins_list) - 1):
-                        bin_cut = (data[bin_branch]  > bins_list[i]) & (data[bin_branch] < bins_list[i+1]) & pre_selection
-                        base_name = f"{region_key}_{category}_{bin_prefix}{i+1}_{process_name}"
-                        splits = flavor_cuts if should_split else {"": None}
-
-                        for suffix, flavor_mask in splits.items():
-                            sel = selection & bin_cut & flavor_mask if flavor_mask is not None else selection & bin_cut
-                            name = f"{base_name}{suffix}_{in_syst}"
-                            fill_h(name, sel, category, flag_template=True)
-            
+            if args.save_templates:
+                self.h_templates[process_name].fill(
+                    var[in_bins], cell, syst=in_syst, weight=weight[in_bins]
+                )
             if args.save_plotting_pkl:
-                name = f"{process_name}|{region_key}|{in_syst}"
-                export_h_to_shelve(h_plotting, name, plotting_outfile_path)
+                self.h_plotting[process_name].fill(
+                    var,
+                    bin_values,  # using dynamic bin data here
+                    category,
+                    genflavor,
+                    syst=in_syst,
+                    weight=weight,
+                )
+
+    def export(self, template_store=None, plotting_store=None):
+        """Slice the named templates and plotting histograms out of the cell histograms"""
+        samples_qq = self.setup.get("samples_qq", [])
+        n_var = self.axis_var.extent
+
+        for process_name, h_cells in self.h_templates.items():
+            is_data = "data" in process_name.lower()
+            should_split = any(s in process_name for s in samples_qq) and not is_data
+            splits = FLAVOR_CELLS if should_split else {"": list(range(N_FLAVOR_CELLS))}
+
+            view = h_cells.view(flow=True)
+            shape = (n_var, len(CELL_CATEGORIES), self.n_bins, N_FLAVOR_CELLS, -1)
+            values, variances = view.value.reshape(shape), view.variance.reshape(shape)
+
+            for in_syst in self.systs:
+                s = self.axis_syst.index(in_syst)
+                for category in self.categories:
+                    cats = CATEGORY_CELLS[category]
+                    for i in range(self.n_bins):
+                        base_name = f"{self.region_key}_{category}_{self.bin_prefix}{i+1}_{process_name}"
+                        for suffix, flavors in splits.items():
+                            h_template = hist.Hist(self.axis_var, storage=hist.storage.Weight())
+                            out = h_template.view(flow=True)
+                            out["value"] = values[:, cats, i][:, :, flavors, s].sum(axis=(1, 2))
+                            out["variance"] = variances[:, cats, i][:, :, flavors, s].sum(axis=(1, 2))
+                            template_store.add(f"{base_name}{suffix}_{in_syst}", h_template)
+
+        for process_name, h_cells in self.h_plotting.items():
+            view = h_cells.view(flow=True)
+            for in_syst in self.systs:
+                s = self.axis_syst.index(in_syst)
+                h_plotting = hist.Hist(self.axis_var, self.axis_bin, self.axis_cat, self.axis_flav)
+                out = h_plotting.view(flow=True)
+                for category in self.categories:
+                    cells = view[..., s][:, :, CATEGORY_CELLS[category]]
+                    out[:, :, self.axis_cat.index(category), :] = cells.sum(axis=2)
+                plotting_store.add(f"{process_name}|{self.region_key}|{in_syst}", h_plotting)
+
+
+def fill_binned_histogram(
+    events, region_key, setup, args, systs=["nominal"], template_outfile_path="", plotting_outfile_path=""
+):
+    # events: {process: DataFrame}, or {process: iterable of DataFrames} to fill batch by batch
+    # (e.g. utils.iter_sample_batches), keeping only one batch in memory
+    filler = TemplateFiller(region_key, setup, args, systs)
+    for process_name, data in events.items():
+        for batch in [data] if hasattr(data, "columns") else data:
+            filler.fill(process_name, batch)
+
+    template_store = open_hist_store(template_outfile_path)
+    plotting_store = open_hist_store(plotting_outfile_path)
+    filler.export(template_store, plotting_store)
+
+    for store in (template_store, plotting_store):
+        if store is not None:
+            store.flush()
 
-    return 
\ No newline at end of file
+    return
@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of the BDT inference: coffea xgboost_wrapper (awkward concatenation + DMatrix)
+versus the packed float32 matrix + inplace_predict path of hbb.bdt_inference.
+
+Run from the repository root (where the model path is relative to):
+    python src/benchmarks/bdt_inference.py --n-events 200000 --n-threads 1 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import awkward as ak
+import numpy as np
+from coffea.ml_tools import xgboost_wrapper
+
+from hbb.bdt_inference import (
+    FILL_VALUE,
+    bdt_features,
+    load_booster,
+    pack_features,
+    predict,
+)
+
+
+def make_features(n_events: int, seed: int = 42) -> ak.Array:
+    """Random features, with ~30% missing values as for events without a second fatjet or ak4 jets"""
+    rng = np.random.default_rng(seed)
+    features = {}
+    for name in bdt_features:
+        values = rng.normal(size=n_events).astype(np.float32)
+        mask = rng.random(n_events) < 0.3
+        features[name] = ak.Array(np.ma.masked_array(values, mask=mask))
+    return ak.zip(features, depth_limit=1)
+
+
+class wrapper_model(xgboost_wrapper):
+    # previous implementation, see get_BDT_model in categorizer.py before the inference refactor
+    def prepare_awkward(self, events):
+        features = []
+        for name in bdt_features:
+            feat = events[name]
+            feat = ak.fill_none(feat, FILL_VALUE)
+            features.append(feat[:, np.newaxis])
+        ret = ak.concatenate(features, axis=1)
+        return [], {"data": ret}
+
+
+def timeit(func, repeat: int):
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - tic)
+    return min(times), out
+
+
+def main(args):
+    events = make_features(args.n_events)
+    booster = load_booster(args.model)
+
+    # as before, the wrapper is built from the booster with the feature name check disabled
+    wrapper = wrapper_model(booster)
+    t_wrapper, ref = timeit(lambda: wrapper(events), args.repeat)
+    print(f"xgboost_wrapper:           {t_wrapper:.3f} s  ({args.n_events / t_wrapper / 1e3:.0f} kHz)")
+
+    t_pack, matrix = timeit(lambda: pack_features(events, bdt_features), args.repeat)
+    print(f"pack_features:             {t_pack:.3f} s")
+
+    for n_threads in args.n_threads:
+        t_pred, out = timeit(lambda n=n_threads: predict(booster, matrix, n_threads=n), args.repeat)
+        total = t_pack + t_pred
+        print(
+            f"inplace_predict ({n_threads} threads): {total:.3f} s  ({args.n_events / total / 1e3:.0f} kHz, "
+            f"x{t_wrapper / total:.1f})"
+        )
+        if not np.array_equal(np.asarray(ref), out):
+            print(f"  WARNING: {np.sum(np.asarray(ref) != out)} scores differ from the wrapper")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", default="src/hbb/data/MultiBDT_3cat_26Jun12.json", type=str)
+    parser.add_argument("--n-events", default=200_000, type=int)
+    parser.add_argument("--n-threads", default=[1, 4], type=int, nargs="+")
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,187 @@
+"""
+Benchmark of the muon scale and resolution corrections: the per-variation awkward functions of
+hbb.MuonScaRe (as previously called in correct_muons) versus the fused numpy engine muon_scare.
+
+The POG json is read from /cvmfs by default. Without /cvmfs, a synthetic correction set with the
+same inputs and outputs can be used instead:
+    python src/benchmarks/muon_scare.py --n-muons 1000000 --synthetic
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import awkward as ak
+import correctionlib
+import correctionlib.schemav2 as cs
+import numpy as np
+
+from hbb import random_utils
+from hbb.corrections import get_pog_cset
+from hbb.MuonScaRe import muon_scare, pt_resol, pt_resol_var, pt_scale, pt_scale_var
+
+
+def _binned(name, inputs, categories, variable, edges, values, flow="clamp"):
+    """Correction binned in variable, after nested categories on the (input, keys) in categories"""
+
+    def node(cats, vals):
+        if not cats:
+            return cs.Binning(nodetype="binning", input=variable.name, edges=edges, content=vals, flow=flow)
+        (cat, keys), rest = cats[0], cats[1:]
+        return cs.Category(
+            nodetype="category",
+            input=cat.name,
+            content=[cs.CategoryItem(key=key, value=node(rest, vals[key])) for key in keys],
+        )
+
+    return cs.Correction(
+        name=name,
+        version=1,
+        inputs=inputs,
+        output=cs.Variable(name="value", type="real"),
+        data=node(categories, values),
+    )
+
+
+def make_synthetic_cset() -> correctionlib.CorrectionSet:
+    """Toy correction set with the structure of the muon_scalesmearing POG json"""
+    abseta = cs.Variable(name="abseta", type="real")
+    eta = cs.Variable(name="eta", type="real")
+    phi = cs.Variable(name="phi", type="real")
+    nL = cs.Variable(name="nTrackerLayers", type="int")
+    param = cs.Variable(name="param", type="int")
+    var = cs.Variable(name="var", type="string")
+
+    edges = [0.0, 0.9, 1.2, 2.1, 2.4]
+    cb = {0: [0.0, 0.01, -0.01, 0.02], 1: [1.0, 1.1, 1.2, 1.3], 2: [3.0, 4.0, 5.0, 6.0], 3: [1.5, 1.7, 1.9, 2.1]}
+    poly = {0: [0.01, 0.012, 0.015, 0.02], 1: [1e-4, 1.2e-4, 1.5e-4, 2e-4], 2: [1e-7, 2e-7, 3e-7, 4e-7]}
+    nl_keys = list(range(20))
+
+    def with_layers(values):
+        # nTrackerLayers enters as a category, with a small dependence on the number of layers
+        return {p: {n: [v * (1 + 0.01 * (n - 10)) for v in vals] for n in nl_keys} for p, vals in values.items()}
+
+    corrections = [
+        _binned("cb_params", [abseta, nL, param], [(param, list(cb)), (nL, nl_keys)], abseta, edges, with_layers(cb)),
+        _binned(
+            "poly_params", [abseta, nL, param], [(param, list(poly)), (nL, nl_keys)], abseta, edges, with_layers(poly)
+        ),
+    ]
+    k_values = {
+        "k_data": {"nom": [1.1, 1.15, 1.2, 1.25], "stat": [0.02] * 4},
+        "k_mc": {"nom": [1.0, 1.05, 1.1, 1.3], "stat": [0.03] * 4},
+    }
+    for name, values in k_values.items():
+        corrections.append(_binned(name, [abseta, var], [(var, list(values))], abseta, edges, values))
+    eta_edges = [-2.4, -1.2, 0.0, 1.2, 2.4]
+    for dtmc, scale in [("data", 1.0), ("mc", 0.5)]:
+        a_values = {"nom": [1e-4 * scale, -2e-4 * scale, 3e-4 * scale, -1e-4 * scale], "stat": [5e-5] * 4}
+        m_values = {
+            "nom": [1.0 + 1e-3 * scale, 1.0 - 2e-3 * scale, 1.0 + 5e-4 * scale, 1.0 - 1e-3 * scale],
+            "stat": [2e-4] * 4,
+            "rho_stat": [0.1, -0.2, 0.3, -0.1],
+        }
+        # phi enters the real json as a second binning, it is only passed along here
+        for name, values in [("a_" + dtmc, a_values), ("m_" + dtmc, m_values)]:
+            corrections.append(_binned(name, [eta, phi, var], [(var, list(values))], eta, eta_edges, values))
+
+    cset = cs.CorrectionSet(schema_version=2, corrections=corrections)
+    return correctionlib.CorrectionSet.from_string(cset.model_dump_json())
+
+
+def make_muons(n_muons: int, seed: int = 42):
+    """Random muons in events with 0 to 3 muons, in the kinematic range of the selections"""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 4, size=n_muons)
+    counts = counts[np.cumsum(counts) <= n_muons]
+    counts = np.append(counts, n_muons - counts.sum())
+    n_events = len(counts)
+
+    flat = {
+        "pt": (20 + rng.exponential(40, size=n_muons)).astype(np.float32),
+        "eta": rng.uniform(-2.4, 2.4, size=n_muons).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, size=n_muons).astype(np.float32),
+        "charge": rng.choice([-1, 1], size=n_muons).astype(np.int32),
+        "nTrackerLayers": rng.integers(7, 18, size=n_muons).astype(np.int32),
+    }
+    muons = ak.zip({key: ak.unflatten(value, counts) for key, value in flat.items()})
+    run = np.full(n_events, 367000, dtype=np.uint32)
+    event = rng.integers(0, 2**40, size=n_events, dtype=np.uint64)
+    lumi = rng.integers(1, 2000, size=n_events).astype(np.uint32)
+    return muons, run, lumi, event, counts
+
+
+def previous(muons, run, lumi, event, cset):
+    """Per-variation calls, as previously done in corrections.correct_muons"""
+    out = {"ptscalecorr": pt_scale(0, muons.pt, muons.eta, muons.phi, muons.charge, cset, nested=True)}
+    out["ptcorr"] = pt_resol(out["ptscalecorr"], muons.eta, muons.nTrackerLayers, event, lumi, run, cset, nested=True)
+    out["ptscalecorr_up"] = pt_scale_var(out["ptcorr"], muons.eta, muons.phi, muons.charge, "up", cset, nested=True)
+    out["ptscalecorr_down"] = pt_scale_var(out["ptcorr"], muons.eta, muons.phi, muons.charge, "dn", cset, nested=True)
+    out["ptcorr_resol_up"] = pt_resol_var(out["ptscalecorr"], out["ptcorr"], muons.eta, "up", cset, nested=True)
+    out["ptcorr_resol_down"] = pt_resol_var(out["ptscalecorr"], out["ptcorr"], muons.eta, "dn", cset, nested=True)
+    return out
+
+
+def fused(muons, run, lumi, event, counts, cset):
+    """Fused engine, including the flattening and unflattening done in the processor kernel"""
+
+    def flat(x):
+        return ak.to_numpy(ak.flatten(x))
+
+    corrected = muon_scare(
+        flat(muons.pt),
+        flat(muons.eta),
+        flat(muons.phi),
+        flat(muons.charge),
+        flat(muons.nTrackerLayers),
+        random_utils.uniform(*random_utils.object_keys(run, lumi, event, counts), "muon_resolution"),
+        cset,
+        is_data=False,
+    )
+    return {key: ak.unflatten(value, counts) for key, value in corrected.items()}
+
+
+def timeit(func, repeat: int):
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - tic)
+    return min(times), out
+
+
+def main(args):
+    if args.synthetic:
+        cset = make_synthetic_cset()
+    elif args.cset is not None:
+        cset = correctionlib.CorrectionSet.from_file(args.cset)
+    else:
+        cset = get_pog_cset("muon_pt", args.year)
+
+    muons, run, lumi, event, counts = make_muons(args.n_muons)
+
+    t_previous, ref = timeit(lambda: previous(muons, run, lumi, event, cset), args.repeat)
+    print(f"per-variation awkward: {t_previous:.3f} s  ({args.n_muons / t_previous / 1e6:.2f} MHz)")
+
+    t_fused, out = timeit(lambda: fused(muons, run, lumi, event, counts, cset), args.repeat)
+    print(
+        f"fused numpy:           {t_fused:.3f} s  ({args.n_muons / t_fused / 1e6:.2f} MHz, x{t_previous / t_fused:.1f})"
+    )
+
+    for key, value in ref.items():
+        a, b = ak.to_numpy(ak.flatten(value)), ak.to_numpy(ak.flatten(out[key]))
+        if not np.array_equal(a, b, equal_nan=True):
+            diff = np.nanmax(np.abs(a - b) / np.abs(a))
+            print(f"  WARNING: {np.sum(a != b)} {key} values differ (max relative difference {diff:.2e})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--year", default="2023", type=str)
+    parser.add_argument("--cset", default=None, type=str, help="muon_scalesmearing json, instead of the POG one")
+    parser.add_argument("--synthetic", action="store_true", default=False, help="use a toy correction set")
+    parser.add_argument("--n-muons", default=1_000_000, type=int)
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,44 @@
+"""
+Builds (or updates) the normalization index of a skim tag (see hbb/utils.py build_sumw_index),
+which load_samples uses instead of reading the pickles of every dataset:
+    python src/build_sumw_index.py --tag 26Feb03 --year 2023
+Only the datasets that are missing from the index, or whose pickles changed, are read again.
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+from hbb.utils import SUMW_INDEX_DIR, build_sumw_index
+
+
+def main(args):
+    data_dir = Path(args.data_dir) if args.data_dir else Path(f"/eos/uscms/store/group/lpchbbrun3/skims/{args.tag}/{args.year}")
+    index_dir = Path(args.index_dir) if args.index_dir else data_dir / SUMW_INDEX_DIR
+
+    index = build_sumw_index(
+        data_dir, datasets=args.datasets or None, index_dir=index_dir, rebuild=args.rebuild, n_threads=args.threads
+    )
+    print(f"Wrote the normalization index of {len(index['datasets'])} datasets to {index_dir}")
+    if args.verbose:
+        for dataset, entry in sorted(index["datasets"].items()):
+            print(f"{dataset:<60} {len(entry['pickles']):>5} pickles  sumw {index['sumw'][entry['row']]:.6g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--tag", default=None, help="skims tag, e.g. 26Feb03")
+    parser.add_argument("--year", default=None, choices=["2022", "2022EE", "2023", "2023BPix", "2024"])
+    parser.add_argument("--data-dir", default=None, help="directory of the datasets, instead of --tag and --year")
+    parser.add_argument("--index-dir", default=None, help=f"defaults to <data dir>/{SUMW_INDEX_DIR}")
+    parser.add_argument("--datasets", default=[], nargs="*", help="datasets to index, all by default")
+    parser.add_argument("--rebuild", action="store_true", help="read the pickles of every dataset again")
+    parser.add_argument("--threads", default=8, type=int, help="datasets read at the same time")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.data_dir is None and (args.tag is None or args.year is None):
+        parser.error("--tag and --year are required when --data-dir is not provided.")
+
+    main(args)
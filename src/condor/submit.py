@@ -110,6 +110,16 @@ def main(args):
                     "nano_version": args.nano_version,
                     "run_mode": args.run_mode,
                     "BDT": args.BDT,
+                    "extra_args": " ".join(
+                        (["--skim-region-flags"] if args.skim_region_flags else [])
+                        + [f"--weight-format {args.weight_format}"]
+                        + [f"--skim-dtypes {args.skim_dtypes} --pdf-dtype {args.pdf_dtype}"]
+                        + (
+                            [f"--preprocess-cache {args.preprocess_cache} --preprocess-cache-mode read"]
+                            if args.preprocess_cache
+                            else []
+                        )
+                    ),
                 }
                 write_template(sh_templ, localsh, sh_args)
                 os.system(f"chmod u+x {localsh}")
@@ -172,6 +182,39 @@ def parse_args(parser):
         help="Evaluate BDT scores and use for categorization",
         default=False,
     )
+    run_utils.add_bool_arg(
+        parser,
+        "skim-region-flags",
+        default=False,
+        help="write each shift once per skim group, with the regions as boolean columns",
+    )
+    parser.add_argument(
+        "--weight-format",
+        default="full",
+        help="store every systematic weight in the skims, or only the individual weight factors",
+        type=str,
+        choices=["full", "factors"],
+    )
+    parser.add_argument(
+        "--skim-dtypes",
+        default="native",
+        help="store the skim columns with their awkward types, or with the compact policy",
+        type=str,
+        choices=["native", "compact"],
+    )
+    parser.add_argument(
+        "--pdf-dtype",
+        default="float32",
+        help="type of the PDF and scale variation weights with --skim-dtypes compact",
+        type=str,
+        choices=["float32", "float16"],
+    )
+    parser.add_argument(
+        "--preprocess-cache",
+        default=None,
+        help="preprocess cache read by the jobs (e.g. on EOS), filled beforehand with run.py --preprocess-only",
+        type=str,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+"""
+BDT inference for the event categorization.
+
+The input features are packed into one contiguous float32 matrix per partition and evaluated
+with xgboost's inplace_predict, which avoids building a DMatrix and the per-feature awkward
+concatenation of coffea's xgboost_wrapper. The booster is loaded once per worker process.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import awkward as ak
+import dask_awkward as dak
+import numpy as np
+import xgboost as xgb
+
+from hbb.corrections import get_registered
+
+# input features of MultiBDT_3cat_26Jun12, in training order
+bdt_features = [
+    "nFatJet",
+    "nJet",
+    "FatJet0_phi",
+    "FatJet0_eta",
+    "FatJet0_n2b1",
+    "FatJet0_n3b1",
+    "FatJet1_pt",
+    "FatJet1_phi",
+    "FatJet1_eta",
+    "FatJet1_msd",
+    "VBFPair_mjj",
+    "VBFPair_deta",
+    "FatJet1_ParTPQCD",
+    "FatJet1_ParTPXbb",
+    "FatJet1_ParTPXcc",
+    "FatJet1_ParTPXqq",
+    "FatJet1_ParTPXcs",
+    "FatJet1_ParTPXbbVsQCD",
+    "FatJet1_ParTPXccVsQCD",
+    "FatJet1_ParTPXbbXcc",
+    "FatJet1_ParTmassX2p",
+    "Jet0_pt",
+    "Jet0_eta",
+    "Jet0_phi",
+    "Jet0_mass",
+    "Jet0_btagPNetB",
+    "Jet0_btagPNetCvB",
+    "Jet0_btagPNetCvL",
+    "Jet0_btagPNetQvG",
+    "Jet1_pt",
+    "Jet1_eta",
+    "Jet1_phi",
+    "Jet1_mass",
+    "Jet1_btagPNetB",
+    "Jet1_btagPNetCvB",
+    "Jet1_btagPNetCvL",
+    "Jet1_btagPNetQvG",
+    "Jet2_pt",
+    "Jet2_eta",
+    "Jet2_phi",
+    "Jet2_mass",
+    "Jet2_btagPNetB",
+    "Jet2_btagPNetCvB",
+    "Jet2_btagPNetCvL",
+    "Jet2_btagPNetQvG",
+    "Jet3_pt",
+    "Jet3_eta",
+    "Jet3_phi",
+    "Jet3_mass",
+    "Jet3_btagPNetB",
+    "Jet4_btagPNetCvB",
+    "Jet4_btagPNetCvL",
+    "Jet4_btagPNetQvG",
+    "JetClosestFatJet0_pt",
+    "JetClosestFatJet0_eta",
+    "JetClosestFatJet0_phi",
+    "JetClosestFatJet0_mass",
+]
+
+# value of missing features (e.g. no second fatjet), as used in the training
+FILL_VALUE = -999.0
+
+
+def load_booster(model_file: str) -> xgb.Booster:
+    """Booster for a model file (relative to the working directory), loaded once per process"""
+
+    def loader():
+        booster = xgb.Booster()
+        booster.load_model(Path.cwd() / model_file)
+        booster.feature_names = None  # Disable feature name checking
+        return booster
+
+    return get_registered(("bdt", model_file), loader)
+
+
+def pack_features(features, names: list[str]) -> np.ndarray:
+    """
+    Pack flat (optional) feature arrays into a C-contiguous float32 matrix of shape (events, features),
+    filling missing values with FILL_VALUE
+    """
+    columns = [features[name] for name in names]
+    n_events = len(columns[0]) if columns else 0
+    matrix = np.empty((n_events, len(names)), dtype=np.float32)
+    for i, column in enumerate(columns):
+        matrix[:, i] = ak.to_numpy(ak.fill_none(column, FILL_VALUE))
+    return matrix
+
+
+def predict(booster: xgb.Booster, matrix: np.ndarray, n_threads: int = 1, block_size: int = 50_000) -> np.ndarray:
+    """
+    Evaluate the booster on the packed matrix with inplace_predict.
+    With n_threads > 1, blocks of rows are evaluated concurrently (inplace_predict is thread safe
+    and releases the GIL).
+    """
+    if n_threads <= 1 or len(matrix) <= block_size:
+        return booster.inplace_predict(matrix)
+
+    blocks = [matrix[i : i + block_size] for i in range(0, len(matrix), block_size)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(booster.inplace_predict, blocks))
+    return np.concatenate(results)
+
+
+def _bdt_kernel(features, model_file, names, n_threads):
+    """Per-partition kernel, the typetracer pass (column optimization) is done on length-zero arrays"""
+    typetracer = ak.backend(features) == "typetracer"
+    features = ak.typetracer.length_zero_if_typetracer(features)
+
+    matrix = pack_features(features, names)
+    if len(matrix):
+        scores = predict(load_booster(model_file), matrix, n_threads=n_threads)
+    else:
+        scores = np.zeros(0, dtype=np.float32)
+
+    out = ak.Array(scores)
+    if typetracer:
+        out = ak.Array(out.layout.to_typetracer(forget_length=True))
+    return out
+
+
+class BDTModel:
+    """
+    Callable BDT evaluation on a record array (or dict) of features.
+    Only the model file name is stored, so the object is cheap to serialize to the workers.
+    The features are read from the columns given by columns ({feature: column}), or from the
+    column with the feature name.
+    """
+
+    def __init__(self, model_file: str, features: list[str] = None, n_threads: int = 1, columns: dict = None):
+        self.model_file = model_file
+        self.features = list(features) if features is not None else list(bdt_features)
+        self.n_threads = n_threads
+        self.columns = dict(columns) if columns is not None else {}
+
+    def __call__(self, events):
+        names = [self.columns.get(name, name) for name in self.features]
+        if isinstance(events, dict):
+            events = ak.zip({name: events[name] for name in names}, depth_limit=1)
+
+        kwargs = {"model_file": self.model_file, "names": names, "n_threads": self.n_threads}
+        if isinstance(events, dak.Array):
+            return dak.map_partitions(_bdt_kernel, events, label="bdt-inference", **kwargs)
+        return _bdt_kernel(events, **kwargs)
@@ -0,0 +1,184 @@
+"""
+Adaptive chunking for run.py.
+
+Data, QCD and signal MC have very different event complexity, so a single step size either
+creates many small tasks (overhead dominated) or chunks that run out of memory. Instead, a small
+probe chunk of each dataset is processed first, measuring its wall time and memory growth, and the
+step size is chosen to fit a memory target (RSS) and a target task duration. The measurements are
+stored per dataset in a json file, so that later jobs on the same dataset reuse them without probing.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import resource
+import threading
+import time
+from pathlib import Path
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with Path("/proc/self/statm").open() as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # no procfs (e.g. macOS): fall back to the peak RSS so far (bytes on macOS, kB on linux)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+class PeakRSS:
+    """
+    Context manager recording the RSS when entered and its peak while inside,
+    sampled in a background thread every interval seconds
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = current_rss()
+        self.peak = self.start
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+
+def measure_chunk(run_chunk, n_events: int) -> dict:
+    """
+    Time a call to run_chunk() and measure the memory it adds
+    :param run_chunk: callable computing a chunk of n_events events, with its graph already built
+        (building the graph is a fixed cost, which would bias the time per event)
+    :return: {"events", "seconds", "rss_before", "rss_peak", "mem_per_event", "time_per_event"}
+    """
+    with PeakRSS() as rss:
+        tic = time.time()
+        run_chunk()
+        seconds = time.time() - tic
+    n_events = max(n_events, 1)
+    return {
+        "events": n_events,
+        "seconds": seconds,
+        "rss_before": rss.start,
+        "rss_peak": rss.peak,
+        "mem_per_event": max(rss.peak - rss.start, 0) / n_events,
+        "time_per_event": seconds / n_events,
+    }
+
+
+def choose_step_size(
+    measurement: dict,
+    memory_target: float = 2e9,
+    target_time: float = 120.0,
+    concurrency: int = 1,
+    baseline: float = None,
+    min_step: int = 1_000,
+    max_step: int = 500_000,
+    round_to: int = 1_000,
+) -> int:
+    """
+    Largest step size that keeps the RSS below memory_target and the chunks below target_time
+    :param measurement: output of measure_chunk
+    :param memory_target: target RSS in bytes
+    :param target_time: target wall time of a chunk in seconds
+    :param concurrency: number of chunks processed at the same time (e.g. dask threads)
+    :param baseline: RSS not proportional to the chunk size, defaults to the RSS before the probe
+    """
+    if baseline is None:
+        baseline = measurement["rss_before"]
+
+    candidates = [max_step]
+    if measurement["mem_per_event"] > 0:
+        free = max(memory_target - baseline, 0)
+        candidates.append(free / (measurement["mem_per_event"] * max(concurrency, 1)))
+    if measurement["time_per_event"] > 0:
+        candidates.append(target_time / measurement["time_per_event"])
+
+    step = int(min(candidates)) // round_to * round_to
+    return min(max(step, min_step), max_step)
+
+
+def _split(start: int, stop: int, step_size: int) -> list[list[int]]:
+    n = math.ceil((stop - start) / step_size)
+    edges = [start + round(i * (stop - start) / n) for i in range(n + 1)]
+    return [[lo, hi] for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def rechunk_steps(steps: list, step_size: int) -> list[list[int]]:
+    """
+    Steps of about step_size entries from the (cluster aligned) steps of a file: consecutive steps are
+    merged as long as they fit in step_size, which keeps their alignment, and larger steps are split evenly
+    """
+    out = []
+    for start, stop in steps:
+        if stop - start > step_size:
+            out.extend(_split(start, stop, step_size))
+        elif out and out[-1][1] == start and stop - out[-1][0] <= step_size:
+            out[-1][1] = stop
+        else:
+            out.append([start, stop])
+    return out
+
+
+def rechunk_dataset(dataset_spec: dict, step_size: int) -> dict:
+    """Copy of a preprocessed dataset spec with the steps of every file rechunked to step_size"""
+    files = {}
+    for fname, file_spec in dataset_spec["files"].items():
+        new_spec = dict(file_spec)
+        if new_spec.get("steps") is not None:
+            new_spec["steps"] = rechunk_steps(new_spec["steps"], step_size)
+        files[fname] = new_spec
+    return {**dataset_spec, "files": files}
+
+
+def probe_dataset(dataset_spec: dict, n_events: int) -> tuple[dict, int]:
+    """
+    Spec with a single chunk of at most n_events events, taken from the first step of the first file
+    :return: (spec, number of events in the chunk)
+    """
+    for fname, file_spec in dataset_spec["files"].items():
+        if file_spec.get("steps"):
+            start, stop = file_spec["steps"][0]
+            stop = min(stop, start + n_events)
+            probe = {**file_spec, "steps": [[start, stop]]}
+            return {**dataset_spec, "files": {fname: probe}}, stop - start
+    raise ValueError("No file with steps to probe in the dataset")
+
+
+def load_chunk_sizes(path: str) -> dict:
+    """Stored probe measurements, as {dataset: measurement}"""
+    path = Path(path)
+    if not path.is_file():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_chunk_sizes(path: str, chunk_sizes: dict):
+    """Merge the measurements into the json file (other datasets already in the file are kept)"""
+    stored = load_chunk_sizes(path)
+    stored.update(chunk_sizes)
+    tmp = Path(f"{path}.tmp")
+    with tmp.open("w") as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+    tmp.replace(path)
@@ -11,6 +11,7 @@ import pathlib
 from pathlib import Path
 
 import contextlib
+import threading
 
 import awkward as ak
 import dask_awkward as dak
@@ -24,7 +25,8 @@ from coffea.nanoevents.methods.nanoaod import JetArray, MuonArray
 from coffea.jetmet_tools import CorrectedJetsFactory, CorrectedMETFactory, JECStack
 from coffea.lookup_tools import extractor
 
-from hbb.MuonScaRe import pt_resol, pt_scale, pt_resol_var, pt_scale_var 
+from hbb import random_utils
+from hbb.MuonScaRe import muon_scare
 from hbb.jerc_eras import jec_eras,jer_eras, jec_mc, jer_mc, jec_data, fatjet_jerc_keys, jet_jerc_keys
 from hbb.taggers import b_taggers
 from hbb.EWHiggs_corrections import theory_xs, xs_ewkcorr, ewh_ptbin
@@ -84,6 +86,50 @@ def get_pog_json(obj: str, year: str) -> str:
     return f"{pog_correction_path}/{pog_json[0]}/{year}/latest/{pog_json[1]}"
 
 
+# Process-wide registry of parsed correction objects.
+# Parsing the gzipped POG jsons and the JERC text files takes seconds, so each object is
+# loaded lazily once per worker process and then reused by every chunk and every shift.
+# Keys are tuples starting with the kind of object, e.g. ("pog", year, obj) or
+# ("jerc", year, runkey, jet_type).
+_correction_registry = {}
+_correction_registry_lock = threading.RLock()
+
+
+def get_registered(key: tuple, loader):
+    """
+    Return the object stored under key, calling loader() to build it on first access
+    """
+    with _correction_registry_lock:
+        if key not in _correction_registry:
+            _correction_registry[key] = loader()
+        return _correction_registry[key]
+
+
+def invalidate_corrections(*key_prefix):
+    """
+    Drop cached correction objects whose key starts with key_prefix,
+    e.g. invalidate_corrections("pog", "2022") or invalidate_corrections() to clear everything
+    """
+    with _correction_registry_lock:
+        for key in [k for k in _correction_registry if k[: len(key_prefix)] == key_prefix]:
+            del _correction_registry[key]
+
+
+def get_pog_cset(obj: str, year: str):
+    """Cached correctionlib CorrectionSet for a POG json"""
+    return get_registered(
+        ("pog", year, obj), lambda: correctionlib.CorrectionSet.from_file(get_pog_json(obj, year))
+    )
+
+
+def get_local_cset(filename: str):
+    """Cached correctionlib CorrectionSet for a json stored in the package"""
+    return get_registered(
+        ("local", filename),
+        lambda: correctionlib.CorrectionSet.from_file(f"{package_path}/hbb/data/{filename}"),
+    )
+
+
 def build_lumimask(filename):
     from coffea.lumi_tools import LumiMask
 
@@ -108,10 +154,9 @@ def add_pileup_weight(weights: Weights, year: str, nPU):
     values = {}
 
     if not year == "2024":
-        cset = correctionlib.CorrectionSet.from_file(get_pog_json("pileup", year))
+        cset = get_pog_cset("pileup", year)
     else:
-        pog_json_file = f"{package_path}/hbb/data/puWeights_2024.json"
-        cset = correctionlib.CorrectionSet.from_file(get_pog_json("pileup2024", year))
+        cset = get_pog_cset("pileup2024", year)
 
     corr = {
         "2018": "Collisions18_UltraLegacy_goldenJSON",
@@ -128,17 +173,40 @@ def add_pileup_weight(weights: Weights, year: str, nPU):
 
     weights.add("pileup", values["nominal"], values["up"], values["down"])
 
+# number of PDF (standard Hessian set) and QCD scale (muR x muF, index 4 is the nominal) variations
+N_PDF_WEIGHTS = 103
+N_SCALEVAR_WEIGHTS = 9
+
+
+def _theory_ratio_kernel(var_weights, n_var: int):
+    if ak.backend(var_weights) != "typetracer":
+        lengths = np.unique(ak.to_numpy(ak.num(var_weights, axis=1)))
+        if np.any(lengths != n_var):
+            # e.g. 8 scale weights without the nominal: the variations would be shifted by one
+            raise ValueError(f"Expected {n_var} theory weights per event, found lengths {lengths.tolist()}")
+    # all the vectors have n_var entries, this only makes the list type regular
+    return ak.fill_none(ak.pad_none(var_weights, n_var, axis=1, clip=True), 1.0)
+
+
+def theory_ratio_matrix(var_weights, n_var: int):
+    """
+    Variations as a regular (events, n_var) array of ratios to the nominal LHE weight
+    (as stored in NanoAOD). Raises ValueError when computed if an event does not have exactly n_var variations.
+    """
+    if isinstance(var_weights, dak.Array):
+        return dak.map_partitions(_theory_ratio_kernel, var_weights, n_var=n_var, label="theory-ratio-matrix")
+    return _theory_ratio_kernel(var_weights, n_var)
+
+
 def add_pdf_weight(gen_weights, pdf_weights, output):
     """
     Apply pdf weight variation for standard Hessian set
+    Stored as a single fixed-size list column, with the sums of weights as one array
     """
+    pdf = theory_ratio_matrix(pdf_weights, N_PDF_WEIGHTS)
+    output["sumw_pdf"]["sumweight_pdf"] = ak.sum(pdf * gen_weights[:, np.newaxis], axis=0)
 
-    out_pdf = {}
-    for i in range(103):
-        out_pdf[f"weight_pdf_{i}"] = pdf_weights[:, i]
-        output["sumw_pdf"][f"sumweight_pdf_{i}"] = ak.sum(pdf_weights[:, i] * gen_weights)
-
-    return out_pdf
+    return {"weight_pdf": pdf}
 
 def add_ps_weight(weights: Weights, ps_weights):
     """
@@ -164,29 +232,21 @@ def add_ps_weight(weights: Weights, ps_weights):
     weights.add("ISRPartonShower", nom, up_isr, down_isr)
     weights.add("FSRPartonShower", nom, up_fsr, down_fsr)
 
-def add_scalevar(gen_weights, var_weights, output, structure = "7pt"):
+def add_scalevar(gen_weights, var_weights, output):
     """
     QCD scale variations according to recommendations by the LHCXSWG
     For application to:
          high pt ggf and ttH higgs production mc : muF = muR
          high pt VBF and VH higgs production mc : muF^2 = muR^2
     Recommendation by LHCXSWG cds.cern.ch/record/2669113
-    """
-    var_map = {
-        "3pt" : [0, 4, 8],             # case where muF^2 = muR^2
-        "7pt" : [0, 1, 3, 4, 5, 7, 8]  # case where muF = muR 
-    }
 
-    out_lhe = {}
-    try:
-        for var in var_map[structure]:
-            out_lhe[f"weight_scalevar_{structure}_{var}"] = var_weights[:, var]
-            output["sumw_scalevar"][f"sumweight_scalevar_{structure}_{var}"] = ak.sum(var_weights[:, var] * gen_weights)
-            
-    except Exception as e:
-        print("Scale variation structure unexpected:", e)
+    All 9 variations are stored in a single fixed-size list column, the 3pt ([0, 4, 8])
+    or 7pt ([0, 1, 3, 4, 5, 7, 8]) envelope is chosen when making the templates
+    """
+    scalevar = theory_ratio_matrix(var_weights, N_SCALEVAR_WEIGHTS)
+    output["sumw_scalevar"]["sumweight_scalevar"] = ak.sum(scalevar * gen_weights[:, np.newaxis], axis=0)
 
-    return out_lhe
+    return {"weight_scalevar": scalevar}
 
 def get_EWHiggs_corrector(prodmode: str):
     #Create the corrector for the EW Higgs xs corrections based on selected production mode
@@ -244,8 +304,8 @@ def add_EWHiggs_weight(weights: Weights, dataset: str, genpart):
     else:
         return
     
-    corr = get_EWHiggs_corrector(prodmode)
-    ewk_nominal = corr.to_evaluator().evaluate(boson_pt)
+    corr = get_registered(("ewhiggs", prodmode), lambda: get_EWHiggs_corrector(prodmode).to_evaluator())
+    ewk_nominal = corr.evaluate(boson_pt)
 
     weights.add(f"{prodmode}_EW", ewk_nominal)
 
@@ -254,13 +314,14 @@ def add_EWHiggs_weight(weights: Weights, dataset: str, genpart):
 # apply to both Data and MC
 # https://cms-talk.web.cern.ch/t/jet-veto-maps-for-run3-data/18444?u=anmalara
 # https://cms-talk.web.cern.ch/t/jes-for-2022-re-reco-cde-and-prompt-fg/32873
-def get_jetveto_event(jets: JetArray, year: str):
+def get_jetveto_jets(jets: JetArray, year: str):
     """
-    Get event selection that rejects events with jets in the veto map
+    Jets that can veto the event: in the veto map and passing the tight lepton veto ID.
+    Does not depend on the jet energy, so it can be shared between the JES/JER variations.
     """
 
     # correction: Non-zero value for (eta, phi) indicates that the region is vetoed
-    cset = correctionlib.CorrectionSet.from_file(get_pog_json("jetveto", year))
+    cset = get_pog_cset("jetveto", year)
     j, nj = ak.flatten(jets), ak.num(jets)
 
     def get_veto(j, nj, csetstr):
@@ -278,8 +339,18 @@ def get_jetveto_event(jets: JetArray, year: str):
     }[year]
 
     jet_veto = get_veto(j, nj, corr_str) > 0
+    return jets.jetidtightlepveto & jet_veto
+
 
-    event_sel = ~(ak.any((jets.pt > 15) & (jets.jetidtightlepveto) & jet_veto, axis=1))
+def get_jetveto_event(jets: JetArray, year: str, veto_jets=None):
+    """
+    Get event selection that rejects events with jets in the veto map
+    :param veto_jets: output of get_jetveto_jets for these jets, if already computed
+    """
+    if veto_jets is None:
+        veto_jets = get_jetveto_jets(jets, year)
+
+    event_sel = ~(ak.any((jets.pt > 15) & veto_jets, axis=1))
     return event_sel
 
 def correct_jetid(jets, jet_type: str, year: str):
@@ -288,7 +359,7 @@ def correct_jetid(jets, jet_type: str, year: str):
     https://twiki.cern.ch/twiki/bin/view/CMS/JetID13p6TeV#nanoAOD_Flags
     https://gitlab.cern.ch/cms-nanoAOD/jsonpog-integration/-/blob/199ba071f68176a815615651f8a5ae939ef0793e/examples/jetidExample.py
     """
-    evaluator = correctionlib.CorrectionSet.from_file(get_pog_json("jetid", year))
+    evaluator = get_pog_cset("jetid", year)
 
     if jet_type == "AK8":
         name_tight = "AK8PUPPI_Tight"
@@ -335,8 +406,8 @@ jec_name_map = {
     "UnClusteredEnergyDeltaY": "MetUnclustEnUpDeltaY",
 }
 
-def apply_jerc(jets, jet_type: str, year: str, runkey: str):
-    #Create CorrectedJetFactory and apply jercs+variations to JetArray or FatJetArray
+def build_jet_factory(jet_type: str, year: str, runkey: str):
+    #Create CorrectedJetFactory from the JEC/JER text files for a given jet type and run
 
     jerc_path =f"{package_path}/hbb/data/jerc"
     jec_path = f"{jerc_path}/{jec_eras[runkey]}"
@@ -365,7 +436,14 @@ def apply_jerc(jets, jet_type: str, year: str, runkey: str):
         ext.finalize()
 
     jec_stack = JECStack(ext.make_evaluator())
-    jet_factory = CorrectedJetsFactory(jec_name_map, jec_stack)
+    return CorrectedJetsFactory(jec_name_map, jec_stack)
+
+def apply_jerc(jets, jet_type: str, year: str, runkey: str):
+    #Apply jercs+variations to JetArray or FatJetArray, the factory is built once per process
+
+    jet_factory = get_registered(
+        ("jerc", year, runkey, jet_type), lambda: build_jet_factory(jet_type, year, runkey)
+    )
 
     corrected_jets = jet_factory.build(jets)
     return corrected_jets
@@ -380,65 +458,118 @@ def correct_met(met, jets: JetArray):
     met["MetUnclustEnUpDeltaX"] = dX_up - dX_nom
     met["MetUnclustEnUpDeltaY"] = dY_up - dY_nom
 
-    met_factory = CorrectedMETFactory(jec_name_map)
+    met_factory = get_registered(("met_factory",), lambda: CorrectedMETFactory(jec_name_map))
     corrected_met = met_factory.build(met, jets)
 
     return corrected_met
 
-def add_btag_weights(weights: Weights, jets: JetArray, btagger: str, wp: str, year: str, alt_str: str):
-    """
-    Apply btag event scale factor for AK4 jets queried
-    Using BTV fixed WP recommendations
-    https://btv-wiki.docs.cern.ch/PerformanceCalibration/fixedWPSFRecommendations/
-    """
-    sys_name = ""
+def load_btag_eff(btagger: str, year: str):
+    #Load the MC b-tagging efficiency lookups, see src/hbb/data/btag/compile_btag_eff.py
+    eff_file = f"{package_path}/hbb/data/btag/mc_eff_{btagger}_{year}.pkl"
+    with open(eff_file, 'rb') as f:
+        return pickle.load(f)
+
+btag_sf_systematics = ["central", "up", "down", "up_correlated", "down_correlated"]
+# flavour groups of the b-tag weights, as {group: hadronFlavour}
+btag_flavour_groups = {"light": 0, "b": 4, "c": 5}
+
+
+def get_btag_sys_name(btagger: str) -> str:
     if "PNet" in btagger:
-        sys_name = "particleNet"
+        return "particleNet"
     elif "RobustParT" in btagger:
-        sys_name = "robustParticleTransformer"
+        return "robustParticleTransformer"
     elif "DeepFlav" in btagger:
-        sys_name = "deepJet"
+        return "deepJet"
     elif "UParT" in btagger:
-        sys_name = "UParTAK4"
+        return "UParTAK4"
+    return ""
 
-    cset = correctionlib.CorrectionSet.from_file(get_pog_json("btagging", year))
-    btag_cut = b_taggers[year]["AK4"][btagger][wp]
 
-    eff_file = f"{package_path}/hbb/data/btag/mc_eff_{btagger}_{year}.pkl"
-    with open(eff_file, 'rb') as f:
-        lookup_dict = pickle.load(f)
+def _btag_weights_kernel(jets, eff, btagger, wp, year):
+    """
+    Per-partition kernel: flatten the jets once, evaluate every SF systematic on the light and
+    heavy flavour jets, and reduce to one per-event weight per flavour group and systematic.
+    Runs on numpy arrays, the typetracer pass (column optimization) is done on length-zero arrays.
+    """
+    typetracer = ak.backend(jets) == "typetracer"
+
+    def flat_numpy(x):
+        return ak.to_numpy(ak.flatten(ak.typetracer.length_zero_if_typetracer(x)))
+
+    counts = ak.num(ak.typetracer.length_zero_if_typetracer(jets.pt), axis=1)
+    flavour = flat_numpy(jets.hadronFlavour)
+    abseta = np.abs(flat_numpy(jets.eta))
+    pt = flat_numpy(jets.pt)
+    tagged = flat_numpy(jets[btagger]) > b_taggers[year]["AK4"][btagger][wp]
+    eff = flat_numpy(eff)
+
+    cset = get_pog_cset("btagging", year)
+    sys_name = get_btag_sys_name(btagger)
+    light = flavour == 0
+
+    out = {}
+    for syst in btag_sf_systematics:
+        sf = np.ones(len(pt))
+        if np.any(light):
+            sf[light] = cset[f"{sys_name}_light"].evaluate(syst, wp, flavour[light], abseta[light], pt[light])
+        if np.any(~light):
+            sf[~light] = cset[f"{sys_name}_comb"].evaluate(syst, wp, flavour[~light], abseta[~light], pt[~light])
+
+        # per-jet factor of the fixed WP method
+        factor = np.where(tagged, sf, (1 - sf * eff) / (1 - eff))
+        for group, group_flavour in btag_flavour_groups.items():
+            group_factor = ak.unflatten(np.where(flavour == group_flavour, factor, 1.0), counts)
+            out[f"{group}_{syst}"] = ak.prod(group_factor, axis=1)
+
+    out = ak.zip(out, depth_limit=1)
+    if typetracer:
+        out = ak.Array(out.layout.to_typetracer(forget_length=True))
+    return out
+
+
+def get_btag_weights(jets: JetArray, btagger: str, wp: str, year: str) -> dict:
+    """
+    Per-event b-tag weights for every flavour group and SF systematic, as {"{group}_{syst}": weight}.
+    All systematics are evaluated in a single pass over the flattened jets.
+    """
+    lookup_dict = get_registered(("btag_eff", year, btagger), lambda: load_btag_eff(btagger, year))
 
     eff_opt = "TTbar+QCD"  
         #options = "TTbar+QCD", "TTbar", "QCD"
         #defined in src/hbb/data/btag/compile_btag_eff.py
 
-    def eff_lookup(x, y, z): return lookup_dict[eff_opt](x, y, z)
+    jets = jets[abs(jets.eta) < 2.5]
+    eff = lookup_dict[eff_opt](jets.hadronFlavour, jets.pt, abs(jets.eta))
 
-    jets_l = jets[(jets.hadronFlavour == 0) & (abs(jets.eta)<2.5)]
-    jets_b = jets[(jets.hadronFlavour == 4) & (abs(jets.eta)<2.5)]
-    jets_c = jets[(jets.hadronFlavour == 5) & (abs(jets.eta)<2.5)]
+    kwargs = {"btagger": btagger, "wp": wp, "year": year}
+    if isinstance(jets, dak.Array):
+        out = dak.map_partitions(_btag_weights_kernel, jets, eff, label="btag-weights", **kwargs)
+    else:
+        out = _btag_weights_kernel(jets, eff, **kwargs)
 
-    pass_l = getattr(jets_l, btagger) > btag_cut
-    pass_b = getattr(jets_b, btagger) > btag_cut
-    pass_c = getattr(jets_c, btagger) > btag_cut
+    return {
+        f"{group}_{syst}": out[f"{group}_{syst}"]
+        for group in btag_flavour_groups
+        for syst in btag_sf_systematics
+    }
 
-    eff_l = eff_lookup(jets_l.hadronFlavour, jets_l.pt, abs(jets_l.eta))
-    eff_b = eff_lookup(jets_b.hadronFlavour, jets_b.pt, abs(jets_b.eta))
-    eff_c = eff_lookup(jets_c.hadronFlavour, jets_c.pt, abs(jets_c.eta))
 
-    def calc_weight(eff, sf, pass_tag):
-        tagged = ak.prod(sf[pass_tag], axis=-1)
-        untagged = ak.prod(((1 - sf*eff) / (1 - eff))[~pass_tag], axis=-1)
-        return ak.fill_none(tagged * untagged, 1.)
-    
-    def get_sf(jets, j_flav, syst):
-        j, nj = ak.flatten(jets), ak.num(jets)
-        sf = cset[f"{sys_name}_{j_flav}"].evaluate(syst, wp, j.hadronFlavour, abs(j.eta), j.pt)
-        return ak.unflatten(sf, nj)
+def add_btag_weights(
+    weights: Weights, jets: JetArray, btagger: str, wp: str, year: str, alt_str: str, btag_weights: dict = None
+):
+    """
+    Apply btag event scale factor for AK4 jets queried
+    Using BTV fixed WP recommendations
+    https://btv-wiki.docs.cern.ch/PerformanceCalibration/fixedWPSFRecommendations/
+    btag_weights can be passed from get_btag_weights, to reuse them for several regions with the same jets
+    """
+    if btag_weights is None:
+        btag_weights = get_btag_weights(jets, btagger, wp, year)
 
-    weight_l = calc_weight( eff_l, get_sf(jets_l, "light", "central"), pass_l )
-    weight_b = calc_weight( eff_b, get_sf(jets_b, "comb", "central"), pass_b )
-    weight_c = calc_weight( eff_c, get_sf(jets_c, "comb", "central"), pass_c )
+    weight_l = btag_weights["light_central"]
+    weight_b = btag_weights["b_central"]
+    weight_c = btag_weights["c_central"]
 
     weights.add(f'{alt_str}btagLightSF', weight_l)
     weights.add(f'{alt_str}btagBSF', weight_b)
@@ -446,42 +577,20 @@ def add_btag_weights(weights: Weights, jets: JetArray, btagger: str, wp: str, ye
     
     nominal = weight_l * weight_b * weight_c
 
-    weights.add(
-        f"{alt_str}btagSFlight_{year}",
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_l, get_sf(jets_l, "light", "up"), pass_l),
-        weightDown=calc_weight(eff_l, get_sf(jets_l, "light", "down"), pass_l),
-    )
-    weights.add(
-        f"{alt_str}btagSFb_{year}",
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_b, get_sf(jets_b, "comb", "up"), pass_b),
-        weightDown=calc_weight(eff_b, get_sf(jets_b, "comb", "down"), pass_b),
-    )
-    weights.add(
-        f"{alt_str}btagSFc_{year}",
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_c, get_sf(jets_c, "comb", "up"), pass_c),
-        weightDown=calc_weight(eff_c, get_sf(jets_c, "comb", "down"), pass_c),
-    )
-    weights.add(
-        f'{alt_str}btagSFlight_correlated', 
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_l, get_sf(jets_l, "light", "up_correlated"), pass_l),
-        weightDown=calc_weight(eff_l, get_sf(jets_l, "light", "down_correlated"), pass_l),
-    )
-    weights.add(
-        f'{alt_str}btagSFb_correlated', 
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_b, get_sf(jets_b, "comb", "up_correlated"), pass_b),
-        weightDown=calc_weight(eff_b, get_sf(jets_b, "comb", "down_correlated"), pass_b),
-    )
-    weights.add(
-        f'{alt_str}btagSFc_correlated', 
-        ak.ones_like(nominal),
-        weightUp=calc_weight(eff_c, get_sf(jets_c, "comb", "up_correlated"), pass_c),
-        weightDown=calc_weight(eff_c, get_sf(jets_c, "comb", "down_correlated"), pass_c),
-    )
+    for group, name in [("light", f"btagSFlight_{year}"), ("b", f"btagSFb_{year}"), ("c", f"btagSFc_{year}")]:
+        weights.add(
+            f"{alt_str}{name}",
+            ak.ones_like(nominal),
+            weightUp=btag_weights[f"{group}_up"],
+            weightDown=btag_weights[f"{group}_down"],
+        )
+    for group, name in [("light", "btagSFlight_correlated"), ("b", "btagSFb_correlated"), ("c", "btagSFc_correlated")]:
+        weights.add(
+            f"{alt_str}{name}",
+            ak.ones_like(nominal),
+            weightUp=btag_weights[f"{group}_up_correlated"],
+            weightDown=btag_weights[f"{group}_down_correlated"],
+        )
     return nominal
 
 def add_muon_weights(weights: Weights, year: str, muons: MuonArray, pt_type: str, muon_type: str, alt_str: str):
@@ -501,7 +610,7 @@ def add_muon_weights(weights: Weights, year: str, muons: MuonArray, pt_type: str
 
     #TODO add trigger SFs
     
-    cset = correctionlib.CorrectionSet.from_file(get_pog_json("muon", year))
+    cset = get_pog_cset("muon", year)
     m, nm = ak.flatten(muons), ak.num(muons, axis=1)
     
     def get_sf(cset_key, syst):
@@ -536,7 +645,7 @@ def add_photon_weights(weights: Weights, year: str, photons, alt_str: str):
         "2024" : "2024Prompt",
     }
 
-    cset = correctionlib.CorrectionSet.from_file(get_pog_json("photon", year))
+    cset = get_pog_cset("photon", year)
 
     if "2023" in year:   
         #json format is different for 23 and 23BPix
@@ -558,28 +667,72 @@ mupt_variations = {
     "MuonPTRes" : "ptcorr_resol"
 }
 
+def _correct_muons_kernel(muons, runNr, lumiNr, evtNr, year, isRealData):
+    """
+    Per-partition kernel: flatten the muons once and compute the corrected pt with all its
+    variations in a single numpy pass (see hbb.MuonScaRe.muon_scare).
+    The typetracer pass (column optimization) is done on length-zero arrays.
+    """
+    typetracer = ak.backend(muons) == "typetracer"
+
+    def flat_numpy(x):
+        return ak.to_numpy(ak.flatten(ak.typetracer.length_zero_if_typetracer(x)))
+
+    counts = ak.to_numpy(ak.num(ak.typetracer.length_zero_if_typetracer(muons.pt), axis=1))
+    pt = flat_numpy(muons.pt)
+    eta = flat_numpy(muons.eta)
+    phi = flat_numpy(muons.phi)
+    charge = flat_numpy(muons.charge)
+    if isRealData:
+        nL = rndm = None
+    else:
+        nL = flat_numpy(muons.nTrackerLayers)
+        keys = [ak.to_numpy(ak.typetracer.length_zero_if_typetracer(x)) for x in (runNr, lumiNr, evtNr)]
+        rndm = random_utils.uniform(*random_utils.object_keys(*keys, counts), "muon_resolution")
+
+    cset = get_pog_cset("muon_pt", year)
+    corrected = muon_scare(pt, eta, phi, charge, nL, rndm, cset, is_data=isRealData)
+
+    out = ak.zip({key: ak.unflatten(value, counts) for key, value in corrected.items()})
+    if typetracer:
+        out = ak.Array(out.layout.to_typetracer(forget_length=True))
+    return out
+
+
 def correct_muons(muons, events, year: str, isRealData: bool):
     """
     Central corrections maintained by MUON POG
     https://muon-wiki.docs.cern.ch/guidelines/corrections/#medium-pt-scale-and-resolution
     https://gitlab.cern.ch/cms-muonPOG/muonscarekit
     src/hbb/MuonScaRe.py refactored to work with dask+awkward by Lara
+    The nominal corrections and all the variations are computed in a single fused pass.
     """
-    cset = correctionlib.CorrectionSet.from_file(get_pog_json("muon_pt", year))
+    kwargs = {"year": year, "isRealData": isRealData}
+    if isinstance(muons, dak.Array):
+        corrected = dak.map_partitions(
+            _correct_muons_kernel,
+            muons,
+            events.run,
+            events.luminosityBlock,
+            events.event,
+            label="muon-scare",
+            **kwargs,
+        )
+    else:
+        corrected = _correct_muons_kernel(muons, events.run, events.luminosityBlock, events.event, **kwargs)
 
     if isRealData:
-        muons["ptcorr"] = pt_scale(1, muons.pt, muons.eta, muons.phi, muons.charge, cset, nested=True)
+        muons["ptcorr"] = corrected.ptcorr
 
     else:
-        muons["ptscalecorr"] = pt_scale(0, muons.pt, muons.eta,  muons.phi, muons.charge, cset, nested=True)
-        muons["ptcorr"] = pt_resol( muons.ptscalecorr, muons.eta, muons.phi, muons.nTrackerLayers, 
-                                   events.event, events.luminosityBlock, cset, nested=True)
+        muons["ptscalecorr"] = corrected.ptscalecorr
+        muons["ptcorr"] = corrected.ptcorr
 
-        muons["ptscalecorr_up"] = pt_scale_var(muons.ptcorr, muons.eta, muons.phi, muons.charge, "up", cset, nested=True)
-        muons["ptscalecorr_down"] = pt_scale_var(muons.ptcorr, muons.eta, muons.phi, muons.charge, "dn", cset, nested=True)
+        muons["ptscalecorr_up"] = corrected.ptscalecorr_up
+        muons["ptscalecorr_down"] = corrected.ptscalecorr_down
 
-        muons["ptcorr_resol_up"] = pt_resol_var(muons.ptscalecorr, muons.ptcorr, muons.eta, "up", cset, nested=True)
-        muons["ptcorr_resol_down"] = pt_resol_var(muons.ptscalecorr, muons.ptcorr, muons.eta, "dn", cset, nested=True)
+        muons["ptcorr_resol_up"] = corrected.ptcorr_resol_up
+        muons["ptcorr_resol_down"] = corrected.ptcorr_resol_down
 
     return muons
 
@@ -618,8 +771,7 @@ def add_VJets_corrections(weights: Weights, dataset: str, genpart):
         for syst in systlist:
             weights.add(syst, ones, ewkcorr.evaluate(syst + "_up", vpt) / ewknom, ewkcorr.evaluate(syst + "_down", vpt) / ewknom)
 
-    file = f"{package_path}/hbb/data/vjets/vjets_corrections_2flavorDY.json"
-    vjets_kfactors = correctionlib.CorrectionSet.from_file(file)
+    vjets_kfactors = get_local_cset("vjets/vjets_corrections_2flavorDY.json")
 
     if isZ_dataset:
         qcdcorr = vjets_kfactors["Z_MLMtoFXFX"].evaluate(vpt)
@@ -0,0 +1,113 @@
+"""
+Size and timing instrumentation for the dask task graphs built by the processors.
+
+The skims for all shifts and regions produce a very large graph, and building/optimizing it
+can dominate the job time before any data is read. These helpers report the graph size per
+shift and region and enforce a budget so that regressions are caught early.
+"""
+
+from __future__ import annotations
+
+import time
+import warnings
+
+import dask
+from dask.highlevelgraph import HighLevelGraph
+
+
+def _graph(collections):
+    graphs = [c.__dask_graph__() for c in collections]
+    if len(graphs) == 1:
+        return graphs[0]
+    # layers shared between collections (e.g. the input and the common selections) are counted once
+    return HighLevelGraph.merge(*graphs)
+
+
+def graph_size(*collections) -> dict:
+    """
+    Number of tasks (nodes) and layers of the graph needed to compute the given dask collections
+    """
+    hlg = _graph(collections)
+    return {"nodes": len(hlg), "layers": len(hlg.layers)}
+
+
+def time_optimization(*collections) -> tuple[dict, float]:
+    """
+    Run the dask optimizations (for dask-awkward, this includes the column projection)
+    :return: size of the optimized graph and time spent optimizing in seconds
+    """
+    tic = time.time()
+    optimized = dask.optimize(*collections)
+    toc = time.time()
+    return graph_size(*optimized), toc - tic
+
+
+def iter_skim_collections(output: dict):
+    """
+    Iterate over (shift, region, collection) for the output of categorizer.process
+    """
+    for shift, shift_output in output.items():
+        for region, collection in shift_output.get("skim", {}).items():
+            yield shift, region, collection
+
+
+def check_graph_budget(size: dict, max_nodes: int = None, max_layers: int = None, action: str = "warn", name: str = ""):
+    """
+    Compare a graph size with the budget. Warns or raises RuntimeError depending on action.
+    :return: True if the graph is within the budget
+    """
+    over = []
+    if max_nodes is not None and size["nodes"] > max_nodes:
+        over.append(f"{size['nodes']} nodes > {max_nodes}")
+    if max_layers is not None and size["layers"] > max_layers:
+        over.append(f"{size['layers']} layers > {max_layers}")
+
+    if not over:
+        return True
+
+    msg = f"Task graph {name} is over budget: {', '.join(over)}"
+    if action == "error":
+        raise RuntimeError(msg)
+    warnings.warn(msg, stacklevel=2)
+    return False
+
+
+def graph_report(output: dict, optimize: bool = True) -> list[dict]:
+    """
+    Build a per shift and region report of the graph sizes and optimization times.
+    Construction times are taken from the "graphtime" entry filled by the processor, if present:
+    "construction" is the time spent on the region itself (its skim and cutflow), and
+    "shift_construction" the time of the whole shift, including the selections and columns shared by its regions.
+    """
+    rows = []
+    for shift, region, collection in iter_skim_collections(output):
+        row = {"shift": shift, "region": region, **graph_size(collection)}
+        graphtime = output[shift].get("graphtime", {})
+        row["construction"] = graphtime.get(region)
+        row["shift_construction"] = graphtime.get("total")
+        if optimize:
+            opt_size, opt_time = time_optimization(collection)
+            row["optimized_nodes"] = opt_size["nodes"]
+            row["optimized_layers"] = opt_size["layers"]
+            row["optimization"] = opt_time
+        rows.append(row)
+    return rows
+
+
+def print_graph_report(rows: list[dict]):
+    """Print the rows of graph_report as a table"""
+
+    def fmt(x, spec):
+        return format(x, spec) if x is not None else "-"
+
+    print(
+        f"{'shift':<18} {'region':<22} {'nodes':>8} {'layers':>7} {'opt nodes':>10} "
+        f"{'opt layers':>10} {'build [s]':>10} {'shift build [s]':>16} {'opt [s]':>8}"
+    )
+    for row in rows:
+        print(
+            f"{row['shift']:<18} {row['region']:<22} {row['nodes']:>8} {row['layers']:>7} "
+            f"{fmt(row.get('optimized_nodes'), 'd'):>10} {fmt(row.get('optimized_layers'), 'd'):>10} "
+            f"{fmt(row.get('construction'), '.2f'):>10} {fmt(row.get('shift_construction'), '.2f'):>16} "
+            f"{fmt(row.get('optimization'), '.2f'):>8}"
+        )
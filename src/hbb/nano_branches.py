@@ -0,0 +1,184 @@
+"""
+NanoAOD branches read by the categorizer processor.
+
+The manifest is used to check that the dask-awkward column optimization only reads the
+branches declared here, since reading fewer baskets over XRootD is the main lever on job time.
+"""
+
+from __future__ import annotations
+
+import warnings
+
+# fields read from each collection, including those needed by coffea behaviors
+# (4-vectors, matched_gen, children) and by the jet id / JERC corrections
+nano_collections = {
+    "FatJet": [
+        "pt",
+        "eta",
+        "phi",
+        "mass",
+        "msoftdrop",
+        "rawFactor",
+        "area",
+        "jetId",
+        "n2b1",
+        "n3b1",
+        "genJetAK8Idx",
+        "chHEF",
+        "neHEF",
+        "chEmEF",
+        "neEmEF",
+        "muEF",
+        "chMultiplicity",
+        "neMultiplicity",
+        "particleNet_massCorr",
+        "particleNet_QCD",
+        "particleNet_XbbVsQCD",
+        "particleNet_XccVsQCD",
+        "particleNet_XqqVsQCD",
+        "particleNet_XggVsQCD",
+        "globalParT3_QCD",
+        "globalParT3_Xbb",
+        "globalParT3_Xcc",
+        "globalParT3_Xcs",
+        "globalParT3_Xqq",
+        "globalParT3_TopbWq",
+        "globalParT3_TopbWqq",
+        "globalParT3_massCorrGeneric",
+        "globalParT3_massCorrX2p",
+    ],
+    "Jet": [
+        "pt",
+        "eta",
+        "phi",
+        "mass",
+        "rawFactor",
+        "area",
+        "jetId",
+        "genJetIdx",
+        "hadronFlavour",
+        "chHEF",
+        "neHEF",
+        "chEmEF",
+        "neEmEF",
+        "muEF",
+        "chMultiplicity",
+        "neMultiplicity",
+        "btagPNetB",
+        "btagPNetCvB",
+        "btagPNetCvL",
+        "btagPNetQvG",
+        "btagUParTAK4B",
+    ],
+    "Muon": [
+        "pt",
+        "eta",
+        "phi",
+        "mass",
+        "charge",
+        "nTrackerLayers",
+        "looseId",
+        "highPtId",
+        "isGlobal",
+        "pfRelIso04_all",
+        "dxy",
+        "dz",
+    ],
+    "Electron": ["pt", "eta", "phi", "mass", "pfRelIso03_all", "mvaNoIso_WP90", "dxy", "dz"],
+    "Photon": ["pt", "eta", "phi", "mass", "isScEtaEB", "isScEtaEE", "mvaID_WP80", "cutBased"],
+    "PuppiMET": ["pt", "phi", "ptUnclusteredUp", "phiUnclusteredUp"],
+}
+
+# collections only present (and read) in MC
+nano_collections_mc = {
+    "GenPart": ["pt", "eta", "phi", "mass", "pdgId", "status", "statusFlags", "genPartIdxMother"],
+    "GenJet": ["pt", "eta", "phi", "mass"],
+    "GenJetAK8": ["pt", "eta", "phi", "mass"],
+}
+
+# flat event-level branches
+event_branches = ["run", "luminosityBlock", "event", "Rho_fixedGridRhoFastjetAll"]
+event_branches_mc = [
+    "genWeight",
+    "Pileup_nTrueInt",
+    "nPSWeight",
+    "PSWeight",
+    "nLHEPdfWeight",
+    "LHEPdfWeight",
+    "nLHEScaleWeight",
+    "LHEScaleWeight",
+]
+
+
+def get_branch_manifest(triggers: list[str], met_filters: list[str], isRealData: bool = False) -> set[str]:
+    """
+    Full set of TTree branches the processor is allowed to read.
+    :param triggers: HLT paths (without the HLT_ prefix) used by any selection or saved in the skim
+    :param met_filters: Flag names (without the Flag_ prefix) used in the MET filter selection
+    :param isRealData: if False, include generator-level branches
+    """
+    collections = dict(nano_collections)
+    branches = set(event_branches)
+    if not isRealData:
+        collections.update(nano_collections_mc)
+        branches.update(event_branches_mc)
+
+    for collection, fields in collections.items():
+        if collection != "PuppiMET":
+            branches.add(f"n{collection}")
+        branches.update(f"{collection}_{field}" for field in fields)
+
+    branches.update(f"HLT_{t}" for t in triggers)
+    branches.update(f"Flag_{f}" for f in met_filters)
+    return branches
+
+
+def check_necessary_columns(necessary_columns: dict, manifest: set[str], strict: bool = False) -> set[str]:
+    """
+    Compare the columns found by dask_awkward.report_necessary_columns with the manifest.
+    Returns the set of branches read that are not declared; warns (or raises if strict) if any.
+    """
+    unexpected = set()
+    for columns in necessary_columns.values():
+        if columns is None:
+            continue
+        unexpected.update(set(columns) - manifest)
+
+    if unexpected:
+        msg = (
+            f"{len(unexpected)} branches read but not declared in the branch manifest: "
+            f"{sorted(unexpected)}"
+        )
+        if strict:
+            raise ValueError(msg)
+        warnings.warn(msg, stacklevel=2)
+
+    return unexpected
+
+
+def summarize_read_report(report) -> dict:
+    """
+    Summarize the uproot read report returned by apply_to_fileset(..., allow_read_errors_with_report)
+    :return: dictionary {dataset: {"chunks", "failed", "bytes", "bytes_per_chunk", "requests"}}
+    """
+    summary = {}
+    for dataset, rep in report.items():
+        n_chunks, n_failed, n_bytes, n_requests = 0, 0, 0, 0
+        for chunk in rep.tolist():
+            n_chunks += 1
+            counters = chunk.get("performance_counters")
+            if chunk.get("exception") is not None or counters is None:
+                n_failed += 1
+                continue
+            n_bytes += counters["num_requested_bytes"]
+            n_requests += counters["num_requests"]
+
+        n_ok = n_chunks - n_failed
+        summary[dataset] = {
+            "chunks": n_chunks,
+            "failed": n_failed,
+            "bytes": n_bytes,
+            "bytes_per_chunk": n_bytes / n_ok if n_ok else 0,
+            "requests": n_requests,
+        }
+    return summary
@@ -0,0 +1,126 @@
+"""
+Declarative export of the selected objects as flat, fixed-width columns.
+
+Each entry of the export spec gives the collection, the number of slots (and their names),
+the fields as {column suffix: field} and the value of empty slots. The columns of each entry
+are built in one kernel per chunk (see hbb.ranking_utils.slot_columns) and are used both for
+the skims and for the BDT inputs, e.g. the "Jet" entry gives Jet0_pt, ..., Jet3_btagPNetB.
+An entry can also rename columns, to keep the names of the existing skims and BDT trainings.
+"""
+
+from __future__ import annotations
+
+from hbb.ranking_utils import slot_columns
+
+ak4_export_fields = ["pt", "eta", "phi", "mass", "btagPNetB", "btagPNetCvB", "btagPNetCvL", "btagPNetQvG"]
+
+# the last three scores of the fourth AK4 jet are stored (and used by the BDT) as Jet4_*
+jet3_stored_names = {f"Jet3_{field}": f"Jet4_{field}" for field in ["btagPNetCvB", "btagPNetCvL", "btagPNetQvG"]}
+
+fatjet_export_fields = {
+    "pt": "pt",
+    "phi": "phi",
+    "eta": "eta",
+    "msd": "msd",
+    "msd_rho": "qcdrho",
+    "n2b1": "n2b1",
+    "n3b1": "n3b1",
+    "pnetMass": "pnetmass",
+    "pnetTXbb": "particleNet_XbbVsQCD",
+    "pnetTXcc": "particleNet_XccVsQCD",
+    "pnetTXqq": "particleNet_XqqVsQCD",
+    "pnetTXgg": "particleNet_XggVsQCD",
+    "pnetTQCD": "particleNet_QCD",
+    "pnetXbbXcc": "pnetXbbXcc",
+}
+
+# only stored for the candidate jet
+fatjet0_only_fields = ["n2b1", "n3b1", "pnetTQCD", "pnetXbbXcc"]
+
+# GloParTv3 scores, not in v12
+fatjet_parT_export_fields = [
+    "ParTPQCD",
+    "ParTPXbb",
+    "ParTPXcc",
+    "ParTPXqq",
+    "ParTPXcs",
+    "ParTPXbbVsQCD",
+    "ParTPXccVsQCD",
+    "ParTPXbbXcc",
+    "ParTPTopbWq",
+    "ParTPTopbWqq",
+    "ParTmassGeneric",
+    "ParTmassX2p",
+    "ParTmassGeneric_rho",
+    "ParTmassX2p_rho",
+]
+
+
+def get_export_spec(nano_version: str) -> dict:
+    """
+    Export spec as {entry: {"collection", "prefix", "slots", "start", "fields", "fill_value", "rename"}}.
+    The collection is the key of the (jagged) collection passed to export_objects, and rename
+    (optional) gives the stored names of columns as {column: name}.
+    """
+    parT = {} if "v12" in nano_version else {field: field for field in fatjet_parT_export_fields}
+    return {
+        "FatJet0": {
+            "collection": "candidatejets",
+            "prefix": "FatJet",
+            "slots": 1,
+            "start": 0,
+            "fields": {**fatjet_export_fields, **parT},
+            "fill_value": None,
+        },
+        "FatJet1": {
+            "collection": "subleadingjets",
+            "prefix": "FatJet",
+            "slots": 1,
+            "start": 1,
+            "fields": {
+                **{key: field for key, field in fatjet_export_fields.items() if key not in fatjet0_only_fields},
+                **parT,
+            },
+            "fill_value": None,
+        },
+        # AK4 jets away from FatJet0, leading in pt
+        "Jet": {
+            "collection": "ak4_outside_ak8",
+            "prefix": "Jet",
+            "slots": 4,
+            "start": 0,
+            "fields": ak4_export_fields,
+            "fill_value": None,
+            "rename": jet3_stored_names,
+        },
+        # AK4 jet away but closest to FatJet0
+        "JetClosestFatJet0": {
+            "collection": "ak4_closest_ak8",
+            "prefix": "JetClosestFatJet",
+            "slots": 1,
+            "start": 0,
+            "fields": ["pt", "eta", "phi", "mass"],
+            "fill_value": None,
+        },
+    }
+
+
+def slot_names(entry: dict) -> list[str]:
+    start = entry.get("start", 0)
+    return [f"{entry['prefix']}{start + i}" for i in range(entry["slots"])]
+
+
+def export_objects(collections: dict, spec: dict) -> dict:
+    """
+    Flat columns of every entry of the spec
+    :param collections: {collection name: jagged collection}
+    :return: {entry: {column: array}}
+    """
+    exports = {}
+    for name, entry in spec.items():
+        columns = slot_columns(
+            collections[entry["collection"]], entry["fields"], slot_names(entry), entry.get("fill_value")
+        )
+        rename = entry.get("rename", {})
+        exports[name] = {rename.get(column, column): array for column, array in columns.items()}
+    return exports
@@ -0,0 +1,112 @@
+"""
+Streaming compaction of the skim parquet files.
+
+dak.to_parquet writes one file per partition, and the job then combines the files of each
+region into a single parquet file. The fragments are read batch by batch and written with a
+pyarrow ParquetWriter in row groups of a target size, so the memory use does not depend on the
+number of events (unlike reading the whole region into a pandas DataFrame).
+"""
+
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def _natural_key(path: Path):
+    # part2.parquet before part10.parquet
+    return [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", path.name)]
+
+
+def parquet_fragments(folder) -> list[Path]:
+    """Parquet files in a folder, in natural order"""
+    return sorted(Path(folder).glob("*.parquet"), key=_natural_key)
+
+
+def flag_columns(schema: pa.Schema) -> list[str]:
+    """Boolean and integer columns (region flags, counts, flavours), which benefit from dictionary encoding"""
+    return [
+        field.name
+        for field in schema
+        if pa.types.is_boolean(field.type) or pa.types.is_integer(field.type)
+    ]
+
+
+def _dictionary_columns(schema: pa.Schema, dictionary: str):
+    if dictionary == "all":
+        return True
+    if dictionary == "none":
+        return False
+    if dictionary == "flags":
+        # parquet has no dictionary encoding for booleans (they are bit-packed)
+        return [name for name in flag_columns(schema) if not pa.types.is_boolean(schema.field(name).type)]
+    raise ValueError(f"Invalid dictionary option {dictionary}, must be 'flags', 'all' or 'none'")
+
+
+def compact_parquet(
+    folder,
+    output_file,
+    compression: str = "zstd",
+    compression_level: int = None,
+    row_group_size: int = 128 * 1024,
+    dictionary: str = "flags",
+) -> int:
+    """
+    Concatenate the parquet fragments in folder into output_file, with constant memory use
+    :param compression: parquet compression codec ("zstd", "snappy", "lz4", "gzip" or "none")
+    :param row_group_size: target number of rows per row group
+    :param dictionary: dictionary encode the "flags" (integer) columns, "all" columns or "none"
+    :return: number of rows written
+    """
+    fragments = parquet_fragments(folder)
+    if not fragments:
+        raise FileNotFoundError(f"No parquet files in {folder}")
+
+    # fragments with no selected events may have less specific (e.g. null) types
+    schema = pa.unify_schemas([pq.read_schema(fragment) for fragment in fragments], promote_options="permissive")
+    schema = schema.remove_metadata()
+
+    n_rows = 0
+    buffer, n_buffer = [], 0
+
+    with pq.ParquetWriter(
+        output_file,
+        schema,
+        compression=compression,
+        compression_level=compression_level,
+        use_dictionary=_dictionary_columns(schema, dictionary),
+    ) as writer:
+        for fragment in fragments:
+            for batch in pq.ParquetFile(fragment).iter_batches(batch_size=row_group_size):
+                if batch.num_rows == 0:
+                    continue
+                buffer.append(_conform(pa.Table.from_batches([batch]), schema))
+                n_buffer += batch.num_rows
+                # write full row groups, keeping at most one row group (plus a batch) in memory
+                while n_buffer >= row_group_size:
+                    table = pa.concat_tables(buffer)
+                    writer.write_table(table.slice(0, row_group_size), row_group_size=row_group_size)
+                    n_rows += row_group_size
+                    rest = table.slice(row_group_size)
+                    buffer, n_buffer = [rest], len(rest)
+
+        if n_buffer or n_rows == 0:
+            table = pa.concat_tables(buffer) if buffer else schema.empty_table()
+            writer.write_table(table, row_group_size=row_group_size)
+            n_rows += len(table)
+
+    return n_rows
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Cast a table to the schema, adding missing columns as nulls"""
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table[field.name].cast(field.type))
+        else:
+            columns.append(pa.nulls(len(table), type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
@@ -0,0 +1,156 @@
+"""
+Persistent cache of the coffea preprocessing (step boundaries, number of entries, uuid and forms).
+
+coffea's preprocess opens every file (over XRootD) to compute the steps, and every condor job
+repeats this for its slice of files. The cache stores the preprocessed entry of each file, keyed by
+its path and the step configuration, in a json file (optionally .gz) that can be local or on EOS
+(any fsspec url, e.g. root://cmseos.fnal.gov//store/...). Only files missing from the cache are
+preprocessed. NanoAOD files are not modified in place, so by default the path identifies the file;
+with validate="stat", the size and modification time of the files are also checked (a stat is much
+cheaper than opening the file).
+"""
+
+from __future__ import annotations
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+from coffea.dataset_tools import preprocess
+
+CACHE_VERSION = 1
+
+
+def stat_file(fname: str) -> dict:
+    """Size and modification time of a local or remote file"""
+    fs, path = fsspec.core.url_to_fs(fname)
+    info = fs.info(path)
+    return {"size": info.get("size"), "mtime": info.get("mtime")}
+
+
+def stat_files(fnames: list, n_threads: int = 16) -> dict:
+    """{fname: stat} of the files, None for the files that cannot be accessed"""
+
+    def safe_stat(fname):
+        try:
+            return stat_file(fname)
+        except (OSError, FileNotFoundError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return dict(zip(fnames, pool.map(safe_stat, fnames)))
+
+
+class PreprocessCache:
+    """
+    Preprocessed file entries for one step configuration
+    :param path: local path or fsspec url of the json cache
+    :param validate: "none" (cache keyed by path) or "stat" (also check size and mtime)
+    """
+
+    def __init__(self, path: str, step_size: int, align_clusters: bool, validate: str = "none"):
+        if validate not in ("none", "stat"):
+            raise ValueError(f"Invalid validation {validate}, must be 'none' or 'stat'")
+        self.path = path
+        self.config = f"step{step_size}_align{int(align_clusters)}"
+        self.validate = validate
+        self.files = {}
+        self.forms = {}
+        self._content = {"version": CACHE_VERSION, "steps": {}, "forms": {}}
+        self.load()
+
+    def load(self):
+        fs, path = fsspec.core.url_to_fs(self.path)
+        if not fs.exists(path):
+            return
+        with fsspec.open(self.path, "rt", compression="infer") as f:
+            content = json.load(f)
+        if content.get("version") != CACHE_VERSION:
+            print(f"Ignoring preprocess cache {self.path} with version {content.get('version')}")
+            return
+        self._content = content
+        self.files = content["steps"].setdefault(self.config, {})
+        self.forms = content["forms"]
+
+    def save(self):
+        self._content["steps"][self.config] = self.files
+        self._content["forms"] = self.forms
+        with fsspec.open(self.path, "wt", compression="infer") as f:
+            json.dump(self._content, f)
+
+    def lookup(self, files: dict) -> tuple[dict, list]:
+        """
+        Split the files of a dataset into cached and missing ones
+        :param files: {fname: object path}
+        :return: ({fname: preprocessed entry}, [missing fnames])
+        """
+        stats = stat_files([f for f in files if f in self.files]) if self.validate == "stat" else {}
+        cached, missing = {}, []
+        for fname, object_path in files.items():
+            entry = self.files.get(fname)
+            valid = entry is not None and entry["object_path"] == object_path
+            if valid and self.validate == "stat":
+                stat = stats[fname]
+                valid = stat is not None and all(entry.get(key) == stat[key] for key in ("size", "mtime"))
+            if valid:
+                cached[fname] = {key: entry[key] for key in ("object_path", "steps", "num_entries", "uuid")}
+            else:
+                missing.append(fname)
+        return cached, missing
+
+    def update(self, preprocessed: dict):
+        """Add the files (with steps) and forms of the preprocessed datasets"""
+        for dataset, dataset_spec in preprocessed.items():
+            files = {fname: entry for fname, entry in dataset_spec["files"].items() if entry.get("steps")}
+            stats = stat_files(list(files)) if self.validate == "stat" else {}
+            for fname, entry in files.items():
+                stat = stats.get(fname) or {"size": None, "mtime": None}
+                self.files[fname] = {**entry, **stat}
+            if dataset_spec.get("form") is not None:
+                self.forms[dataset] = dataset_spec["form"]
+
+
+def cached_preprocess(fileset: dict, cache: PreprocessCache, update: bool = True, **kwargs) -> tuple[dict, dict]:
+    """
+    coffea preprocess, only for the files missing from the cache
+    :param fileset: dataset spec, as from run_utils.get_dataset_spec
+    :param update: add the newly preprocessed files to the cache and save it
+    :param kwargs: passed to preprocess
+    :return: (available, total) as from preprocess
+    """
+    cached, missing = {}, {}
+    for dataset, dataset_spec in fileset.items():
+        cached[dataset], missing_files = cache.lookup(dataset_spec["files"])
+        if missing_files:
+            missing[dataset] = {
+                **dataset_spec,
+                "files": {fname: dataset_spec["files"][fname] for fname in missing_files},
+            }
+
+    n_cached = sum(len(files) for files in cached.values())
+    n_missing = sum(len(spec["files"]) for spec in missing.values())
+    print(f"Preprocess cache: {n_cached} files cached, {n_missing} to preprocess")
+
+    new_available, new_total = preprocess(missing, **kwargs) if missing else ({}, {})
+
+    available, total = {}, {}
+    for dataset, dataset_spec in fileset.items():
+        new_avail = new_available.get(dataset, {})
+        form = new_avail.get("form") or cache.forms.get(dataset)
+        available[dataset] = {
+            "files": {**cached[dataset], **new_avail.get("files", {})},
+            "metadata": dataset_spec.get("metadata"),
+            "form": form,
+        }
+        total[dataset] = {
+            "files": {**cached[dataset], **new_total.get(dataset, {}).get("files", {})},
+            "metadata": dataset_spec.get("metadata"),
+            "form": form,
+        }
+
+    if update and new_available:
+        cache.update(new_available)
+        cache.save()
+        print(f"Saved preprocess cache to {cache.path}")
+
+    return available, total
@@ -1,20 +1,23 @@
 from __future__ import annotations
 
+import copy
+import functools
 import json
 import logging
+import operator
 import time
 from pathlib import Path
 
 import awkward as ak
 import dask_awkward as dak
 import numpy as np
-import xgboost as xgb
 from coffea.analysis_tools import PackedSelection, Weights
-from coffea.ml_tools import xgboost_wrapper
 from hist.dask import Hist
 
+from hbb.bdt_inference import BDTModel
 from hbb.corrections import (
     add_btag_weights,
+    get_btag_weights,
     add_muon_weights,
     add_pdf_weight,
     add_photon_weights,
@@ -27,12 +30,20 @@ from hbb.corrections import (
     correct_met,
     correct_muons,
     get_jetveto_event,
+    get_jetveto_jets,
     lumiMasks,
     mupt_variations,
 )
 from hbb.jerc_eras import jerc_variations, run_map
+from hbb.nano_branches import get_branch_manifest
+from hbb.object_export import export_objects, get_export_spec
+from hbb.ranking_utils import argbest, best, pad_slots
 from hbb.processors.SkimmerABC import SkimmerABC
+from hbb.skim_schema import apply_dtype_policy, get_dtype_policy
 from hbb.taggers import b_taggers
+from hbb.trigger_utils import PathEvaluator
+from hbb.utils import WEIGHT_FACTOR_PREFIX, WEIGHT_NORM_COLUMN, region_flag, skim_group
+from hbb.weight_utils import weight_products
 
 from .GenSelection import (
     bosonFlavor,
@@ -42,6 +53,9 @@ from .GenSelection import (
     getBosons,
 )
 from .objects import (
+    JetVariations,
+    ak4jet_id_masks,
+    ak8jet_id_mask,
     good_ak4jets,
     good_ak8jets,
     good_electrons,
@@ -64,6 +78,15 @@ def update(events, collections):
     return out
 
 
+def copy_weights(weights: Weights) -> Weights:
+    """Return a copy of a Weights object that can be extended without modifying the original"""
+    out = copy.copy(weights)
+    for attr, value in vars(weights).items():
+        if isinstance(value, (dict, list)):
+            setattr(out, attr, copy.copy(value))
+    return out
+
+
 # mapping samples to the appropriate function for doing gen-level selections
 gen_selection_dict = {
     "Hto2B": gen_selection_Hbb,
@@ -73,85 +96,6 @@ gen_selection_dict = {
 }
 
 
-def get_BDT_model(BDT_file: str):
-    bdt_features = [
-        "nFatJet",
-        "nJet",
-        "FatJet0_phi",
-        "FatJet0_eta",
-        "FatJet0_n2b1",
-        "FatJet0_n3b1",
-        "FatJet1_pt",
-        "FatJet1_phi",
-        "FatJet1_eta",
-        "FatJet1_msd",
-        "VBFPair_mjj",
-        "VBFPair_deta",
-        "FatJet1_ParTPQCD",
-        "FatJet1_ParTPXbb",
-        "FatJet1_ParTPXcc",
-        "FatJet1_ParTPXqq",
-        "FatJet1_ParTPXcs",
-        "FatJet1_ParTPXbbVsQCD",
-        "FatJet1_ParTPXccVsQCD",
-        "FatJet1_ParTPXbbXcc",
-        "FatJet1_ParTmassX2p",
-        "Jet0_pt",
-        "Jet0_eta",
-        "Jet0_phi",
-        "Jet0_mass",
-        "Jet0_btagPNetB",
-        "Jet0_btagPNetCvB",
-        "Jet0_btagPNetCvL",
-        "Jet0_btagPNetQvG",
-        "Jet1_pt",
-        "Jet1_eta",
-        "Jet1_phi",
-        "Jet1_mass",
-        "Jet1_btagPNetB",
-        "Jet1_btagPNetCvB",
-        "Jet1_btagPNetCvL",
-        "Jet1_btagPNetQvG",
-        "Jet2_pt",
-        "Jet2_eta",
-        "Jet2_phi",
-        "Jet2_mass",
-        "Jet2_btagPNetB",
-        "Jet2_btagPNetCvB",
-        "Jet2_btagPNetCvL",
-        "Jet2_btagPNetQvG",
-        "Jet3_pt",
-        "Jet3_eta",
-        "Jet3_phi",
-        "Jet3_mass",
-        "Jet3_btagPNetB",
-        "Jet4_btagPNetCvB",
-        "Jet4_btagPNetCvL",
-        "Jet4_btagPNetQvG",
-        "JetClosestFatJet0_pt",
-        "JetClosestFatJet0_eta",
-        "JetClosestFatJet0_phi",
-        "JetClosestFatJet0_mass",
-    ]
-
-    class xgboost_model(xgboost_wrapper):
-        # Define how to prepare awkward arrays for BDT evaluation
-        def prepare_awkward(self, events):
-            features = []
-            for name in bdt_features:
-                feat = events[name]
-                feat = ak.fill_none(feat, -999.0)
-                features.append(feat[:, np.newaxis])
-            ret = ak.concatenate(features, axis=1)
-            return [], dict(data=ret)
-
-    booster = xgb.Booster()
-    booster.load_model(Path.cwd() / BDT_file)
-    booster.feature_names = None  # Disable feature name checking
-    model = xgboost_model(booster)
-    return model
-
-
 class categorizer(SkimmerABC):
     def __init__(
         self,
@@ -164,6 +108,10 @@ class categorizer(SkimmerABC):
         evaluate_BDT=True,
         btag_eff=False,
         save_skim_nosysts=False,
+        skim_region_flags=False,
+        weight_format="full",
+        skim_dtypes="native",
+        pdf_dtype="float32",
     ):
         super().__init__()
 
@@ -177,6 +125,14 @@ class categorizer(SkimmerABC):
         if self._skip_syst:
             self._save_skim = True
         self._skim_outpath = skim_outpath
+        # write each shift once per skim group, with the regions as boolean columns
+        self._skim_region_flags = skim_region_flags
+        # "full": every systematic weight as a column, "factors": individual weight factors only
+        if weight_format not in ("full", "factors"):
+            raise ValueError(f"Invalid weight format {weight_format}, must be 'full' or 'factors'")
+        self._weight_format = weight_format
+        # stored column types, see hbb.skim_schema
+        self._dtype_policy = get_dtype_policy(skim_dtypes, pdf_dtype=pdf_dtype)
         self._evaluate_BDT = evaluate_BDT
         self._btag_eff = btag_eff
         self._btagger, self._btag_wp = "btagPNetB", "M"
@@ -184,8 +140,10 @@ class categorizer(SkimmerABC):
             self._btagger = "btagUParTAK4B"
         self._btag_cut = b_taggers[self._year]["AK4"][self._btagger][self._btag_wp]
         self._mupt_type = "ptcorr"
+        self._export_spec = get_export_spec(nano_version)
         if self._evaluate_BDT:
-            self.bdt_model = get_BDT_model("src/hbb/data/MultiBDT_3cat_26Jun12.json")
+            # the booster itself is loaded (once per worker process) on first evaluation
+            self.bdt_model = BDTModel("src/hbb/data/MultiBDT_3cat_26Jun12.json")
 
         with Path("src/hbb/muon_triggers.json").open() as f:
             self._muontriggers = json.load(f)
@@ -200,6 +158,20 @@ class categorizer(SkimmerABC):
         with Path("src/hbb/metfilters.json").open() as f:
             self._met_filters = json.load(f)
 
+        # all trigger groups are evaluated from a single stacked read of the HLT branches
+        self._trigger_evaluator = PathEvaluator(
+            {
+                "trigger": self._triggers[self._year],
+                "muontrigger": self._muontriggers[self._year],
+                "egammatrigger": self._egammatriggers[self._year],
+            },
+            mode="or",
+        )
+        self._metfilter_evaluator = {
+            key: PathEvaluator({"metfilter": self._met_filters[self._year][key]}, mode="and")
+            for key in ("data", "mc")
+        }
+
         self.make_output = lambda: {
             "sumw": {},
             "sumw_pdf": {},
@@ -211,6 +183,8 @@ class categorizer(SkimmerABC):
             .Weight(),
             "btagWeight": Hist.new.Reg(50, 0, 3, name="val", label="BTag correction").Weight(),
             "skim": {},
+            # time (s) spent building the graph of each skim, see hbb.graph_utils
+            "graphtime": {},
         }
 
         # btag efficiency plots - binning according to:
@@ -224,6 +198,18 @@ class categorizer(SkimmerABC):
             .Weight()
         )
 
+    def branch_manifest(self, isRealData=False) -> set:
+        """
+        NanoAOD branches this processor is expected to read for the configured year
+        """
+        triggers = (
+            self._triggers[self._year]
+            + self._muontriggers[self._year]
+            + self._egammatriggers[self._year]
+        )
+        met_filters = self._met_filters[self._year]["data" if isRealData else "mc"]
+        return get_branch_manifest(triggers, met_filters, isRealData)
+
     def process(self, events):
 
         # process only nominal case
@@ -243,9 +229,11 @@ class categorizer(SkimmerABC):
 
         """
         run processor for each shift defined in total_variations
+        shift-independent quantities are computed once and shared between shifts
         return output as dict {variation: output}
         """
-        return {var: self.process_shift(events, var) for var in total_variations}
+        common = self.process_common(events)
+        return {var: self.process_shift(events, var, common=common) for var in total_variations}
 
     def add_common_weights(self, weights, events, dataset):
         """
@@ -266,11 +254,21 @@ class categorizer(SkimmerABC):
         return
 
     def add_region_weights(
-        self, region, weights, events, btag_jets=None, muons=None, muon_type="", photons=None
+        self,
+        region,
+        weights,
+        events,
+        btag_jets=None,
+        muons=None,
+        muon_type="",
+        photons=None,
+        mupt_type=None,
+        btag_cache=None,
         ):
         """
         Add weights that are region specific, depending on objects queried.
         Weights will be differentiated by "REGION{region}_" , which will be used for sorting in the partial_weight call
+        btag_cache: dictionary shared by the calls on the same chunk, to evaluate the b-tag SFs once per jet collection
         """
 
         weight_str = f"REGION{region}_"
@@ -279,34 +277,52 @@ class categorizer(SkimmerABC):
         if not self._skip_syst:
 
             if not self._btag_eff and btag_jets is not None:
+                # regions using the same jet collection share the SF evaluation within a chunk
+                btag_weights = None
+                if btag_cache is not None:
+                    key = getattr(btag_jets, "name", id(btag_jets))
+                    if key not in btag_cache:
+                        btag_cache[key] = get_btag_weights(btag_jets, self._btagger, self._btag_wp, self._year)
+                    btag_weights = btag_cache[key]
                 btag_SF = add_btag_weights(
-                    weights, btag_jets, self._btagger, self._btag_wp, self._year, alt_str=weight_str
+                    weights,
+                    btag_jets,
+                    self._btagger,
+                    self._btag_wp,
+                    self._year,
+                    alt_str=weight_str,
+                    btag_weights=btag_weights,
                 )
 
             if muons is not None:
-                add_muon_weights(weights, self._year, muons, self._mupt_type, muon_type, alt_str=weight_str)
+                mupt_type = self._mupt_type if mupt_type is None else mupt_type
+                add_muon_weights(weights, self._year, muons, mupt_type, muon_type, alt_str=weight_str)
 
             if photons is not None:
                 add_photon_weights(weights, self._year, photons, alt_str=weight_str)
 
         return btag_SF
 
-    def get_weight_dict(self, events, region, weights, dataset, output) -> tuple[dict, dict]:
+    def get_theory_weights(self, events, dataset, output) -> dict:
         """
-        Calculate the partial weights and the systematic variations for specified region.
-        Saved to dictionary to be output in skim files.
+        PDF and QCD scale variations (signal datasets only).
+        These do not depend on the region or the energy shift, so they are computed once per chunk.
         """
-
-        pdf_dict, scalevar_3_dict, scalevar_7_dict = {}, {}, {}
+        pdf_dict, scalevar_dict = {}, {}
         if not self._skip_syst:
             # Saving variations and sums in the output vector for signal datasets
             flag_syst = ("Hto2B" in dataset) or ("Hto2C" in dataset) or ("VBFZto" in dataset)
             if flag_syst:
                 pdf_dict = add_pdf_weight(events.genWeight, events.LHEPdfWeight, output)
-                scalevar_3_dict = add_scalevar(events.genWeight, events.LHEScaleWeight, output, structure = "3pt")
-                scalevar_7_dict = add_scalevar(events.genWeight, events.LHEScaleWeight, output, structure = "7pt")
+                scalevar_dict = add_scalevar(events.genWeight, events.LHEScaleWeight, output)
 
-        #Sort the region specific weights
+        return {**pdf_dict, **scalevar_dict}
+
+    def get_region_weight_names(self, region, weights) -> list[str]:
+        """
+        Names of the weights entering the event weight of a region:
+        all common weights, plus the REGION{region}_ weights of this region.
+        """
         include_weights = []
         for weight_key in weights._weights.keys():
             if "REGION" in weight_key:
@@ -314,6 +330,18 @@ class categorizer(SkimmerABC):
                     include_weights.append(weight_key)
             else:
                 include_weights.append(weight_key)
+        return include_weights
+
+    def get_weight_dict(self, region, weights, dataset, theory_weights) -> tuple[dict, dict]:
+        """
+        Calculate the partial weights and the systematic variations for specified region.
+        Saved to dictionary to be output in skim files.
+        """
+        if self._weight_format == "factors":
+            return self.get_weight_factors(region, weights, dataset, theory_weights)
+
+        #Sort the region specific weights
+        include_weights = self.get_region_weight_names(region, weights)
 
         logger.debug("weights", extra=weights._weights.keys())
         # dictionary of all weights and variations
@@ -321,17 +349,23 @@ class categorizer(SkimmerABC):
         # dictionary of total # events for norm preserving variations for normalization in postprocessing
         totals_dict = {}
 
-        # nominal
-        weights_dict["weight"] = weights.partial_weight(include=include_weights)
-
-        # systematics
+        # variations of this region as {name in skim: (weight, ratio to nominal, invert)}
+        variations = {}
         for systematic in weights.variations:
-            if "REGION" in systematic:
-                if region in systematic:
-                    syst_dict = systematic.replace(f"REGION{region}_", "")
-                    weights_dict[syst_dict] = weights.partial_weight(include=include_weights, modifier=systematic)
+            if "REGION" in systematic and region not in systematic:
+                continue
+            weight = systematic.replace("Down", "").replace("Up", "")
+            if systematic in weights._modifiers:
+                variations[systematic.replace(f"REGION{region}_", "")] = (weight, weights._modifiers[systematic], False)
             else:
-                weights_dict[systematic] = weights.partial_weight(include=include_weights, modifier=systematic)
+                up = weights._modifiers[systematic.replace("Down", "Up")]
+                variations[systematic.replace(f"REGION{region}_", "")] = (weight, up, True)
+
+        # nominal, leave-one-out and systematic products in a single pass
+        nominal, without, varied = weight_products({w: weights._weights[w] for w in include_weights}, variations)
+
+        weights_dict["weight"] = nominal
+        weights_dict.update(varied)
 
         ###################### Normalization (Step 1) ######################
         # strip the year from the dataset name
@@ -341,64 +375,79 @@ class categorizer(SkimmerABC):
         for key, val in weights_dict.items():
             weights_dict[key] = val * weight_norm
 
-
         for weight in include_weights:
-            weights_dict[f"weight_nonorm_{weight.replace(f'REGION{region}_', '')}"] = weights.partial_weight(include=[weight])
+            weights_dict[f"weight_nonorm_{weight.replace(f'REGION{region}_', '')}"] = weights._weights[weight]
 
         for weight in include_weights:
-            include_copy = include_weights.copy()
-            include_copy.remove(weight)
-            weights_dict[f"weight_nonorm_WITHOUT_{weight.replace(f'REGION{region}_', '')}"] = weights.partial_weight(include=include_copy)
+            weights_dict[f"weight_nonorm_WITHOUT_{weight.replace(f'REGION{region}_', '')}"] = without[weight]
 
         # save the unnormalized weight, to confirm that it's been normalized in post-processing
-        weights_dict["weight_noxsec"] = weights.partial_weight(include=include_weights)
+        weights_dict["weight_noxsec"] = nominal
 
-        weights_dict_out = {**weights_dict, **pdf_dict, **scalevar_3_dict, **scalevar_7_dict}
+        weights_dict_out = {**weights_dict, **theory_weights}
 
         return weights_dict_out, totals_dict
 
-    def process_shift(self, events, shift_name):
+    def get_weight_factors(self, region, weights, dataset, theory_weights) -> tuple[dict, dict]:
+        """
+        Factorized alternative to get_weight_dict: store each weight factor and its Up/Down ratios once,
+        instead of every systematic, nonorm and WITHOUT product.
+        Products are rebuilt when loading the skims, see hbb.utils.rebuild_weight.
+        """
+        include_weights = self.get_region_weight_names(region, weights)
+
+        dataset_no_year = dataset.replace(f"{self._year}_", "")
+        weight_norm = self.get_dataset_norm(self._year, dataset_no_year)
+
+        weights_dict = {}
+        # the nominal weight is kept, since it is used by every reader
+        weights_dict["weight"] = weights.partial_weight(include=include_weights) * weight_norm
+        weights_dict[WEIGHT_NORM_COLUMN] = ak.ones_like(weights_dict["weight"]) * weight_norm
+
+        for weight in include_weights:
+            name = weight.replace(f"REGION{region}_", "")
+            weights_dict[f"{WEIGHT_FACTOR_PREFIX}{name}"] = weights._weights[weight]
+            for direction in ("Up", "Down"):
+                # modifiers are stored as ratios to the nominal factor
+                if f"{weight}{direction}" in weights._modifiers:
+                    weights_dict[f"{WEIGHT_FACTOR_PREFIX}{name}{direction}"] = weights._modifiers[f"{weight}{direction}"]
+
+        return {**weights_dict, **theory_weights}, {}
+
+    def process_common(self, events) -> dict:
+        """
+        Compute the shift-independent pieces of the selection once per chunk:
+        triggers, lumimask, MET filters, corrected jets and muons (with all their variations),
+        electrons, photons, gen bosons and the common event weights.
+        The returned dictionary is shared by all calls to process_shift on the same chunk.
+        """
 
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
-        selection = PackedSelection()
-        output = self.make_output() if not self._btag_eff else self.make_btag_output()
-        weights = Weights(None, storeIndividual=True)
-        if shift_name == "nominal" and not isRealData and not self._btag_eff:
-            output["sumw"][dataset] = ak.sum(events.genWeight)
+        common = {
+            "dataset": dataset,
+            "isRealData": isRealData,
+            "selections": {},
+            "jet_cache": {},
+            "btag_cache": {},
+            "sumw": {},
+            "theory_sumw": {"sumw_pdf": {}, "sumw_scalevar": {}},
+        }
+        if not isRealData and not self._btag_eff:
+            common["sumw"][dataset] = ak.sum(events.genWeight)
 
-        trigger = ak.values_astype(ak.zeros_like(events.run), bool)
-        for t in self._triggers[self._year]:
-            if t in events.HLT.fields:
-                trigger = trigger | events.HLT[t]
-        selection.add("trigger", trigger)
-        del trigger
+        trigger_decisions, trigger_booleans = self._trigger_evaluator(events.HLT, events.run, dataset)
+        common["selections"].update(trigger_decisions)
 
         if isRealData:
-            selection.add("lumimask", lumiMasks[self._year[:4]](events.run, events.luminosityBlock))
+            common["selections"]["lumimask"] = lumiMasks[self._year[:4]](events.run, events.luminosityBlock)
         else:
-            selection.add("lumimask", ak.values_astype(ak.ones_like(events.run), bool))
-
-        trigger = ak.values_astype(ak.zeros_like(events.run), bool)
-        for t in self._muontriggers[self._year]:
-            if t in events.HLT.fields:
-                trigger = trigger | events.HLT[t]
-        selection.add("muontrigger", trigger)
-        del trigger
-
-        trigger = ak.values_astype(ak.zeros_like(events.run), bool)
-        for t in self._egammatriggers[self._year]:
-            if t in events.HLT.fields:
-                trigger = trigger | events.HLT[t]
-        selection.add("egammatrigger", trigger)
-        del trigger
-
-        metfilter = ak.values_astype(ak.ones_like(events.run), bool)
-        for flag in self._met_filters[self._year]["data" if isRealData else "mc"]:
-            if flag in events.Flag.fields:
-                metfilter = metfilter & events.Flag[flag]
-        selection.add("metfilter", metfilter)
-        del metfilter
+            common["selections"]["lumimask"] = ak.values_astype(ak.ones_like(events.run), bool)
+
+        metfilter_decisions, _ = self._metfilter_evaluator["data" if isRealData else "mc"](
+            events.Flag, events.run, dataset
+        )
+        common["selections"].update(metfilter_decisions)
 
         mc_run = "mc"
         if isRealData:
@@ -433,59 +482,115 @@ class categorizer(SkimmerABC):
             )
         met = events.PuppiMET
         # Apply jerc corrections to jets, fatjets, and met collections
+        # the corrected collections carry every variation, so this is done once for all shifts
+        jet_attrs = []
         if not self._skip_syst:
             jets = apply_jerc(jets, "AK4", self._year, jec_key)
             fatjets = apply_jerc(fatjets, "AK8", self._year, jec_key)
             met = correct_met(met, jets)  # PuppiMET Recommended for Run3
+            if not isRealData:
+                jet_attrs = [jerc_variations[var] for var in ("JES", "JER")]
+        common["met"] = met
+
+        # only the varied pt and mass are kept for the JES/JER variations,
+        # the energy-independent parts of the jet selections are computed once
+        common["jets"] = JetVariations.from_corrected(jets, jet_attrs)
+        common["ak4_id_masks"] = ak4jet_id_masks(jets)
+        common["ak4_veto_jets"] = get_jetveto_jets(jets, self._year)
+        common["fatjets"] = JetVariations.from_corrected(fatjets, jet_attrs)
+        common["ak8_id_mask"] = ak8jet_id_mask(fatjets)
+
+        # muon corrections store every pt variation as a separate field
+        common["muons"] = correct_muons(events.Muon, events, self._year, isRealData)
+
+        goodelectron = good_electrons(events.Electron)
+        common["nelectrons"] = ak.num(goodelectron, axis=1)
+
+        goodphotons = good_photons(events.Photon)
+        nphotons = ak.num(goodphotons, axis=1)
+
+        tightphotons = tight_photons(events.Photon)
+        common["ntightphotons"] = ak.num(tightphotons, axis=1)
+        common["vgammaphoton"] = ak.firsts(tightphotons)
+
+        common["selections"]["onephoton"] = nphotons == 1
+        common["selections"]["atleastonephoton"] = common["ntightphotons"] >= 1
+        common["selections"]["passphotonveto"] = nphotons == 0
+
+        common["egamma_trigger_booleans"] = {t: trigger_booleans[t] for t in self._egammatriggers[self._year]}
+        common["jetmet_trigger_booleans"] = {t: trigger_booleans[t] for t in self._triggers[self._year]}
+
+        # weights that are not region specific
+        weights = Weights(None, storeIndividual=True)
+        theory_weights = {}
+        if not isRealData:
+            self.add_common_weights(weights, events, dataset)
+            theory_weights = self.get_theory_weights(events, dataset, common["theory_sumw"])
+            common["bosons"] = getBosons(events.GenPart)
+        common["weights"] = weights
+        common["theory_weights"] = theory_weights
+
+        return common
+
+    def select_jets(self, events, common, jet_shift) -> dict:
+        """
+        Jet and MET dependent part of the selection for a given jet energy shift.
+        Muon energy shifts reuse the nominal result.
+        """
+
+        dataset = common["dataset"]
+        isRealData = common["isRealData"]
+        met = common["met"]
+        selections = {}
 
         # Select jets, fatjets, and met collections according to jerc variation shift
-        if shift_name != "nominal" and "Muon" not in shift_name:
-            var, direction = shift_name.split("_")
+        # (the JES/JER varied collections only differ from the nominal ones in pt and mass)
+        variation = ()
+        if jet_shift != "nominal":
+            var, direction = jet_shift.split("_")
             attr = jerc_variations[var]
             if var in ("JES", "JER"):
-                jets = getattr(getattr(jets, attr), direction.lower())
-                fatjets = getattr(getattr(fatjets, attr), direction.lower())
+                variation = (attr, direction.lower())
                 met = getattr(getattr(met, attr), direction.lower())
             elif var == "UES":
                 met = getattr(getattr(met, attr), direction.lower())
+        jets = common["jets"].get(*variation)
+        fatjets = common["fatjets"].get(*variation)
 
-        goodfatjets = good_ak8jets(fatjets)
-        goodjets = good_ak4jets(jets)
+        goodfatjets = good_ak8jets(fatjets, common["ak8_id_mask"])
+        goodjets = good_ak4jets(jets, common["ak4_id_masks"])
 
-        cut_jetveto = get_jetveto_event(jets, self._year)
-        selection.add("ak4jetveto", cut_jetveto)
+        cut_jetveto = get_jetveto_event(jets, self._year, common["ak4_veto_jets"])
+        selections["ak4jetveto"] = cut_jetveto
 
-        selection.add("2FJ", ak.num(goodfatjets, axis=1) == 2)
-        selection.add("not2FJ", ak.num(goodfatjets, axis=1) != 2)
+        selections["2FJ"] = ak.num(goodfatjets, axis=1) == 2
+        selections["not2FJ"] = ak.num(goodfatjets, axis=1) != 2
 
-        if "v12" in self._nano_version:
-            xbbfatjets = goodfatjets[ak.argsort(goodfatjets.pnetXbbXcc, axis=1, ascending=False)]
-        else:
-            xbbfatjets = goodfatjets[ak.argsort(goodfatjets.ParTPXbbXcc, axis=1, ascending=False)]
+        # candidate jet: highest Xbb score, subleading jet: highest pt among the others
+        # (argmax gives the first of equal values, as the stable argsort did)
+        xbb_score = goodfatjets.pnetXbbXcc if "v12" in self._nano_version else goodfatjets.ParTPXbbXcc
+        candidate_index = argbest(xbb_score)
+        is_candidate = ak.local_index(goodfatjets, axis=1) == ak.firsts(candidate_index)
+        candidatejets = goodfatjets[candidate_index]
+        subleadingjets = best(goodfatjets, goodfatjets.pt, mask=~is_candidate)
 
-        candidatejet = ak.firsts(xbbfatjets[:, 0:1])
-        
-        leftover_jets = xbbfatjets[:, 1:]
-        leftover_jets_bypt = leftover_jets[ak.argsort(leftover_jets.pt, axis=1, ascending=False)]
-        
-        subleadingjet = ak.firsts(leftover_jets_bypt[:, 0:1])
+        candidatejet = ak.firsts(candidatejets)
+        subleadingjet = ak.firsts(subleadingjets)
 
-        selection.add(
-            "minjetkin",
+        selections["minjetkin"] = (
             (candidatejet.pt >= 300) & (candidatejet.pt < 1200)
-            & (abs(candidatejet.eta) < 2.5),
+            & (abs(candidatejet.eta) < 2.5)
         )
 
-        selection.add(
-            "minjetkin_zgamma",
+        selections["minjetkin_zgamma"] = (
             (candidatejet.pt >= 200)  # Loosened pt cut
             & (candidatejet.pt < 1200)
             & (candidatejet.msd >= 0.0)  # Loosened msd cut
             & (candidatejet.msd < 201.0)
-            & (abs(candidatejet.eta) < 2.5),
+            & (abs(candidatejet.eta) < 2.5)
         )
 
-        selection.add("particleNetXbbpass", (candidatejet.particleNet_XbbVsQCD >= 0.5))
+        selections["particleNetXbbpass"] = candidatejet.particleNet_XbbVsQCD >= 0.5
 
         # only consider 4 AK4 jets leading in pT to be consistent with old framework
         jets = goodjets[:, :4]
@@ -496,33 +601,39 @@ class categorizer(SkimmerABC):
         ak4_outside_ak8_medB = jets[(dR > 0.8) & (getattr(jets, self._btagger) > self._btag_cut)]
 
         # ak4 closest to ak8
-        ak4_closest_ak8 = ak.firsts(
-            ak4_outside_ak8[ak.argmin(ak4_outside_ak8.delta_r(candidatejet), axis=1, keepdims=True)]
-        )
+        ak4_closest_ak8s = best(ak4_outside_ak8, ak4_outside_ak8.delta_r(candidatejet), largest=False)
+        ak4_closest_ak8 = ak.firsts(ak4_closest_ak8s)
 
-        selection.add(
-            "antiak4btagMediumOppHem",
+        selections["antiak4btagMediumOppHem"] = (
             ak.max(getattr(ak4_opphem_ak8, self._btagger), axis=1, mask_identity=False)
-            < self._btag_cut,
+            < self._btag_cut
         )
-        selection.add(
-            "antiak4btagMedium",
+        selections["antiak4btagMedium"] = (
             ak.max(getattr(ak4_outside_ak8, self._btagger), axis=1, mask_identity=False)
-            < self._btag_cut,
+            < self._btag_cut
         )
-        selection.add(
-            "ak4btagMedium08",
+        selections["ak4btagMedium08"] = (
             ak.max(getattr(ak4_outside_ak8, self._btagger), axis=1, mask_identity=False)
-            > self._btag_cut,
+            > self._btag_cut
         )
 
-        selection.add("lowmet", met.pt < 140.0)
+        selections["lowmet"] = met.pt < 140.0
 
         # VBF specific variables
-        jet1_away = ak.firsts(ak4_outside_ak8[:, 0:1])
-        jet2_away = ak.firsts(ak4_outside_ak8[:, 1:2])
-        jet3_away = ak.firsts(ak4_outside_ak8[:, 2:3])
-        jet4_away = ak.firsts(ak4_outside_ak8[:, 3:4])
+        jets_away = pad_slots(ak4_outside_ak8, 2)
+        jet1_away, jet2_away = jets_away[:, 0], jets_away[:, 1]
+
+        # flat columns of the objects stored in the skims and used by the BDT, see hbb/object_export.py
+        object_exports = export_objects(
+            {
+                "candidatejets": candidatejets,
+                "subleadingjets": subleadingjets,
+                "ak4_outside_ak8": ak4_outside_ak8,
+                "ak4_closest_ak8": ak4_closest_ak8s,
+            },
+            self._export_spec,
+        )
+        object_columns = {key: value for columns in object_exports.values() for key, value in columns.items()}
 
         vbf_deta = abs(jet1_away.eta - jet2_away.eta)
         vbf_mjj = (jet1_away + jet2_away).mass
@@ -533,20 +644,137 @@ class categorizer(SkimmerABC):
         isvbf = ak.fill_none(isvbf, False)
         isnotvbf = ak.fill_none(~isvbf, True)
 
-        selection.add("isvbf", isvbf)
-        selection.add("notvbf", isnotvbf)
+        selections["isvbf"] = isvbf
+        selections["notvbf"] = isnotvbf
+
+        bdt_scores = None
+        if self._evaluate_BDT:
+            # Construct BDT input
+            bdt_ak_array = {
+                **object_columns,
+                "nFatJet": ak.num(goodfatjets, axis=1),
+                "nJet": ak.num(goodjets, axis=1),
+                "VBFPair_mjj": vbf_mjj,
+                "VBFPair_deta": vbf_deta,
+            }
+            # Evaluate BDT
+            bdt_scores = self.bdt_model(bdt_ak_array)
+
+            # assign scores to selections
+            selections["BDTisVBF"] = bdt_scores == 0
+            selections["BDTisVH"] = bdt_scores == 1
+            selections["BDTisggF"] = bdt_scores == 2
 
-        muons = correct_muons(events.Muon, events, self._year, isRealData)
+        gen_variables = {}
+        if isRealData:
+            genflavor = ak.zeros_like(candidatejet.pt)
+            genBosonPt = ak.zeros_like(candidatejet.pt)
+            genflavor_V = ak.zeros_like(candidatejet.pt)
+            genBosonPt_V = ak.zeros_like(candidatejet.pt)
+        else:
+            for d, gen_func in gen_selection_dict.items():
+                if d in dataset:
+                    # match goodfatjets
+                    gen_variables = gen_func(events, goodfatjets)
+
+            bosons = common["bosons"]
+            matchedBoson = candidatejet.nearest(bosons, axis=None, threshold=0.8)
+            matchedBoson_V = subleadingjet.nearest(bosons, axis=None, threshold=0.8)
+            
+            match_mask = (abs(candidatejet.pt - matchedBoson.pt) / matchedBoson.pt < 0.5) & (
+                abs(candidatejet.msd - matchedBoson.mass) / matchedBoson.mass < 0.3
+            )
+            match_mask_V = (abs(subleadingjet.pt - matchedBoson_V.pt) / matchedBoson_V.pt < 0.5) & (
+                abs(subleadingjet.msd - matchedBoson_V.mass) / matchedBoson_V.mass < 0.3
+            )
+            
+            selmatchedBoson = ak.mask(matchedBoson, match_mask)
+            selmatchedBoson_V = ak.mask(matchedBoson_V, match_mask_V)
+            
+            genflavor = bosonFlavor(selmatchedBoson)
+            genflavor_V = bosonFlavor(selmatchedBoson_V)
+            
+            genBosonPt = ak.fill_none(selmatchedBoson.pt, 0)
+            genBosonPt_V = ak.fill_none(selmatchedBoson_V.pt, 0)
+
+        return {
+            "selections": selections,
+            "met": met,
+            "goodfatjets": goodfatjets,
+            "goodjets": goodjets,
+            "candidatejet": candidatejet,
+            "subleadingjet": subleadingjet,
+            "ak4_opphem_ak8": ak4_opphem_ak8,
+            "ak4_outside_ak8": ak4_outside_ak8,
+            "ak4_outside_ak8_medB": ak4_outside_ak8_medB,
+            "ak4_closest_ak8": ak4_closest_ak8,
+            "object_exports": object_exports,
+            "vbf_deta": vbf_deta,
+            "vbf_mjj": vbf_mjj,
+            "bdt_scores": bdt_scores,
+            "gen_variables": gen_variables,
+            "genflavor": genflavor,
+            "genflavor_V": genflavor_V,
+            "genBosonPt": genBosonPt,
+            "genBosonPt_V": genBosonPt_V,
+        }
+
+    def process_shift(self, events, shift_name, common=None):
+        # graph construction time of the whole shift, reported by hbb.graph_utils.graph_report
+        tic_shift = time.time()
+
+        if common is None:
+            common = self.process_common(events)
+
+        dataset = common["dataset"]
+        isRealData = common["isRealData"]
+        selection = PackedSelection()
+        output = self.make_output() if not self._btag_eff else self.make_btag_output()
+        if shift_name == "nominal" and not isRealData and not self._btag_eff:
+            output["sumw"].update(common["sumw"])
+
+        for name, sel in common["selections"].items():
+            selection.add(name, sel)
+
+        # jet-dependent quantities are shared between nominal and the muon energy shifts
+        jet_shift = "nominal" if "Muon" in shift_name else shift_name
+        if jet_shift not in common["jet_cache"]:
+            common["jet_cache"][jet_shift] = self.select_jets(events, common, jet_shift)
+        jet_vars = common["jet_cache"][jet_shift]
+
+        for name, sel in jet_vars["selections"].items():
+            selection.add(name, sel)
+
+        met = jet_vars["met"]
+        goodfatjets = jet_vars["goodfatjets"]
+        goodjets = jet_vars["goodjets"]
+        candidatejet = jet_vars["candidatejet"]
+        subleadingjet = jet_vars["subleadingjet"]
+        ak4_opphem_ak8 = jet_vars["ak4_opphem_ak8"]
+        ak4_outside_ak8 = jet_vars["ak4_outside_ak8"]
+        ak4_outside_ak8_medB = jet_vars["ak4_outside_ak8_medB"]
+        ak4_closest_ak8 = jet_vars["ak4_closest_ak8"]
+        object_exports = jet_vars["object_exports"]
+        vbf_deta = jet_vars["vbf_deta"]
+        vbf_mjj = jet_vars["vbf_mjj"]
+        bdt_scores = jet_vars["bdt_scores"]
+        gen_variables = jet_vars["gen_variables"]
+        genflavor, genflavor_V = jet_vars["genflavor"], jet_vars["genflavor_V"]
+        genBosonPt, genBosonPt_V = jet_vars["genBosonPt"], jet_vars["genBosonPt_V"]
+
+        # muon pt type for this shift, kept local so the processor state is not modified
+        mupt_type = self._mupt_type
         if shift_name != "nominal" and "Muon" in shift_name:
             var, direction = shift_name.split("_")
-            self._mupt_type = f"{mupt_variations[var]}_{direction.lower()}"
+            mupt_type = f"{mupt_variations[var]}_{direction.lower()}"
 
-        loosemuon = loose_muons(muons, self._mupt_type)
-        highptmuon = highpt_muons(muons, self._mupt_type)
+        muons = common["muons"]
+        loosemuon = loose_muons(muons, mupt_type)
+        highptmuon = highpt_muons(muons, mupt_type)
         nmuons = ak.num(loosemuon, axis=1)
         ttbarmuon = ak.firsts(loosemuon)
         leadingmuon = loosemuon[:, :1]
-        ttbarmuon_sf = leadingmuon[getattr(leadingmuon, self._mupt_type) > 55.0]
+        ttbarmuon_sf = leadingmuon[getattr(leadingmuon, mupt_type) > 55.0]
         # low pt muons break sf (lower bound 15GeV)
         # ak.firsts records array breaks the evaluator also, the inverse breaks selection.add
             # TODO figure this out later
@@ -558,170 +786,64 @@ class categorizer(SkimmerABC):
 
         zmm_mll = (zmm_lead + zmm_sublead).mass
         zmm_charge = zmm_lead.charge * zmm_sublead.charge   # >0 same sign, <0 opp sign
-        zmm_pt = getattr(zmm_lead, self._mupt_type) + getattr(zmm_sublead, self._mupt_type)
+        zmm_pt = getattr(zmm_lead, mupt_type) + getattr(zmm_sublead, mupt_type)
 
         dR_leadm = goodfatjets.delta_r(zmm_lead)
         dR_subleadm = goodfatjets.delta_r(zmm_sublead)
         ak8_outside_dimuon = goodfatjets[(dR_leadm > 0.8) & (dR_subleadm > 0.8)]
         nak8_zmm = ak.num(ak8_outside_dimuon, axis=1)
 
-        goodelectron = good_electrons(events.Electron)
-        nelectrons = ak.num(goodelectron, axis=1)
+        nelectrons = common["nelectrons"]
 
         selection.add("noleptons", (nmuons == 0) & (nelectrons == 0))
         selection.add("onemuon", (nmuons == 1) & (nelectrons == 0))
         selection.add("twoloosemuon", (nmuons == 2) & (nelectrons == 0))
         selection.add("twomuon_zmm", (nmuons_zmm == 2) & (nelectrons == 0))
         selection.add(
-            "muonkin_leadzmm", (getattr(zmm_lead, self._mupt_type) > 60.0)
+            "muonkin_leadzmm", (getattr(zmm_lead, mupt_type) > 60.0)
         )
         selection.add(
             "muonpairkin_zmm", (zmm_mll >= 80) & (zmm_mll <= 100) & (zmm_charge < 0) & (zmm_pt > 300)
         )
 
         selection.add(
-            "muonkin", (getattr(ttbarmuon, self._mupt_type) > 55.0) & (abs(ttbarmuon.eta) < 2.1)
+            "muonkin", (getattr(ttbarmuon, mupt_type) > 55.0) & (abs(ttbarmuon.eta) < 2.1)
         )
         selection.add("muonDphiAK8", abs(ttbarmuon.delta_phi(candidatejet)) > 2 * np.pi / 3)
 
-        goodphotons = good_photons(events.Photon)
-        nphotons = ak.num(goodphotons, axis=1)
-
-        ntightphotons = ak.num(tight_photons(events.Photon), axis=1)
-        vgammaphoton = ak.firsts(tight_photons(events.Photon))
-
-        selection.add("onephoton", (nphotons == 1))
-        selection.add("atleastonephoton", (ntightphotons >= 1))
-        selection.add("passphotonveto", (nphotons == 0))
-
-        if self._evaluate_BDT:
-            # Construct BDT input
-            bdt_ak_array = {
-                "nFatJet": ak.num(goodfatjets, axis=1),
-                "nJet": ak.num(goodjets, axis=1),
-                "FatJet0_phi": candidatejet.phi,
-                "FatJet0_eta": candidatejet.eta,
-                "FatJet0_n2b1": candidatejet.n2b1,
-                "FatJet0_n3b1": candidatejet.n3b1,
-                "FatJet1_pt": subleadingjet.pt,
-                "FatJet1_phi": subleadingjet.phi,
-                "FatJet1_eta": subleadingjet.eta,
-                "FatJet1_msd": subleadingjet.msd,
-                "VBFPair_mjj": vbf_mjj,
-                "VBFPair_deta": vbf_deta,
-                "FatJet1_ParTPQCD": subleadingjet.ParTPQCD,
-                "FatJet1_ParTPXbb": subleadingjet.ParTPXbb,
-                "FatJet1_ParTPXcc": subleadingjet.ParTPXcc,
-                "FatJet1_ParTPXqq": subleadingjet.ParTPXqq,
-                "FatJet1_ParTPXcs": subleadingjet.ParTPXcs,
-                "FatJet1_ParTPXbbVsQCD": subleadingjet.ParTPXbbVsQCD,
-                "FatJet1_ParTPXccVsQCD": subleadingjet.ParTPXccVsQCD,
-                "FatJet1_ParTPXbbXcc": subleadingjet.ParTPXbbXcc,
-                "FatJet1_ParTmassX2p": subleadingjet.ParTmassX2p,
-                "Jet0_pt": jet1_away.pt,
-                "Jet0_eta": jet1_away.eta,
-                "Jet0_phi": jet1_away.phi,
-                "Jet0_mass": jet1_away.mass,
-                "Jet0_btagPNetB": jet1_away.btagPNetB,
-                "Jet0_btagPNetCvB": jet1_away.btagPNetCvB,
-                "Jet0_btagPNetCvL": jet1_away.btagPNetCvL,
-                "Jet0_btagPNetQvG": jet1_away.btagPNetQvG,
-                "Jet1_pt": jet2_away.pt,
-                "Jet1_eta": jet2_away.eta,
-                "Jet1_phi": jet2_away.phi,
-                "Jet1_mass": jet2_away.mass,
-                "Jet1_btagPNetB": jet2_away.btagPNetB,
-                "Jet1_btagPNetCvB": jet2_away.btagPNetCvB,
-                "Jet1_btagPNetCvL": jet2_away.btagPNetCvL,
-                "Jet1_btagPNetQvG": jet2_away.btagPNetQvG,
-                "Jet2_pt": jet3_away.pt,
-                "Jet2_eta": jet3_away.eta,
-                "Jet2_phi": jet3_away.phi,
-                "Jet2_mass": jet3_away.mass,
-                "Jet2_btagPNetB": jet3_away.btagPNetB,
-                "Jet2_btagPNetCvB": jet3_away.btagPNetCvB,
-                "Jet2_btagPNetCvL": jet3_away.btagPNetCvL,
-                "Jet2_btagPNetQvG": jet3_away.btagPNetQvG,
-                "Jet3_pt": jet4_away.pt,
-                "Jet3_eta": jet4_away.eta,
-                "Jet3_phi": jet4_away.phi,
-                "Jet3_mass": jet4_away.mass,
-                "Jet3_btagPNetB": jet4_away.btagPNetB,
-                "Jet4_btagPNetCvB": jet4_away.btagPNetCvB,
-                "Jet4_btagPNetCvL": jet4_away.btagPNetCvL,
-                "Jet4_btagPNetQvG": jet4_away.btagPNetQvG,
-                "JetClosestFatJet0_pt": ak4_closest_ak8.pt,
-                "JetClosestFatJet0_eta": ak4_closest_ak8.eta,
-                "JetClosestFatJet0_phi": ak4_closest_ak8.phi,
-                "JetClosestFatJet0_mass": ak4_closest_ak8.mass,
-            }
-            bdt_input = ak.zip(bdt_ak_array, depth_limit=1)
-
-            # Evaluate BDT
-            bdt_model = self.bdt_model
-            bdt_scores = bdt_model(bdt_input)
-
-            # assign scores to selections
-            selection.add("BDTisVBF", (bdt_scores == 0))
-            selection.add("BDTisVH", (bdt_scores == 1))
-            selection.add("BDTisggF", (bdt_scores == 2))
+        ntightphotons = common["ntightphotons"]
+        vgammaphoton = common["vgammaphoton"]
 
-        gen_variables = {}
         btag_SF = ak.ones_like(events.run)
-        if isRealData:
-            genflavor = ak.zeros_like(candidatejet.pt)
-            genBosonPt = ak.zeros_like(candidatejet.pt)
-            genflavor_V = ak.zeros_like(candidatejet.pt)
-            genBosonPt_V = ak.zeros_like(candidatejet.pt)
-        else:
+        weights = copy_weights(common["weights"])
+        if not isRealData:
+
+            output["sumw_pdf"].update(common["theory_sumw"]["sumw_pdf"])
+            output["sumw_scalevar"].update(common["theory_sumw"]["sumw_scalevar"])
 
-            self.add_common_weights(weights, events, dataset)
             # signal regions
             btag_SF = self.add_region_weights(
-                "signal", weights, events, btag_jets=ak4_outside_ak8
+                "signal", weights, events, btag_jets=ak4_outside_ak8, btag_cache=common["btag_cache"]
             )
             # muon region
-            btag_SF_mu = self.add_region_weights(
-                "control-tt", weights, events, btag_jets=ak4_outside_ak8, muons=ttbarmuon_sf, muon_type="loose"
+            self.add_region_weights(
+                "control-tt", weights, events, btag_jets=ak4_outside_ak8, muons=ttbarmuon_sf, muon_type="loose", mupt_type=mupt_type,
+                btag_cache=common["btag_cache"],
             )
             # gamma region
-            btag_SF_gamma = self.add_region_weights(
-                "control-zgamma", weights, events, btag_jets=ak4_outside_ak8, photons=vgammaphoton
+            self.add_region_weights(
+                "control-zgamma", weights, events, btag_jets=ak4_outside_ak8, photons=vgammaphoton, btag_cache=common["btag_cache"]
             )
             # zmumu muon region 
-            btag_SF_zmm = self.add_region_weights(
-                "control-zmumu", weights, events, muons=zmm_muons, muon_type="highpt"
+            self.add_region_weights(
+                "control-zmumu", weights, events, muons=zmm_muons, muon_type="highpt", mupt_type=mupt_type
             )
 
-            weights_dict, totals_temp = self.get_weight_dict(events, "signal", weights, dataset, output)
-            weights_dict_mu, totals_temp_mu = self.get_weight_dict(events, "control-tt", weights, dataset, output)
-            weights_dict_gamma, totals_temp_gamma = self.get_weight_dict(events, "control-zgamma", weights, dataset, output)
-            weights_dict_zmm, totals_temp_zmm = self.get_weight_dict(events, "control-zmumu", weights, dataset, output)
-
-            for d, gen_func in gen_selection_dict.items():
-                if d in dataset:
-                    # match goodfatjets
-                    gen_variables = gen_func(events, goodfatjets)
-
-            bosons = getBosons(events.GenPart)
-            matchedBoson = candidatejet.nearest(bosons, axis=None, threshold=0.8)
-            matchedBoson_V = subleadingjet.nearest(bosons, axis=None, threshold=0.8)
-            
-            match_mask = (abs(candidatejet.pt - matchedBoson.pt) / matchedBoson.pt < 0.5) & (
-                abs(candidatejet.msd - matchedBoson.mass) / matchedBoson.mass < 0.3
-            )
-            match_mask_V = (abs(subleadingjet.pt - matchedBoson_V.pt) / matchedBoson_V.pt < 0.5) & (
-                abs(subleadingjet.msd - matchedBoson_V.mass) / matchedBoson_V.mass < 0.3
-            )
-            
-            selmatchedBoson = ak.mask(matchedBoson, match_mask)
-            selmatchedBoson_V = ak.mask(matchedBoson_V, match_mask_V)
-            
-            genflavor = bosonFlavor(selmatchedBoson)
-            genflavor_V = bosonFlavor(selmatchedBoson_V)
-            
-            genBosonPt = ak.fill_none(selmatchedBoson.pt, 0)
-            genBosonPt_V = ak.fill_none(selmatchedBoson_V.pt, 0)
+            theory_weights = common["theory_weights"]
+            weights_dict, _ = self.get_weight_dict("signal", weights, dataset, theory_weights)
+            weights_dict_mu, _ = self.get_weight_dict("control-tt", weights, dataset, theory_weights)
+            weights_dict_gamma, _ = self.get_weight_dict("control-zgamma", weights, dataset, theory_weights)
+            weights_dict_zmm, _ = self.get_weight_dict("control-zmumu", weights, dataset, theory_weights)
 
         # softdrop mass, 0 for genflavor == 0
         msd_matched = candidatejet.msd * (genflavor > 0) + candidatejet.msd * (genflavor == 0)
@@ -789,19 +911,8 @@ class categorizer(SkimmerABC):
         nominal_weight = ak.ones_like(events.run) if isRealData else weights_dict["weight"]
         gen_weight = ak.ones_like(events.run) if isRealData else events.genWeight
 
-        egamma_trigger_booleans = {}
-        for t in self._egammatriggers[self._year]:
-            if t in events.HLT.fields:
-                egamma_trigger_booleans[t] = events.HLT[t]
-            else:
-                egamma_trigger_booleans[t] = ak.values_astype(ak.zeros_like(events.run), bool)
-
-        jetmet_trigger_booleans = {}
-        for t in self._triggers[self._year]:
-            if t in events.HLT.fields:
-                jetmet_trigger_booleans[t] = events.HLT[t]
-            else:
-                jetmet_trigger_booleans[t] = ak.values_astype(ak.zeros_like(events.run), bool)
+        egamma_trigger_booleans = common["egamma_trigger_booleans"]
+        jetmet_trigger_booleans = common["jetmet_trigger_booleans"]
 
         if self._btag_eff:
             cut = selection.all(*btag_eff_cuts)
@@ -829,32 +940,10 @@ class categorizer(SkimmerABC):
                 "nJet_outsideFatJet0": ak.num(ak4_opphem_ak8, axis=1),
                 "nJet_opphemFatJet0": ak.num(ak4_outside_ak8, axis=1),
                 "nJet_outsideFatJet0_medBtag": ak.num(ak4_outside_ak8_medB, axis=1),
-                "FatJet0_pt": candidatejet.pt,
-                "FatJet0_phi": candidatejet.phi,
-                "FatJet0_eta": candidatejet.eta,
-                "FatJet0_msd": candidatejet.msd,
-                "FatJet0_msd_rho": candidatejet.qcdrho,
+                **object_exports["FatJet0"],
                 "FatJet0_msdmatched": msd_matched,
-                "FatJet0_n2b1": candidatejet.n2b1,
-                "FatJet0_n3b1": candidatejet.n3b1,
-                "FatJet0_pnetMass": candidatejet.pnetmass,
-                "FatJet0_pnetTXbb": candidatejet.particleNet_XbbVsQCD,
-                "FatJet0_pnetTXcc": candidatejet.particleNet_XccVsQCD,
-                "FatJet0_pnetTXqq": candidatejet.particleNet_XqqVsQCD,
-                "FatJet0_pnetTXgg": candidatejet.particleNet_XggVsQCD,
-                "FatJet0_pnetTQCD": candidatejet.particleNet_QCD,
-                "FatJet0_pnetXbbXcc": candidatejet.pnetXbbXcc,
-                "FatJet1_pt": subleadingjet.pt,
-                "FatJet1_phi": subleadingjet.phi,
-                "FatJet1_eta": subleadingjet.eta,
-                "FatJet1_msd": subleadingjet.msd,
+                **object_exports["FatJet1"],
                 "FatJet1_msdmatched": msd_matched_V,
-                "FatJet1_msd_rho": subleadingjet.qcdrho,
-                "FatJet1_pnetMass": subleadingjet.pnetmass,
-                "FatJet1_pnetTXbb": subleadingjet.particleNet_XbbVsQCD,
-                "FatJet1_pnetTXcc": subleadingjet.particleNet_XccVsQCD,
-                "FatJet1_pnetTXqq": subleadingjet.particleNet_XqqVsQCD,
-                "FatJet1_pnetTXgg": subleadingjet.particleNet_XggVsQCD,
                 "VBFPair_mjj": vbf_mjj,
                 "VBFPair_deta": vbf_deta,
                 "Photon0_pt": vgammaphoton.pt,
@@ -871,12 +960,12 @@ class categorizer(SkimmerABC):
                 output_array.update({"BDT_score": bdt_scores})
 
             output_array_zmm = {
-                "Zmm_MuonLead_pt": (getattr(zmm_lead, self._mupt_type)),
+                "Zmm_MuonLead_pt": (getattr(zmm_lead, mupt_type)),
                 "Zmm_MuonLead_eta": zmm_lead.eta,
                 "Zmm_MuonLead_phi": zmm_lead.phi,
                 "Zmm_MuonLead_charge": zmm_lead.charge,
 
-                "Zmm_MuonSublead_pt": (getattr(zmm_sublead, self._mupt_type)),
+                "Zmm_MuonSublead_pt": (getattr(zmm_sublead, mupt_type)),
                 "Zmm_MuonSubLead_eta": zmm_sublead.eta,
                 "Zmm_MuonSubLead_phi": zmm_sublead.phi,
                 "Zmm_MuonSubLead_charge": zmm_sublead.charge,
@@ -892,133 +981,81 @@ class categorizer(SkimmerABC):
             energy_var_array = {
                 "GenBoson_pt": genBosonPt,
                 "GenFlavor": genflavor,
-                "FatJet0_pt": candidatejet.pt,
-                "FatJet0_msd": candidatejet.msd,
+                **{
+                    f"FatJet0_{key}": object_exports["FatJet0"][f"FatJet0_{key}"]
+                    for key in ["pt", "msd", "msd_rho", "pnetTXbb", "pnetTXcc", "pnetXbbXcc"]
+                },
                 "FatJet0_msdmatched": msd_matched,
-                "FatJet0_msd_rho": candidatejet.qcdrho,
-                "FatJet0_pnetTXbb": candidatejet.particleNet_XbbVsQCD,
-                "FatJet0_pnetTXcc": candidatejet.particleNet_XccVsQCD,
-                "FatJet0_pnetXbbXcc": candidatejet.pnetXbbXcc,
                 "VBFPair_mjj": vbf_mjj,
                 "weight": nominal_weight,
                 "genWeight": gen_weight,
             }
 
             if "v12" not in self._nano_version:
-                parT_array = {
-                    "FatJet0_ParTPQCD": candidatejet.ParTPQCD,
-                    "FatJet0_ParTPXbb": candidatejet.ParTPXbb,
-                    "FatJet0_ParTPXcc": candidatejet.ParTPXcc,
-                    "FatJet0_ParTPXqq": candidatejet.ParTPXqq,
-                    "FatJet0_ParTPXcs": candidatejet.ParTPXcs,
-                    "FatJet0_ParTPXbbVsQCD": candidatejet.ParTPXbbVsQCD,
-                    "FatJet0_ParTPXccVsQCD": candidatejet.ParTPXccVsQCD,
-                    "FatJet0_ParTPXbbXcc": candidatejet.ParTPXbbXcc,
-                    "FatJet0_ParTPTopbWq": candidatejet.ParTPTopbWq,
-                    "FatJet0_ParTPTopbWqq": candidatejet.ParTPTopbWqq,
-                    "FatJet0_ParTmassGeneric_rho": candidatejet.ParTmassGeneric_rho,
-                    "FatJet0_ParTmassX2p_rho": candidatejet.ParTmassX2p_rho,
-                    "FatJet0_ParTmassGeneric": candidatejet.ParTmassGeneric,
-                    "FatJet0_ParTmassX2p": candidatejet.ParTmassX2p,
-                    "FatJet1_ParTPQCD": subleadingjet.ParTPQCD,
-                    "FatJet1_ParTPXbb": subleadingjet.ParTPXbb,
-                    "FatJet1_ParTPXcc": subleadingjet.ParTPXcc,
-                    "FatJet1_ParTPXqq": subleadingjet.ParTPXqq,
-                    "FatJet1_ParTPXcs": subleadingjet.ParTPXcs,
-                    "FatJet1_ParTPXbbVsQCD": subleadingjet.ParTPXbbVsQCD,
-                    "FatJet1_ParTPXccVsQCD": subleadingjet.ParTPXccVsQCD,
-                    "FatJet1_ParTPXbbXcc": subleadingjet.ParTPXbbXcc,
-                    "FatJet1_ParTPTopbWq": subleadingjet.ParTPTopbWq,
-                    "FatJet1_ParTPTopbWqq": subleadingjet.ParTPTopbWqq,
-                    "FatJet1_ParTmassGeneric": subleadingjet.ParTmassGeneric,
-                    "FatJet1_ParTmassX2p": subleadingjet.ParTmassX2p,
-                    "FatJet1_ParTmassGeneric_rho": subleadingjet.ParTmassGeneric_rho,
-                    "FatJet1_ParTmassX2p_rho": subleadingjet.ParTmassX2p_rho,
-                }
-                output_array = {**output_array, **parT_array}
-
-                energy_var_array_parT = {
-                    "FatJet0_ParTPXbbVsQCD": candidatejet.ParTPXbbVsQCD,
-                    "FatJet0_ParTPXccVsQCD": candidatejet.ParTPXccVsQCD,
-                    "FatJet0_ParTPXbbXcc": candidatejet.ParTPXbbXcc,
-                    "FatJet0_ParTmassGeneric": candidatejet.ParTmassGeneric,
-                    "FatJet0_ParTmassX2p": candidatejet.ParTmassX2p,
-                    "FatJet0_ParTmassGeneric_rho": candidatejet.ParTmassGeneric_rho,
-                    "FatJet0_ParTmassX2p_rho": candidatejet.ParTmassX2p_rho,
-                }
-                energy_var_array = {**energy_var_array, **energy_var_array_parT}
+                energy_var_array.update(
+                    {
+                        f"FatJet0_{key}": object_exports["FatJet0"][f"FatJet0_{key}"]
+                        for key in [
+                            "ParTPXbbVsQCD",
+                            "ParTPXccVsQCD",
+                            "ParTPXbbXcc",
+                            "ParTmassGeneric",
+                            "ParTmassX2p",
+                            "ParTmassGeneric_rho",
+                            "ParTmassX2p_rho",
+                        ]
+                    }
+                )
 
             # extra variables for big array
             output_array_extra = {
                 # AK4 Jets away from FatJet0
-                "Jet0_pt": jet1_away.pt,
-                "Jet0_eta": jet1_away.eta,
-                "Jet0_phi": jet1_away.phi,
-                "Jet0_mass": jet1_away.mass,
-                "Jet0_btagPNetB": jet1_away.btagPNetB,
-                "Jet0_btagPNetCvB": jet1_away.btagPNetCvB,
-                "Jet0_btagPNetCvL": jet1_away.btagPNetCvL,
-                "Jet0_btagPNetQvG": jet1_away.btagPNetQvG,
-                "Jet1_pt": jet2_away.pt,
-                "Jet1_eta": jet2_away.eta,
-                "Jet1_phi": jet2_away.phi,
-                "Jet1_mass": jet2_away.mass,
-                "Jet1_btagPNetB": jet2_away.btagPNetB,
-                "Jet1_btagPNetCvB": jet2_away.btagPNetCvB,
-                "Jet1_btagPNetCvL": jet2_away.btagPNetCvL,
-                "Jet1_btagPNetQvG": jet2_away.btagPNetQvG,
-                "Jet2_pt": jet3_away.pt,
-                "Jet2_eta": jet3_away.eta,
-                "Jet2_phi": jet3_away.phi,
-                "Jet2_mass": jet3_away.mass,
-                "Jet2_btagPNetB": jet3_away.btagPNetB,
-                "Jet2_btagPNetCvB": jet3_away.btagPNetCvB,
-                "Jet2_btagPNetCvL": jet3_away.btagPNetCvL,
-                "Jet2_btagPNetQvG": jet3_away.btagPNetQvG,
-                "Jet3_pt": jet4_away.pt,
-                "Jet3_eta": jet4_away.eta,
-                "Jet3_phi": jet4_away.phi,
-                "Jet3_mass": jet4_away.mass,
-                "Jet3_btagPNetB": jet4_away.btagPNetB,
-                "Jet4_btagPNetCvB": jet4_away.btagPNetCvB,
-                "Jet4_btagPNetCvL": jet4_away.btagPNetCvL,
-                "Jet4_btagPNetQvG": jet4_away.btagPNetQvG,
+                **object_exports["Jet"],
                 # AK4 Jet away but closest to FatJet0
-                "JetClosestFatJet0_pt": ak4_closest_ak8.pt,
-                "JetClosestFatJet0_eta": ak4_closest_ak8.eta,
-                "JetClosestFatJet0_phi": ak4_closest_ak8.phi,
-                "JetClosestFatJet0_mass": ak4_closest_ak8.mass,
+                **object_exports["JetClosestFatJet0"],
                 "JetClosestFatJet0_dR": ak4_closest_ak8.delta_r(candidatejet),
                 "JetClosestFatJet0_dijetMass": (ak4_closest_ak8 + candidatejet).mass,
             }
 
-        def skim(region, output_array):
-            selections = regions[region]
-            cut = selection.all(*selections)
-
-            # to debug...
-            # print(output_array.compute())
-            # print(output_array[cut].compute())
+        def write_skim(name, columns, cut):
+            tic_write = time.time()
 
             if "root:" in self._skim_outpath:
-                skim_path = f"{self._skim_outpath}/{shift_name.replace('_', '')}/{self._year}/{dataset}/{region}"
+                skim_path = f"{self._skim_outpath}/{shift_name.replace('_', '')}/{self._year}/{dataset}/{name}"
             else:
                 skim_path = (
                     Path(self._skim_outpath)
                     / shift_name.replace("_", "")
                     / self._year
                     / dataset
-                    / region
+                    / name
                 )
                 skim_path.mkdir(parents=True, exist_ok=True)
-            print("Saving skim to: ", skim_path)
+
+            columns = apply_dtype_policy(columns, self._dtype_policy)
 
             # possible TODO: add systematic weights?
-            output["skim"][region] = dak.to_parquet(
-                output_array[cut],
+            output["skim"][name] = dak.to_parquet(
+                ak.zip(columns, depth_limit=1)[cut],
                 str(skim_path),
                 compute=False,
             )
+            output["graphtime"][name] = output["graphtime"].get(name, 0) + time.time() - tic_write
+
+        # with region flags, regions stored in the same directory (see hbb.utils.skim_group)
+        # are collected here and written once with a boolean column per region
+        skim_groups = {}
+
+        def skim(region, columns):
+            # construction time of the region: its skim (or its part of the skim group) and cutflow
+            tic_region = time.time()
+            selections = regions[region]
+            if self._skim_region_flags:
+                group = skim_groups.setdefault(skim_group(region), {"regions": [], "columns": {}})
+                group["regions"].append(region)
+                group["columns"].update(columns)
+            else:
+                write_skim(region, columns, selection.all(*selections))
 
             if shift_name == "nominal":
 
@@ -1047,21 +1084,23 @@ class categorizer(SkimmerABC):
                 cut = selection.all(*selections)
                 output["btagWeight"].fill(val=self.normalize(btag_SF, cut))
 
+            output["graphtime"][region] = output["graphtime"].get(region, 0) + time.time() - tic_region
+
         if self._save_skim:
             if shift_name == "nominal":
                 for region in regions:
                     if region == "signal-all":
-                        skim(region, ak.zip({**output_array, **output_array_extra}, depth_limit=1))
+                        skim(region, {**output_array, **output_array_extra})
                     else:
                         if isRealData:
                             if region == "control-zmumu":
-                                skim(region, ak.zip({**output_array, **output_array_zmm}, depth_limit=1))
+                                skim(region, {**output_array, **output_array_zmm})
                             else:
-                                skim(region, ak.zip(output_array, depth_limit=1))
+                                skim(region, output_array)
                         else:
                             if "signal" in region:
                                 skim(
-                                    region, ak.zip({**output_array, **weights_dict}, depth_limit=1)
+                                    region, {**output_array, **weights_dict}
                                 )
                             elif region == "control-tt":
                                 output_array["weight"] = (
@@ -1071,7 +1110,7 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip({**output_array, **weights_dict_mu}, depth_limit=1),
+                                    {**output_array, **weights_dict_mu},
                                 )
                             elif region == "control-zgamma":
                                 output_array["weight"] = (
@@ -1081,7 +1120,7 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip({**output_array, **weights_dict_gamma}, depth_limit=1),
+                                    {**output_array, **weights_dict_gamma},
                                 )
                             elif region == "control-zmumu":
                                 output_array["weight"] = (
@@ -1091,19 +1130,19 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip({**output_array, **output_array_zmm, **weights_dict_zmm}, depth_limit=1),
+                                    {**output_array, **output_array_zmm, **weights_dict_zmm},
                                 )
 
             else:  # energy variation shift case
                 for region in regions:
                     if region != "signal-all":
                         if isRealData:
-                            skim(region, ak.zip(energy_var_array, depth_limit=1))
+                            skim(region, energy_var_array)
                         else:
                             if "signal" in region:
                                 skim(
                                     region,
-                                    ak.zip({**energy_var_array, **weights_dict}, depth_limit=1),
+                                    {**energy_var_array, **weights_dict},
                                 )
                             elif region == "control-tt":
                                 output_array["weight"] = (
@@ -1113,7 +1152,7 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip({**energy_var_array, **weights_dict_mu}, depth_limit=1),
+                                    {**energy_var_array, **weights_dict_mu},
                                 )
                             elif region == "control-zgamma":
                                 output_array["weight"] = (
@@ -1123,9 +1162,7 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip(
-                                        {**energy_var_array, **weights_dict_gamma}, depth_limit=1
-                                    ),
+                                    {**energy_var_array, **weights_dict_gamma},
                                 )
                             elif region == "control-zmumu":
                                 output_array["weight"] = (
@@ -1135,16 +1172,18 @@ class categorizer(SkimmerABC):
                                 )
                                 skim(
                                     region,
-                                    ak.zip(
-                                        {**energy_var_array, **output_array_zmm, **weights_dict_zmm}, depth_limit=1
-                                    ),
+                                    {**energy_var_array, **output_array_zmm, **weights_dict_zmm},
                                 )
 
+            for name, group in skim_groups.items():
+                flags = {region_flag(region): selection.all(*regions[region]) for region in group["regions"]}
+                cut = functools.reduce(operator.or_, flags.values())
+                write_skim(name, {**group["columns"], **flags}, cut)
+
         toc = time.time()
         output["filltime"] = toc - tic
         print(f"Time to fill histograms: {toc - tic:.2f} seconds")
-        if shift_name is None:
-            output["weightStats"] = weights.weightStatistics
+        output["graphtime"]["total"] = time.time() - tic_shift
         return output
 
     def postprocess(self, accumulator):
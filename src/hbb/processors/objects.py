@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import awkward as ak
+import dask_awkward as dak
 import numpy as np
 from coffea.nanoevents.methods.nanoaod import (
     ElectronArray,
@@ -130,18 +131,26 @@ def set_ak4jets(jets: JetArray, isRealData: bool, year: str, nano_version: str,
 
 
 # ak4 jet definition
-def good_ak4jets(jets: JetArray):
+def ak4jet_id_masks(jets: JetArray) -> dict:
+    """
+    Parts of the good_ak4jets selection that do not depend on the jet energy,
+    computed once and shared between the JES/JER variations
+    """
+    abseta = abs(jets.eta)
+    return {
+        "id": jets.jetidtight & jets.jetidtightlepveto & (abseta < 5.0),
+        "horn": (abseta > 2.5) & (abseta < 3.0),
+    }
+
+
+def good_ak4jets(jets: JetArray, id_masks: dict = None):
     # Since the main AK4 collection for Run3 is the AK4 Puppi collection, jets originating from pileup are already suppressed at the jet clustering level
     # PuID might only be needed for forward region (WIP)
 
     # JETID: https://twiki.cern.ch/twiki/bin/viewauth/CMS/JetID13p6TeV
-    sel = (
-        (jets.pt > 30)
-        & (jets.jetidtight)
-        & (jets.jetidtightlepveto)
-        & (abs(jets.eta) < 5.0)
-        & ~((jets.pt <= 50) & (abs(jets.eta) > 2.5) & (abs(jets.eta) < 3.0))
-    )
+    if id_masks is None:
+        id_masks = ak4jet_id_masks(jets)
+    sel = (jets.pt > 30) & id_masks["id"] & ~((jets.pt <= 50) & id_masks["horn"])
 
     return jets[sel]
 
@@ -199,6 +208,51 @@ def set_ak8jets(fatjets: FatJetArray, isRealData: bool, year: str, nano_version:
 
 
 # ak8 jet definition
-def good_ak8jets(fatjets: FatJetArray):
-    sel = fatjets.jetidtight & (fatjets.pt > 200) & (abs(fatjets.eta) < 2.5)
+def ak8jet_id_mask(fatjets: FatJetArray):
+    """Part of the good_ak8jets selection that does not depend on the jet energy"""
+    return fatjets.jetidtight & (abs(fatjets.eta) < 2.5)
+
+
+def good_ak8jets(fatjets: FatJetArray, id_mask=None):
+    if id_mask is None:
+        id_mask = ak8jet_id_mask(fatjets)
+    sel = id_mask & (fatjets.pt > 200)
     return fatjets[sel]
+
+
+class JetVariations:
+    """
+    Jet collection with its JES/JER variations, stored as the varied kinematic columns only
+    (pt and mass, the fields changed by the CorrectedJetsFactory) over a shared nominal collection.
+    A full varied collection is only built on request with get.
+    """
+
+    fields = ("pt", "mass")
+
+    def __init__(self, nominal, variations: dict = None):
+        """
+        :param nominal: nominal jet collection
+        :param variations: {(attr, direction): {field: varied column}}, e.g. {("JES_jes", "up"): {"pt": ..., "mass": ...}}
+        """
+        self.nominal = nominal
+        self.variations = variations if variations is not None else {}
+
+    @classmethod
+    def from_corrected(cls, jets, attrs: list[str]):
+        """Collect the variations of a collection corrected by the CorrectedJetsFactory"""
+        variations = {
+            (attr, direction): {field: getattr(getattr(jets, attr), direction)[field] for field in cls.fields}
+            for attr in attrs
+            for direction in ["up", "down"]
+        }
+        return cls(jets, variations)
+
+    def get(self, attr: str = None, direction: str = None):
+        """Collection with the kinematics of the given variation (the nominal one if attr is None)"""
+        if attr is None:
+            return self.nominal
+        jets = self.nominal
+        with_field = dak.with_field if isinstance(jets, dak.Array) else ak.with_field
+        for field, column in self.variations[(attr, direction)].items():
+            jets = with_field(jets, column, field)
+        return jets
@@ -0,0 +1,81 @@
+"""
+Deterministic, counter-based random numbers for the corrections.
+
+Each random number is a pure function of (run, lumi block, event, object index, stream): the key is
+hashed with the splitmix64 finalizer, fully vectorized in numpy. The results therefore do not depend
+on the chunking, the partitioning or the order in which the events are processed, and need no
+per-element Python work or random state to be carried through dask.
+
+Streams separate independent uses (e.g. muon resolution smearing and toys) of the same objects.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from scipy.special import ndtri
+
+# stream ids, new uses should get a new id so that their random numbers are independent
+STREAMS = {
+    "muon_resolution": 1,
+    "jet_resolution": 2,
+    "toys": 3,
+}
+
+_KEY_MULTIPLIERS = [
+    np.uint64(0x9E3779B97F4A7C15),
+    np.uint64(0xC6A4A7935BD1E995),
+    np.uint64(0x517CC1B727220A95),
+    np.uint64(0xD6E8FEB86659FD93),
+    np.uint64(0xA0761D6478BD642F),
+]
+
+
+def _mix64(h: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer"""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def _stream_id(stream) -> int:
+    return STREAMS[stream] if isinstance(stream, str) else int(stream)
+
+
+def counter_hash(run, lumi, event, index, stream) -> np.ndarray:
+    """
+    64-bit hash of the key (run, lumi, event, index, stream). The inputs are broadcast against each other.
+    :param stream: name in STREAMS or integer stream id
+    """
+    key = np.broadcast_arrays(
+        *[np.asarray(x).astype(np.uint64) for x in (run, lumi, event, index, _stream_id(stream))]
+    )
+    h = np.zeros(key[0].shape, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for k, multiplier in zip(key, _KEY_MULTIPLIERS):
+            h = _mix64(h ^ (k * multiplier))
+    return h
+
+
+def uniform(run, lumi, event, index, stream) -> np.ndarray:
+    """Uniform random numbers in the open interval (0, 1)"""
+    # the 52 most significant bits, shifted by half a step to exclude 0 and 1 (exact in float64)
+    return ((counter_hash(run, lumi, event, index, stream) >> np.uint64(12)).astype(np.float64) + 0.5) * 2.0**-52
+
+
+def normal(run, lumi, event, index, stream) -> np.ndarray:
+    """Standard normal random numbers (inverse CDF of the uniform stream)"""
+    return ndtri(uniform(run, lumi, event, index, stream))
+
+
+def object_keys(run, lumi, event, counts) -> tuple:
+    """
+    Broadcast the per-event (run, lumi, event) to the flattened objects, with their index in the event
+    :param run, lumi, event: per-event arrays or scalars (e.g. a fixed run number)
+    :param counts: number of objects per event
+    :return: (run, lumi, event, index) flat numpy arrays
+    """
+    counts = np.asarray(counts)
+    starts = np.cumsum(counts) - counts
+    index = np.arange(counts.sum()) - np.repeat(starts, counts)
+    return tuple(np.repeat(np.broadcast_to(np.asarray(x), counts.shape), counts) for x in (run, lumi, event)) + (index,)
+
@@ -0,0 +1,75 @@
+"""
+Object ranking and fixed-width extraction helpers.
+
+Selecting the best object of an event (e.g. the candidate fatjet by Xbb score) only needs an
+argmax over the jagged axis, not a full argsort of the collection, and the leading N objects
+are read from a single padded, regular array instead of one ak.firsts(x[:, i:i+1]) slice each.
+Flat per-slot columns (Jet0_pt, ..., Jet3_pt) are extracted in one kernel per collection.
+"""
+
+from __future__ import annotations
+
+import awkward as ak
+import dask_awkward as dak
+
+
+def argbest(values, mask=None, largest: bool = True):
+    """
+    Index of the largest (smallest) value in each event, among the entries passing mask,
+    as a jagged array with one (possibly None) entry per event (keepdims).
+    Ties are resolved in favour of the first entry, as a stable sort would.
+    """
+    if mask is not None:
+        values = ak.mask(values, mask)
+    if largest:
+        return ak.argmax(values, axis=1, keepdims=True)
+    return ak.argmin(values, axis=1, keepdims=True)
+
+
+def best(objects, values, mask=None, largest: bool = True):
+    """The best object in each event as a jagged array of length 1 (None if there is no such object)"""
+    return objects[argbest(values, mask=mask, largest=largest)]
+
+
+def pad_slots(objects, n: int):
+    """Regular array of the first n objects, padded with None; slot i is pad_slots(objects, n)[:, i]"""
+    return ak.pad_none(objects, n, axis=1, clip=True)
+
+
+def _slot_columns_kernel(objects, columns, names, fill_value):
+    """Per-partition kernel, the typetracer pass (column optimization) is done on length-zero arrays"""
+    typetracer = ak.backend(objects) == "typetracer"
+
+    out = {}
+    for column, field in columns.items():
+        values = pad_slots(ak.typetracer.length_zero_if_typetracer(objects[field]), len(names))
+        if fill_value is not None:
+            values = ak.fill_none(values, fill_value)
+        # (events, slots) numpy array, masked where the slot is empty
+        matrix = ak.to_numpy(values)
+        for i, name in enumerate(names):
+            out[f"{name}_{column}"] = matrix[:, i]
+
+    out = ak.zip({key: ak.Array(value) for key, value in out.items()}, depth_limit=1)
+    if typetracer:
+        out = ak.Array(out.layout.to_typetracer(forget_length=True))
+    return out
+
+
+def slot_columns(objects, columns, names: list[str], fill_value=None) -> dict:
+    """
+    Flat columns of the first len(names) objects, e.g. {"Jet0_pt": ..., "Jet1_pt": ...}
+    :param objects: jagged collection
+    :param columns: list of fields, or {column suffix: field}
+    :param names: name of each slot, in order
+    :param fill_value: value of empty slots, None to keep them missing
+    """
+    if not isinstance(columns, dict):
+        columns = {field: field for field in columns}
+
+    kwargs = {"columns": columns, "names": list(names), "fill_value": fill_value}
+    if isinstance(objects, dak.Array):
+        out = dak.map_partitions(_slot_columns_kernel, objects, label="slot-columns", **kwargs)
+    else:
+        out = _slot_columns_kernel(objects, **kwargs)
+    return {key: out[key] for key in out.fields}
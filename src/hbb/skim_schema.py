@@ -0,0 +1,132 @@
+"""
+Column type policy for the skims.
+
+Without a policy, the skims are written with the types produced by awkward: float64 weights and
+kinematics and int64 counts. The policy gives the stored dtype of each column as a list of
+(pattern, dtype) rules, matched in order with fnmatch on the column name, and a fallback per type
+kind (e.g. every other floating point column to float32). Booleans (region flags, triggers) are
+bit-packed in parquet and are kept as they are.
+
+precision_report compares columns before and after the policy, to check the precision loss
+(see src/skim_precision.py).
+"""
+
+from __future__ import annotations
+
+import fnmatch
+
+import awkward as ak
+import numpy as np
+
+SKIM_DTYPES = ["native", "compact"]
+
+
+def get_dtype_policy(skim_dtypes: str = "compact", pdf_dtype: str = "float32") -> dict:
+    """
+    Dtype policy as {"rules": [(pattern, dtype)], "fallback": {kind: dtype}}, kinds as in numpy dtype.kind
+    :param skim_dtypes: "native" (no conversion) or "compact"
+    :param pdf_dtype: dtype of the PDF and scale variation ratios ("float32" or "float16")
+    """
+    if skim_dtypes == "native":
+        return {"rules": [], "fallback": {}}
+    if skim_dtypes != "compact":
+        raise ValueError(f"Invalid skim dtypes {skim_dtypes}, must be one of {SKIM_DTYPES}")
+    return {
+        "rules": [
+            ("weight_pdf*", pdf_dtype),
+            ("weight_scalevar*", pdf_dtype),
+            ("weight*", "float32"),
+            ("genWeight", "float32"),
+            # counts and flavours
+            ("n[A-Z]*", "uint8"),
+            ("Zmm_n*", "uint8"),
+            ("GenFlavor*", "uint8"),
+            ("*_charge", "int8"),
+        ],
+        # kinematics, scores, ...
+        "fallback": {"f": "float32"},
+    }
+
+
+def _primitive(array) -> str:
+    """Primitive type of the leaves of a (possibly optional or list) array, e.g. "float64" """
+    form = array.form if hasattr(array, "form") else ak.to_layout(array).form
+    while not isinstance(form, ak.forms.NumpyForm):
+        if not hasattr(form, "content"):
+            # records, unions: left to the caller
+            return None
+        form = form.content
+    return form.primitive
+
+
+def column_dtype(name: str, primitive: str, policy: dict) -> str:
+    """Stored dtype of a column given its primitive type, None to keep it as it is"""
+    if primitive is None or primitive == "bool":
+        return None
+    for pattern, dtype in policy["rules"]:
+        if fnmatch.fnmatchcase(name, pattern):
+            return dtype
+    return policy["fallback"].get(np.dtype(primitive).kind)
+
+
+def apply_dtype_policy(columns: dict, policy: dict) -> dict:
+    """Cast the columns (awkward or dask-awkward arrays) to the dtypes of the policy"""
+    out = {}
+    for name, array in columns.items():
+        primitive = _primitive(array)
+        dtype = column_dtype(name, primitive, policy)
+        out[name] = array if dtype is None or dtype == primitive else ak.values_astype(array, dtype)
+    return out
+
+
+def precision_report(columns: dict, policy: dict) -> list[dict]:
+    """
+    Precision loss of the policy per column
+    :param columns: {name: array} as read from a skim written without the policy (native dtypes)
+    :return: rows with the column, the dtypes, the maximum absolute and relative differences,
+        the number of values that differ and the number out of range (overflow, wrap-around or inf)
+    """
+    rows = []
+    for name, array in columns.items():
+        primitive = _primitive(array)
+        dtype = column_dtype(name, primitive, policy)
+        if dtype is None or dtype == primitive:
+            continue
+        # missing values are kept missing by the cast
+        values = np.asarray(ak.to_numpy(ak.flatten(ak.drop_none(array), axis=None)))
+
+        with np.errstate(over="ignore", invalid="ignore"):
+            finite = np.isfinite(values) if values.dtype.kind == "f" else np.ones(len(values), dtype=bool)
+            converted = values.astype(dtype)
+            back = converted.astype(np.float64)
+            ref = values.astype(np.float64)
+            if np.dtype(dtype).kind in "iu":
+                info = np.iinfo(dtype)
+                out_of_range = finite & ((ref < info.min) | (ref > info.max) | (ref != np.round(ref)))
+            else:
+                out_of_range = finite & ~np.isfinite(back)
+            diff = np.abs(back - ref)[finite & ~out_of_range]
+            rel = diff / np.maximum(np.abs(ref[finite & ~out_of_range]), np.finfo(np.float64).tiny)
+
+        rows.append(
+            {
+                "column": name,
+                "from": str(values.dtype),
+                "to": dtype,
+                "max_abs_diff": float(diff.max()) if len(diff) else 0.0,
+                "max_rel_diff": float(rel.max()) if len(rel) else 0.0,
+                "n_changed": int(np.sum(diff > 0)),
+                "n_out_of_range": int(np.sum(out_of_range)),
+                "n_values": len(values),
+            }
+        )
+    return rows
+
+
+def print_precision_report(rows: list[dict]):
+    print(f"{'column':<40} {'from':>8} {'to':>8} {'max abs':>10} {'max rel':>10} {'changed':>9} {'range':>6}")
+    for row in rows:
+        print(
+            f"{row['column']:<40} {row['from']:>8} {row['to']:>8} {row['max_abs_diff']:>10.3g} "
+            f"{row['max_rel_diff']:>10.3g} {row['n_changed']:>9} {row['n_out_of_range']:>6}"
+        )
@@ -0,0 +1,100 @@
+"""
+Vectorized evaluation of HLT paths and MET filter flags.
+
+All requested paths are read once, stacked into a single (events x paths) boolean matrix and
+reduced per group, so that a dask graph gets one layer per collection instead of one per path.
+"""
+
+from __future__ import annotations
+
+import awkward as ak
+import dask_awkward as dak
+import numpy as np
+
+
+def _evaluate_paths(collection, reference, groups, available, missing, mode):
+    """
+    Per-partition kernel: stack the available paths, reduce each group with OR/AND
+    and return the group decisions and the individual path columns.
+    Missing paths are treated as never fired.
+    """
+    false = ak.values_astype(ak.zeros_like(reference), bool)
+
+    columns = {}
+    if len(available):
+        matrix = ak.concatenate([collection[p][:, np.newaxis] for p in available], axis=1)
+        columns = {p: matrix[:, i] for i, p in enumerate(available)}
+
+    decisions = {}
+    for group, idx in groups.items():
+        if len(idx) == 0:
+            # OR of nothing never passes, AND of nothing always passes
+            decisions[group] = false if mode == "or" else ~false
+            continue
+        sub = matrix[:, list(idx)] if len(idx) < len(available) else matrix
+        decisions[group] = ak.any(sub, axis=1) if mode == "or" else ak.all(sub, axis=1)
+
+    columns.update(dict.fromkeys(missing, false))
+
+    out = {"groups": ak.zip(decisions, depth_limit=1)}
+    if columns:
+        out["paths"] = ak.zip(columns, depth_limit=1)
+    return ak.zip(out, depth_limit=1)
+
+
+class PathEvaluator:
+    """
+    Combine groups of HLT paths (OR) or MET filter flags (AND) in one pass.
+
+    Args:
+        groups (dict): {group name: list of path names without the HLT_/Flag_ prefix}
+        mode (str): "or" for triggers, "and" for filters
+    """
+
+    def __init__(self, groups: dict[str, list[str]], mode: str = "or"):
+        if mode not in ("or", "and"):
+            raise ValueError(f"Invalid mode {mode}, must be 'or' or 'and'")
+        self.groups = {g: list(paths) for g, paths in groups.items()}
+        self.mode = mode
+        self.paths = list(dict.fromkeys(p for paths in self.groups.values() for p in paths))
+        self._resolved = {}
+
+    def resolve(self, fields, key=None):
+        """
+        Split the requested paths into available/missing for a given set of branch fields.
+        Cached per key (e.g. the dataset name), since the path set only changes between datasets.
+        """
+        if key is not None and key in self._resolved:
+            return self._resolved[key]
+
+        fields = set(fields)
+        available = tuple(p for p in self.paths if p in fields)
+        missing = tuple(p for p in self.paths if p not in fields)
+        index = {p: i for i, p in enumerate(available)}
+        groups = {g: tuple(index[p] for p in paths if p in index) for g, paths in self.groups.items()}
+
+        resolved = (groups, available, missing)
+        if key is not None:
+            self._resolved[key] = resolved
+        return resolved
+
+    def __call__(self, collection, reference, key=None):
+        """
+        :param collection: events.HLT or events.Flag
+        :param reference: any flat per-event array (e.g. events.run), used for the event count
+        :param key: cache key for the resolved path set, e.g. the dataset name
+        :return: ({group: decision}, {path: boolean column})
+        """
+        groups, available, missing = self.resolve(collection.fields, key)
+
+        kwargs = {"groups": groups, "available": available, "missing": missing, "mode": self.mode}
+        if isinstance(collection, dak.Array):
+            out = dak.map_partitions(
+                _evaluate_paths, collection, reference, label=f"evaluate-paths-{self.mode}", **kwargs
+            )
+        else:
+            out = _evaluate_paths(collection, reference, **kwargs)
+
+        decisions = {g: out["groups"][g] for g in groups}
+        columns = {p: out["paths"][p] for p in self.paths}
+        return decisions, columns
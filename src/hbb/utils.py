@@ -5,15 +5,22 @@ Common functions for processors.
 from __future__ import annotations
 
 # In src/hbb/utils.py
+import json
 import pickle
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import subprocess
 
 import awkward as ak
+import fsspec
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
 from coffea.analysis_tools import PackedSelection
 
 P4 = {
@@ -61,6 +68,77 @@ def check_selector(sample: str, selector: str | list[str]):
 
     return False
 
+def skim_group(region: str) -> str:
+    """
+    Directory a region is stored in when skims are written with region flags:
+    all signal regions share the same columns and are written once as "signal"
+    """
+    return "signal" if region.startswith("signal") else region
+
+
+def region_flag(region: str) -> str:
+    """Name of the boolean column marking the events in a region, for skims written with region flags"""
+    return f"region_{region}"
+
+
+# columns written by categorizer.get_weight_factors (weight_format="factors")
+WEIGHT_FACTOR_PREFIX = "weightfactor_"
+WEIGHT_NORM_COLUMN = "weight_norm"
+
+
+def get_weight_factor_names(columns) -> list[str]:
+    """Names of the nominal weight factors stored in a factorized skim"""
+    # coffea does not allow weight names ending in Up/Down, so these are always variations
+    factors = [c[len(WEIGHT_FACTOR_PREFIX) :] for c in columns if c.startswith(WEIGHT_FACTOR_PREFIX)]
+    return [f for f in factors if not f.endswith(("Up", "Down"))]
+
+
+def get_weight_factor_columns(columns) -> list[str]:
+    """All columns needed to rebuild weights from a factorized skim"""
+    return [c for c in columns if c.startswith(WEIGHT_FACTOR_PREFIX) or c == WEIGHT_NORM_COLUMN]
+
+
+def rebuild_weight(events: pd.DataFrame, name: str, factors: list[str] = None) -> pd.Series:
+    """
+    Rebuild a weight column of the full skim format (see categorizer.get_weight_dict)
+    from the individual factors of a factorized skim.
+    :param events: DataFrame with the weightfactor_* and weight_norm columns
+    :param name: one of "weight", "weight_noxsec", "weight_nonorm_{factor}", "weight_nonorm_WITHOUT_{factor}"
+        or a systematic "{factor}Up" / "{factor}Down"
+    :param factors: nominal factor names, found from the columns if not given
+    """
+    if factors is None:
+        factors = get_weight_factor_names(events.columns)
+
+    def product(exclude=None):
+        w = pd.Series(1.0, index=events.index)
+        for f in factors:
+            if f != exclude:
+                w = w * events[f"{WEIGHT_FACTOR_PREFIX}{f}"]
+        return w
+
+    if name == "weight":
+        return product() * events[WEIGHT_NORM_COLUMN]
+    if name == "weight_noxsec":
+        return product()
+    if name.startswith("weight_nonorm_WITHOUT_"):
+        return product(exclude=name[len("weight_nonorm_WITHOUT_") :])
+    if name.startswith("weight_nonorm_"):
+        return events[f"{WEIGHT_FACTOR_PREFIX}{name[len('weight_nonorm_') :]}"]
+
+    for direction in ("Up", "Down"):
+        if name.endswith(direction) and name[: -len(direction)] in factors:
+            nominal = product() * events[WEIGHT_NORM_COLUMN]
+            modifier = f"{WEIGHT_FACTOR_PREFIX}{name}"
+            if modifier in events.columns:
+                return nominal * events[modifier]
+            # same convention as coffea Weights.partial_weight for a missing Down variation
+            if direction == "Down" and f"{WEIGHT_FACTOR_PREFIX}{name[:-4]}Up" in events.columns:
+                return nominal / events[f"{WEIGHT_FACTOR_PREFIX}{name[:-4]}Up"]
+
+    raise KeyError(f"Weight {name} can not be rebuilt from the stored weight factors")
+
+
 def accumulate(outdict, name, _in):
     if name not in outdict:
         outdict[name] = _in
@@ -68,55 +146,288 @@ def accumulate(outdict, name, _in):
         outdict[name] += _in  
     return outdict
 
-def get_sum_genweights(data_dir: Path, dataset: str, load_sys_sumweights: bool = False, scalevar_structure: str = "7pt", local_search_transfer = False) -> float:
+# PDF and QCD scale variations, stored as one fixed-size list column each (ratios to the nominal LHE weight)
+# with the sums of weights as one array, see hbb.corrections.add_pdf_weight/add_scalevar
+THEORY_COLUMNS = {"weight_pdf": 103, "weight_scalevar": 9}
+
+
+def get_legacy_theory_columns(name: str, columns) -> list:
+    """
+    Per-variation columns of skims written before the variations were stored as one column
+    (weight_pdf_{i}, weight_scalevar_{3pt,7pt}_{i}), None for the variations that are not stored
+    """
+    legacy = []
+    for i in range(THEORY_COLUMNS[name]):
+        if name == "weight_pdf":
+            candidates = [f"weight_pdf_{i}"]
+        else:
+            candidates = [f"weight_scalevar_7pt_{i}", f"weight_scalevar_3pt_{i}"]
+        legacy.append(next((c for c in candidates if c in columns), None))
+    return legacy
+
+
+def get_theory_sumw(sumw: dict, name: str) -> np.ndarray:
+    """Array of the sums of weights of the variations, from the sumw_pdf/sumw_scalevar output (any format)"""
+    key = f"sum{name}"
+    if key in sumw:
+        return np.asarray(sumw[key], dtype=np.float64)
+    return np.array(
+        [
+            sumw.get(legacy.replace("weight_", "sumweight_"), np.nan) if legacy is not None else np.nan
+            for legacy in get_legacy_theory_columns(name, [k.replace("sumweight_", "weight_") for k in sumw])
+        ]
+    )
+
+
+def list_pickles(search_path, remote: bool = False) -> dict:
+    """
+    {file name: size} of the pickles of a dataset
+    :param remote: search_path is an /eos/uscms path, listed over XRootD (e.g. on condor)
+    """
+    url = str(search_path)
+    if remote:
+        url = f"root://cmseos.fnal.gov/{url.replace('/eos/uscms', '')}"
+    fs, path = fsspec.core.url_to_fs(url)
+    if not fs.exists(path):
+        return {}
+    return {
+        Path(info["name"]).name: info["size"]
+        for info in fs.ls(path, detail=True)
+        if info["name"].endswith(".pkl")
+    }
+
+
+def sum_pickles(pickle_files, load_sys_sumweights: bool = True) -> tuple[float, dict]:
+    """
+    Sums of weights of the pickles of a dataset
+    :return: sum of genweights, and with load_sys_sumweights {"sumweight_pdf": array, "sumweight_scalevar": array}
+    """
+    total_sumw = 0
+    syst_sumw = {}
+    for pickle_file in pickle_files:
+        with Path(pickle_file).open("rb") as file:
+            out_dict = pickle.load(file)
+        # The sum of weights is stored in the "sumw" key
+        # You can access it like this:
+        for key in out_dict:
+            sumw = next(iter(out_dict[key]["nominal"]["sumw"].values()))
+        total_sumw += sumw
+
+        if load_sys_sumweights:
+            for key in out_dict:
+                sumw_pdf = get_theory_sumw(out_dict[key]["nominal"]["sumw_pdf"], "weight_pdf")
+                sumw_scalevar = get_theory_sumw(out_dict[key]["nominal"]["sumw_scalevar"], "weight_scalevar")
+            accumulate(syst_sumw, "sumweight_pdf", sumw_pdf)
+            accumulate(syst_sumw, "sumweight_scalevar", sumw_scalevar)
+    return total_sumw, syst_sumw
+
+
+# Normalization index of a skim tag: the sums of weights of every dataset, computed once from the pickles
+# and stored next to the datasets (data_dir / "sumw_index") as .npy arrays, memory-mapped when loaded,
+# with a json index {dataset: {"row": row in the arrays, "pickles": {file name: size}}}.
+# An entry is stale (and the pickles are read instead) when the pickles listed for the dataset changed.
+SUMW_INDEX_VERSION = 1
+SUMW_INDEX_DIR = "sumw_index"
+SUMW_INDEX_ARRAYS = ("sumw", "sumweight_pdf", "sumweight_scalevar")
+
+# loaded indices, by path
+_sumw_indices = {}
+_sumw_indices_lock = threading.Lock()
+
+
+def build_sumw_index(
+    data_dir: Path, datasets: list[str] = None, index_dir: Path = None, rebuild: bool = False, n_threads: int = 8
+) -> dict:
+    """
+    Write the normalization index of the datasets in data_dir
+    :param datasets: datasets to index, by default all the directories of data_dir with pickles.
+        The entries of the other datasets already in the index are kept.
+    :param index_dir: defaults to data_dir / SUMW_INDEX_DIR
+    :param rebuild: read the pickles of the datasets, instead of only those of the datasets that are missing or stale
+    :return: the index, as from load_sumw_index
+    """
+    data_dir = Path(data_dir)
+    index_dir = Path(index_dir) if index_dir else data_dir / SUMW_INDEX_DIR
+    if datasets is None:
+        datasets = sorted(d.name for d in data_dir.iterdir() if (d / "pickles").is_dir())
+
+    old = load_sumw_index(index_dir, cached=False)
+    listings = {dataset: list_pickles(data_dir / dataset / "pickles") for dataset in datasets}
+    datasets = [dataset for dataset in datasets if listings[dataset]]
+
+    def scan(dataset):
+        if not rebuild and old and old["datasets"].get(dataset, {}).get("pickles") == listings[dataset]:
+            return lookup_sumw_index(old, dataset, listings[dataset], load_sys_sumweights=True)
+        pickle_files = [data_dir / dataset / "pickles" / name for name in sorted(listings[dataset])]
+        try:
+            return sum_pickles(pickle_files, load_sys_sumweights=True)
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError) as e:
+            warnings.warn(f"Error reading the pickles of {dataset}: {e!r}. Not indexed.", stacklevel=2)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as pool:
+        sums = dict(zip(datasets, pool.map(scan, datasets)))
+    sums = {dataset: entry for dataset, entry in sums.items() if entry is not None}
+
+    # entries of the datasets not scanned are kept as they are
+    if old:
+        for dataset, entry in old["datasets"].items():
+            if dataset not in sums:
+                sums[dataset] = lookup_sumw_index(old, dataset, entry["pickles"], load_sys_sumweights=True)
+                listings[dataset] = entry["pickles"]
+    datasets = sorted(sums)
+
+    arrays = {
+        "sumw": np.array([sums[dataset][0] for dataset in datasets], dtype=np.float64),
+        **{
+            name: np.array(
+                [sums[dataset][1][name] for dataset in datasets], dtype=np.float64
+            ).reshape(len(datasets), THEORY_COLUMNS[name.replace("sumweight_", "weight_")])
+            for name in SUMW_INDEX_ARRAYS[1:]
+        },
+    }
+    index = {
+        "version": SUMW_INDEX_VERSION,
+        "datasets": {dataset: {"row": row, "pickles": listings[dataset]} for row, dataset in enumerate(datasets)},
+    }
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    # the arrays are written before the json, which is what readers open first
+    for name, array in arrays.items():
+        tmp = index_dir / f"{name}.tmp.npy"
+        np.save(tmp, array)
+        tmp.replace(index_dir / f"{name}.npy")
+    tmp = index_dir / "index.json.tmp"
+    with tmp.open("w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    tmp.replace(index_dir / "index.json")
+
+    with _sumw_indices_lock:
+        _sumw_indices.pop(str(index_dir), None)
+    return {**index, **arrays}
+
+
+def load_sumw_index(index_dir: Path, local_search_transfer: bool = False, cached: bool = True) -> dict:
+    """
+    Load a normalization index, with the arrays memory-mapped
+    :param local_search_transfer: copy the index from EOS first (once per process, until a transfer succeeds)
+    :param cached: reuse the index already loaded by this process
+    :return: {"version", "datasets", "sumw", "sumweight_pdf", "sumweight_scalevar"}, None if there is no valid index
+    """
+    key = str(index_dir)
+    with _sumw_indices_lock:
+        if cached and key in _sumw_indices:
+            return _sumw_indices[key]
+
+        search_path = Path(index_dir)
+        if local_search_transfer:
+            local_dir = Path("./local_sumw_index/")
+            if local_dir.is_dir():
+                subprocess.run(["rm", "-r", str(local_dir)])
+            xrd_path = str(search_path).replace("/eos/uscms", "")
+            if not xrdcp_to_local(xrd_path, local_dir, missing_ok=True):
+                # not cached: the transfer is tried again by the next dataset (e.g. a transient XRootD error)
+                return None
+            search_path = local_dir / search_path.name
+
+        index = None
+        try:
+            with (search_path / "index.json").open() as f:
+                index = json.load(f)
+            if index.get("version") != SUMW_INDEX_VERSION:
+                print(f"Ignoring normalization index {index_dir} with version {index.get('version')}")
+                index = None
+            else:
+                for name in SUMW_INDEX_ARRAYS:
+                    index[name] = np.load(search_path / f"{name}.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            index = None
+
+        if cached:
+            _sumw_indices[key] = index
+        return index
+
+
+def lookup_sumw_index(index: dict, dataset: str, pickles: dict, load_sys_sumweights: bool = False):
+    """
+    Sums of weights of a dataset from a normalization index, as from get_sum_genweights
+    :param pickles: current {file name: size} of the pickles of the dataset (see list_pickles)
+    :return: (sumw, syst_sumw), None if the dataset is not in the index or its entry is stale
+    """
+    entry = index["datasets"].get(dataset)
+    if entry is None:
+        return None
+    if entry["pickles"] != pickles:
+        warnings.warn(
+            f"Stale normalization index entry for {dataset} (its pickles changed), "
+            "reading the pickles. Rebuild the index with src/build_sumw_index.py",
+            category=UserWarning,
+            stacklevel=2,
+        )
+        return None
+
+    row = entry["row"]
+    syst_sumw = {}
+    if load_sys_sumweights:
+        syst_sumw = {name: np.array(index[name][row]) for name in SUMW_INDEX_ARRAYS[1:]}
+    return float(index["sumw"][row]), syst_sumw
+
+
+def get_sum_genweights(
+    data_dir: Path,
+    dataset: str,
+    load_sys_sumweights: bool = False,
+    local_search_transfer=False,
+    local_dir: Path = Path("./local_pickle/"),
+    use_sumw_index: bool = True,
+    sumw_index_dir: Path = None,
+) -> float:
     """
     Get the sum of genweights for a given dataset.
     :param data_dir: The directory where the datasets are stored.
     :param dataset: The name of the dataset to get the genweights for.
-    :return: The sum of genweights for the dataset.
+    :param local_dir: Where the pickles are copied to with local_search_transfer.
+    :param use_sumw_index: Take the sums from the normalization index (see build_sumw_index) if it is up to date,
+        instead of reading the pickles.
+    :param sumw_index_dir: Location of the normalization index, defaults to data_dir / SUMW_INDEX_DIR
+    :return: The sum of genweights for the dataset, and with load_sys_sumweights,
+        the sums of weights of the theory variations as {"sumweight_pdf": array, "sumweight_scalevar": array}
     """
     total_sumw = 0
     syst_sumw = {}
+    search_path = Path(data_dir / dataset / "pickles")
 
-    scalevar_map = {
-        "3pt" : [0, 4, 8],             # case where muF^2 = muR^2
-        "7pt" : [0, 1, 3, 4, 5, 7, 8]  # case where muF = muR 
-    }
+    if use_sumw_index:
+        try:
+            index = load_sumw_index(
+                Path(sumw_index_dir) if sumw_index_dir else Path(data_dir) / SUMW_INDEX_DIR, local_search_transfer
+            )
+            if index is not None:
+                # listing the pickles is much cheaper than copying and reading them
+                pickles = list_pickles(search_path, remote=local_search_transfer)
+                entry = lookup_sumw_index(index, dataset, pickles, load_sys_sumweights)
+                if entry is not None:
+                    return entry
+        except (OSError, ValueError, KeyError) as e:
+            # e.g. a transient XRootD error: the pickles are read instead
+            warnings.warn(
+                f"Error reading the normalization index for {dataset}: {e!r}. Reading the pickles.",
+                category=UserWarning,
+                stacklevel=2,
+            )
 
     try:
         # Load the genweights from the pickle file
-        search_path = Path(data_dir / dataset / "pickles")
         if local_search_transfer:
-            if Path("./local_pickle/").is_dir():
-                subprocess.run(["rm", "-r", "./local_pickle/"])
+            if Path(local_dir).is_dir():
+                subprocess.run(["rm", "-r", str(local_dir)])
             xrd_path = str(search_path).replace("/eos/uscms", "")
-            copied = xrdcp_to_local(xrd_path, "./local_pickle/")
-            search_path = Path("local_pickle/pickles")
+            copied = xrdcp_to_local(xrd_path, local_dir)
+            search_path = Path(local_dir) / "pickles"
             if not copied:
                 return None
 
-        for pickle_file in list(search_path.glob("*.pkl")):
-            with Path(pickle_file).open("rb") as file:
-                out_dict = pickle.load(file)
-            # The sum of weights is stored in the "sumw" key
-            # You can access it like this:
-            for key in out_dict:
-                sumw = next(iter(out_dict[key]["nominal"]["sumw"].values()))
-            total_sumw += sumw
-
-            if load_sys_sumweights:
-                for i in range(103):
-                    for key in out_dict:
-
-                        n_sumw = f"sumweight_pdf_{i}"
-                        sumw = out_dict[key]["nominal"]["sumw_pdf"][n_sumw]
-                    accumulate(syst_sumw, n_sumw, sumw)
-
-                for i in scalevar_map[scalevar_structure]:
-                    for key in out_dict:
-                        n_sumw = f"sumweight_scalevar_{scalevar_structure}_{i}"
-                        sumw = out_dict[key]["nominal"]["sumw_scalevar"][n_sumw]
-                    accumulate(syst_sumw, n_sumw, sumw)
+        total_sumw, syst_sumw = sum_pickles(list(search_path.glob("*.pkl")), load_sys_sumweights)
 
     except:
         warnings.warn(
@@ -129,6 +440,252 @@ def get_sum_genweights(data_dir: Path, dataset: str, load_sys_sumweights: bool =
     return total_sumw, syst_sumw
 
 
+def _theory_matrix_from_arrow(column) -> np.ndarray:
+    """(events, variations) matrix of a fixed-size list column of an Arrow table"""
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    return column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), column.type.list_size)
+
+
+def _theory_column_to_arrow(matrix: np.ndarray) -> pa.FixedSizeListArray:
+    return pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel()), matrix.shape[1])
+
+
+# returned by _load_dataset when the transfer of the skims from EOS fails
+_TRANSFER_FAILED = object()
+
+
+def _dataset_files(
+    data_dir: Path, dataset: str, region_dir: str, variation: str, local_search_transfer: bool
+):
+    """
+    Parquet files of a dataset, copied from EOS first with local_search_transfer
+    :return: the directory searched and the files, or _TRANSFER_FAILED
+    """
+    search_path = Path(data_dir / dataset / "parquet" / "nominal" / region_dir)
+    if variation:
+        search_path = Path(data_dir / dataset /  "parquet" / variation / region_dir)
+
+    if local_search_transfer:
+        # one local directory per dataset, as datasets are loaded concurrently
+        local_parquet = Path(f"./local_parquet/{dataset}/")
+        if local_parquet.is_dir():
+            subprocess.run(["rm", "-r", str(local_parquet)])
+        xrd_path = str(search_path).replace("/eos/uscms", "")
+        copied = xrdcp_to_local(xrd_path, local_parquet)
+        if not copied:
+            return _TRANSFER_FAILED
+        search_path = local_parquet / region_dir
+
+    print(f"\n[DEBUG] Script is searching in path: {search_path}\n")
+    # Use os.listdir() which can be more robust on network filesystems
+    if search_path.exists():
+        file_list = [f for f in search_path.iterdir() if f.name.endswith(".parquet")]
+    else:
+        print(f"[DEBUG] Path does not exist: {search_path}")
+        file_list = []
+    return search_path, file_list
+
+
+def _read_plan(schema_names: list[str], columns_to_load: list[str]) -> dict:
+    """
+    Columns to read from the skims to return columns_to_load:
+    {"columns": requested, "read": read, "rebuild": weights to rebuild, "legacy_theory": {name: legacy columns}}
+    """
+    # skims with factorized weights: read the factors instead of the weight columns
+    # that are not stored, and rebuild only those requested
+    read_columns, rebuild_columns = columns_to_load, []
+
+    # older skims store one column per theory variation, combined here into one column
+    legacy_theory = {}
+    if columns_to_load is not None:
+        for name in THEORY_COLUMNS:
+            if name in columns_to_load and name not in schema_names:
+                legacy_theory[name] = get_legacy_theory_columns(name, schema_names)
+        if legacy_theory:
+            legacy_columns = [c for cols in legacy_theory.values() for c in cols if c is not None]
+            columns_to_load = [c for c in columns_to_load if c not in legacy_theory]
+            read_columns = columns_to_load + legacy_columns
+
+    if columns_to_load is not None and WEIGHT_NORM_COLUMN in schema_names:
+        rebuild_columns = [c for c in columns_to_load if c not in schema_names]
+        if rebuild_columns:
+            read_columns = [c for c in read_columns if c in schema_names]
+            read_columns += [c for c in get_weight_factor_columns(schema_names) if c not in read_columns]
+
+    return {
+        "columns": columns_to_load,
+        "read": read_columns,
+        "rebuild": rebuild_columns,
+        "legacy_theory": legacy_theory,
+        "schema_names": schema_names,
+    }
+
+
+def _complete_table(events: pa.Table, plan: dict) -> pa.Table:
+    """Rebuild the weights and theory columns of a table read with a _read_plan"""
+    # the pandas index of the skims (if any) is not read
+    events = events.replace_schema_metadata(None)
+    schema_names, columns_to_load = plan["schema_names"], plan["columns"]
+
+    if plan["rebuild"]:
+        factors_df = events.select(get_weight_factor_columns(schema_names)).to_pandas()
+        factors = get_weight_factor_names(schema_names)
+        for column in plan["rebuild"]:
+            events = events.append_column(column, pa.array(rebuild_weight(factors_df, column, factors).to_numpy()))
+
+    for name, legacy in plan["legacy_theory"].items():
+        matrix = np.full((len(events), len(legacy)), np.nan)
+        for i, column in enumerate(legacy):
+            if column is not None:
+                matrix[:, i] = events[column].to_numpy()
+        events = events.append_column(name, _theory_column_to_arrow(matrix))
+        columns_to_load = [*columns_to_load, name]
+
+    if plan["rebuild"] or plan["legacy_theory"]:
+        events = events.drop_columns([c for c in plan["read"] if c not in columns_to_load])
+    return events
+
+
+def _normalization(
+    data_dir: Path,
+    process: str,
+    dataset: str,
+    load_sys_sumweights: bool,
+    local_search_transfer: bool,
+    use_sumw_index: bool,
+    sumw_index_dir: Path,
+):
+    """Sums of weights to normalize a dataset with, None for data"""
+    if "data" in process:
+        return None
+    local_pickle = Path(f"./local_pickle/{dataset}/")
+    sum_genweights, syst_sumweights = get_sum_genweights(
+        data_dir,
+        dataset,
+        load_sys_sumweights,
+        local_search_transfer,
+        local_dir=local_pickle,
+        use_sumw_index=use_sumw_index,
+        sumw_index_dir=sumw_index_dir,
+    )
+    print(f"Using sum_genweights for {dataset}: {sum_genweights}")
+    if load_sys_sumweights:
+        missing = [f"sum{name}" for name in THEORY_COLUMNS if f"sum{name}" not in syst_sumweights]
+        if missing:
+            # e.g. the pickles could not be read: the theory variations are left unnormalized
+            warnings.warn(
+                f"No {', '.join(missing)} for dataset {dataset}. The theory variations are not normalized.",
+                category=UserWarning,
+                stacklevel=3,
+            )
+    return sum_genweights, syst_sumweights
+
+
+def _normalize_table(events: pa.Table, normalization, load_sys_sumweights: bool) -> pa.Table:
+    """Add the weight_nonorm, finalWeight (and sum_genWeight) columns"""
+    weight = pc.cast(events["weight"], pa.float64())
+    if normalization is not None:
+        # For MC datasets, we need to normalize the weights
+        sum_genweights, syst_sumweights = normalization
+
+        events = events.append_column("weight_nonorm", events["weight"])
+        events = events.append_column("finalWeight", pc.divide(weight, float(sum_genweights)))
+        events = events.append_column("sum_genWeight", pa.array(np.full(len(events), float(sum_genweights))))
+
+        if load_sys_sumweights:
+            # normalize the variations to the sum of weights of the dataset:
+            # divide by the mean ratio sum(w * ratio_i) / sum(w)
+            for name in THEORY_COLUMNS:
+                if name in events.column_names and f"sum{name}" in syst_sumweights:
+                    ratio = syst_sumweights[f"sum{name}"] / sum_genweights
+                    normalized = _theory_matrix_from_arrow(events[name]) / ratio
+                    events = events.set_column(
+                        events.column_names.index(name), name, _theory_column_to_arrow(normalized)
+                    )
+    else:
+        # For data, we just keep the weight as is
+        events = events.append_column("weight_nonorm", events["weight"])
+        events = events.append_column("finalWeight", weight)
+    return events
+
+
+def _load_dataset(
+    data_dir: Path,
+    process: str,
+    dataset: str,
+    columns_to_load: list[str],
+    region: str,
+    region_dir: str,
+    filters: list,
+    variation: str,
+    load_sys_sumweights: bool,
+    local_search_transfer: bool,
+    use_sumw_index: bool,
+    sumw_index_dir: Path,
+):
+    """
+    Load one dataset of load_samples as an Arrow table, with the normalization columns
+    :return: the table, None if the dataset is skipped, or _TRANSFER_FAILED
+    """
+    # Uncomment to debug
+    # print(f"Loading dataset: {dataset}")
+    # print(f"Columns to load: {columns_to_load}")
+
+    try:
+        files = _dataset_files(data_dir, dataset, region_dir, variation, local_search_transfer)
+        if files is _TRANSFER_FAILED:
+            return _TRANSFER_FAILED
+        search_path, file_list = files
+
+        # If no files were found, skip to the next dataset
+        if not file_list:
+            warnings.warn(
+                f"No parquet files found in {search_path}. Skipping dataset {dataset}.",
+                stacklevel=3,
+            )
+            return None
+
+        dataset_files = pds.dataset([str(f) for f in file_list], format="parquet")
+        plan = _read_plan(dataset_files.schema.names, columns_to_load)
+
+        # column projection and predicate pushdown: only the requested columns of the selected rows are read
+        events = dataset_files.to_table(
+            columns=plan["read"],
+            filter=pq.filters_to_expression(filters) if filters else None,
+        )
+        events = _complete_table(events, plan)
+
+    except pa.lib.ArrowInvalid as e:
+        warnings.warn(f"ArrowInvalid error: {e}. Skipping dataset {dataset}.", stacklevel=3)
+        print("List of columns attempted to load: ", columns_to_load)
+        print(
+            "List of files available: ",
+            list(Path(data_dir / dataset / "parquet").glob(f"{region}*.parquet")),
+        )
+        return None
+    except:
+        print(f"Error loading dataset: {dataset}. Skipping.")
+        print(
+            "List of files available: ",
+            list(Path(data_dir / dataset / "parquet").glob(f"{region}*.parquet")),
+        )
+        return None
+
+    normalization = _normalization(
+        data_dir,
+        process,
+        dataset,
+        load_sys_sumweights,
+        local_search_transfer,
+        use_sumw_index,
+        sumw_index_dir,
+    )
+    events = _normalize_table(events, normalization, load_sys_sumweights)
+
+    print(f"Loaded {dataset: <50}: {len(events)} entries")
+    return events
+
+
 def load_samples(
     data_dir: Path,
     samples: dict[str, str],
@@ -138,8 +695,12 @@ def load_samples(
     filters: list[tuple[str, str, str]] = None,
     variation: str = None,
     load_sys_sumweights: bool = False,
-    scalevar_structure: str = "7pt",
-    local_search_transfer = False
+    local_search_transfer = False,
+    region_flags: bool = False,
+    max_in_flight: int = 4,
+    output_format: str = "pandas",
+    use_sumw_index: bool = True,
+    sumw_index_dir: Path = None,
 ) -> dict[str, pd.DataFrame]:
     """
     Load samples from a specified directory and return them as a dictionary.
@@ -149,110 +710,59 @@ def load_samples(
     :param region: The region to load the parquets from (e.g., "signal-all")
     :param extra_columns: A dictionary where keys are dataset names and values are lists of additional columns to load for that dataset.
     :param filters: A list of filters to apply when loading the datasets.
-    :return: A dictionary with dataset/sample names as keys and DataFrames as values.
+    :param region_flags: The skims were written with one directory per skim group and a boolean column per region
+        (categorizer skim_region_flags). The region is then selected with a filter on its flag column.
+    :param max_in_flight: Maximum number of datasets read at the same time, bounds the peak memory of the reads.
+    :param output_format: "pandas" for DataFrames, or "arrow" for pyarrow Tables (no conversion copy)
+    :param use_sumw_index: Normalize with the sums of weights of the normalization index (see build_sumw_index)
+        when it is up to date, instead of reading the pickles of every dataset.
+    :param sumw_index_dir: Location of the normalization index, defaults to data_dir / SUMW_INDEX_DIR
+    :return: A dictionary with dataset/sample names as keys and DataFrames (or Tables) as values.
     """
-    events_dict = {}
-    for process, datasets in samples.items():
-        events_list = []
-        for dataset in datasets:
-            columns_to_load = columns
-            if extra_columns and dataset in extra_columns:
-                columns_to_load += extra_columns[dataset]
-
-            # Uncomment to debug
-            # print(f"Loading dataset: {dataset}")
-            # print(f"Looking in: {data_dir / dataset / 'parquet' / f'{region}*.parquet'}")
-            # print(list(Path(data_dir / dataset / "parquet").glob(f'{region}*.parquet')))
-            # print(f"Columns to load: {columns_to_load}")
-
-            search_path = Path(data_dir / dataset / "parquet" / "nominal" / region)
-            if variation:
-                search_path = Path(data_dir / dataset /  "parquet" / variation / region)
-
-            if local_search_transfer:
-                if Path("./local_parquet/").is_dir():
-                    subprocess.run(["rm", "-r", "./local_parquet/"])
-                xrd_path = str(search_path).replace("/eos/uscms", "")
-                copied = xrdcp_to_local(xrd_path, "./local_parquet/")
-                if not copied:
-                    return None
-                search_path = Path(f"./local_parquet/{region}")
-
-            print(f"\n[DEBUG] Script is searching in path: {search_path}\n")
-            # --- REPLACE THE OLD 'try' BLOCK WITH THIS ---
-            try:
-                # Use os.listdir() which can be more robust on network filesystems
-                if search_path.exists():
-                    file_list = [f for f in search_path.iterdir() if f.name.endswith(".parquet")]
-                    # print(f"[DEBUG] Found files with os.listdir: {file_list}")
-                else:
-                    print(f"[DEBUG] Path does not exist: {search_path}")
-                    file_list = []
-
-                # If no files were found, skip to the next dataset
-                if not file_list:
-                    warnings.warn(
-                        f"No parquet files found in {search_path}. Skipping dataset {dataset}.",
-                        stacklevel=2,
-                    )
-                    continue
-
-                events = pd.read_parquet(
-                    file_list,
-                    filters=filters,
-                    columns=columns_to_load,
-                )
-            # --- END REPLACEMENT ---
-
-            # try:
-            # Load the dataset into a DataFrame
-            #    events = pd.read_parquet(
-            #        list(Path(data_dir / dataset / "parquet").glob(f"{region}*.parquet")),
-            #        filters=filters,
-            #        columns=columns_to_load,
-            #    )
-            except pa.lib.ArrowInvalid as e:
-                warnings.warn(f"ArrowInvalid error: {e}. Skipping dataset {dataset}.", stacklevel=2)
-                print("List of columns attempted to load: ", columns_to_load)
-                print(
-                    "List of files available: ",
-                    list(Path(data_dir / dataset / "parquet").glob(f"{region}*.parquet")),
-                )
-                continue
-            except:
-                print(f"Error loading dataset: {dataset}. Skipping.")
-                print(
-                    "List of files available: ",
-                    list(Path(data_dir / dataset / "parquet").glob(f"{region}*.parquet")),
+    if output_format not in ("pandas", "arrow"):
+        raise ValueError(f"Invalid output format {output_format}, must be 'pandas' or 'arrow'")
+
+    region_dir = region
+    if region_flags:
+        region_dir = skim_group(region)
+        filters = [*(filters or []), (region_flag(region), "==", True)]
+
+    # the datasets are read concurrently (the parquet decoding and the I/O release the GIL)
+    with ThreadPoolExecutor(max_workers=max(max_in_flight, 1)) as pool:
+        futures = {}
+        for process, datasets in samples.items():
+            for dataset in datasets:
+                columns_to_load = columns
+                if extra_columns and dataset in extra_columns:
+                    columns_to_load = [*columns, *extra_columns[dataset]]
+                futures[process, dataset] = pool.submit(
+                    _load_dataset,
+                    data_dir,
+                    process,
+                    dataset,
+                    columns_to_load,
+                    region,
+                    region_dir,
+                    filters,
+                    variation,
+                    load_sys_sumweights,
+                    local_search_transfer,
+                    use_sumw_index,
+                    sumw_index_dir,
                 )
-                continue
+        results = {key: future.result() for key, future in futures.items()}
 
-            if "data" not in process:
-                # For MC datasets, we need to normalize the weights
-                sum_genweights, syst_sumweights = get_sum_genweights(data_dir, dataset, load_sys_sumweights, scalevar_structure, local_search_transfer)
-                print(f"Using sum_genweights for {dataset}: {sum_genweights}")
+    if any(result is _TRANSFER_FAILED for result in results.values()):
+        return None
 
-                events["weight_nonorm"] = events["weight"]
-                events["finalWeight"] = events["weight"] / sum_genweights
-                events["sum_genWeight"] = sum_genweights
-
-                if load_sys_sumweights:
-                    for n_sumw in syst_sumweights:
-                        events[n_sumw] = syst_sumweights[n_sumw]
-            else:
-                # For data, we just keep the weight as is
-                events["weight_nonorm"] = events["weight"]
-                events["finalWeight"] = events["weight"]
-
-            # Add the DataFrame to the dictionary with the dataset name as the key
-            events_list.append(events)
-            print(f"Loaded {dataset: <50}: {len(events)} entries")
-
-        # Combine all DataFrames for the process/sample
-        # print(events_list)
+    events_dict = {}
+    for process, datasets in samples.items():
+        tables = [results[process, dataset] for dataset in datasets if results[process, dataset] is not None]
 
-        if events_list:
-            events_dict[process] = pd.concat(events_list)
+        if tables:
+            # concatenating Arrow tables does not copy the data, the only copy is the conversion to pandas
+            events = pa.concat_tables(tables, promote_options="permissive")
+            events_dict[process] = events.to_pandas() if output_format == "pandas" else events
         else:
             warnings.warn(
                 f"No valid events loaded for process {process}.", category=UserWarning, stacklevel=2
@@ -260,6 +770,76 @@ def load_samples(
 
     return events_dict
 
+def iter_sample_batches(
+    data_dir: Path,
+    process: str,
+    dataset: str,
+    columns: list[str],
+    region: str,
+    filters: list[tuple[str, str, str]] = None,
+    variation: str = None,
+    load_sys_sumweights: bool = False,
+    local_search_transfer = False,
+    region_flags: bool = False,
+    batch_size: int = 100_000,
+    output_format: str = "pandas",
+    use_sumw_index: bool = True,
+    sumw_index_dir: Path = None,
+):
+    """
+    Iterate over the events of a dataset in batches of at most batch_size rows, normalized as in load_samples.
+    Only one batch is read ahead, so the memory use is bounded by the batch size instead of the dataset size.
+    :param process: Process name of the dataset (data is not normalized).
+    :param output_format: "pandas" for DataFrames, or "arrow" for pyarrow Tables
+    :return: Generator of the batches, which yields nothing if the dataset can not be read.
+    Other parameters as in load_samples.
+    """
+    if output_format not in ("pandas", "arrow"):
+        raise ValueError(f"Invalid output format {output_format}, must be 'pandas' or 'arrow'")
+
+    region_dir = region
+    if region_flags:
+        region_dir = skim_group(region)
+        filters = [*(filters or []), (region_flag(region), "==", True)]
+
+    files = _dataset_files(data_dir, dataset, region_dir, variation, local_search_transfer)
+    if files is _TRANSFER_FAILED:
+        return
+    search_path, file_list = files
+    if not file_list:
+        warnings.warn(f"No parquet files found in {search_path}. Skipping dataset {dataset}.", stacklevel=2)
+        return
+
+    dataset_files = pds.dataset([str(f) for f in file_list], format="parquet")
+    plan = _read_plan(dataset_files.schema.names, columns)
+    normalization = _normalization(
+        data_dir,
+        process,
+        dataset,
+        load_sys_sumweights,
+        local_search_transfer,
+        use_sumw_index,
+        sumw_index_dir,
+    )
+
+    n_events = 0
+    for batch in dataset_files.to_batches(
+        columns=plan["read"],
+        filter=pq.filters_to_expression(filters) if filters else None,
+        batch_size=batch_size,
+        batch_readahead=1,
+        fragment_readahead=1,
+    ):
+        if batch.num_rows == 0:
+            continue
+        events = _complete_table(pa.Table.from_batches([batch]), plan)
+        events = _normalize_table(events, normalization, load_sys_sumweights)
+        n_events += len(events)
+        yield events.to_pandas() if output_format == "pandas" else events
+
+    print(f"Loaded {dataset: <50}: {n_events} entries")
+
+
 def xrdcp_to_local(eos_path, local_dir, missing_ok = True):
     Path(local_dir).mkdir(parents=True, exist_ok=True)
     cmd = [
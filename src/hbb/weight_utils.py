@@ -0,0 +1,69 @@
+"""
+Products of event weight factors for the skims.
+
+The nominal weight, the weight without each factor (leave-one-out) and every systematic
+variation are computed in a single pass with prefix/suffix products, i.e. in O(N_weights)
+multiplications instead of one partial_weight call (O(N_weights) each) per output column.
+"""
+
+from __future__ import annotations
+
+import awkward as ak
+import dask_awkward as dak
+
+
+def _weight_products(*arrays, n_factors, variations):
+    """
+    Per-partition kernel.
+    :param arrays: the n_factors nominal factors, followed by the variation ratios
+    :param variations: tuple of (factor index, invert) for each variation ratio
+    """
+    factors = arrays[:n_factors]
+    ratios = arrays[n_factors:]
+    ones = ak.ones_like(factors[0], dtype=float)
+
+    # prefix[i] = f_0 * ... * f_{i-1}, suffix[i] = f_i * ... * f_{n-1}
+    prefix = [ones]
+    for f in factors:
+        prefix.append(prefix[-1] * f)
+    suffix = [ones]
+    for f in reversed(factors):
+        suffix.append(suffix[-1] * f)
+    suffix = suffix[::-1]
+
+    nominal = prefix[n_factors]
+    out = {"nominal": nominal}
+    for i in range(n_factors):
+        out[f"without{i}"] = prefix[i] * suffix[i + 1]
+    for j, ((_, invert), ratio) in enumerate(zip(variations, ratios)):
+        # a missing Down variation is taken as nominal / Up, as in coffea Weights.partial_weight
+        out[f"variation{j}"] = nominal / ratio if invert else nominal * ratio
+
+    return ak.zip(out, depth_limit=1)
+
+
+def weight_products(factors: dict, variations: dict) -> tuple[ak.Array, dict, dict]:
+    """
+    Compute all the weight products needed for the skims at once.
+
+    Args:
+        factors (dict): {name: nominal weight factor}
+        variations (dict): {variation name: (factor name, ratio to the nominal factor, invert)}
+
+    Returns:
+        nominal product, {name: product of all factors but name}, {variation name: varied product}
+    """
+    names = list(factors)
+    index = {name: i for i, name in enumerate(names)}
+    spec = tuple((index[factor], invert) for factor, _, invert in variations.values())
+    arrays = [factors[name] for name in names] + [ratio for _, ratio, _ in variations.values()]
+
+    kwargs = {"n_factors": len(names), "variations": spec}
+    if any(isinstance(a, dak.Array) for a in arrays):
+        out = dak.map_partitions(_weight_products, *arrays, label="weight-products", **kwargs)
+    else:
+        out = _weight_products(*arrays, **kwargs)
+
+    without = {name: out[f"without{i}"] for i, name in enumerate(names)}
+    varied = {var: out[f"variation{j}"] for j, var in enumerate(variations)}
+    return out["nominal"], without, varied
@@ -5,19 +5,141 @@ Runs a coffea processors on a single file or a set of files (ONLY for testing)
 from __future__ import annotations
 
 import argparse
+import os
 import pickle
 import shutil
+import tempfile
+import time
+import warnings
 from pathlib import Path
 
 import dask
+import dask_awkward as dak
 import uproot
 import yaml
 from coffea import nanoevents
 from coffea.dataset_tools import apply_to_fileset, max_chunks, preprocess
 
+from hbb.chunking import (
+    choose_step_size,
+    load_chunk_sizes,
+    measure_chunk,
+    probe_dataset,
+    rechunk_dataset,
+    save_chunk_sizes,
+)
+from hbb.graph_utils import (
+    check_graph_budget,
+    graph_report,
+    graph_size,
+    print_graph_report,
+)
+from hbb.nano_branches import check_necessary_columns, summarize_read_report
+from hbb.parquet_utils import compact_parquet
+from hbb.preprocess_cache import PreprocessCache, cached_preprocess
 from hbb.run_utils import get_dataset_spec, get_fileset
 from hbb.xsecs import xsecs
 
+apply_uproot_options = {
+    "allow_read_errors_with_report": (OSError, KeyError),
+    "xrootd_handler": uproot.source.xrootd.MultithreadedXRootDSource,
+    "timeout": 1800,
+}
+
+
+def get_processor(year: str, args: argparse.Namespace, skim_outpath: str):
+    # TODO: customize processor
+    from hbb.processors import categorizer
+
+    return categorizer(
+        xsecs=xsecs,
+        year=year,
+        nano_version=args.nano_version,
+        save_skim=args.save_skim,
+        evaluate_BDT=args.BDT,
+        skim_outpath=skim_outpath,
+        btag_eff=args.btag_eff,
+        save_skim_nosysts=args.save_skim_nosysts,
+        skim_region_flags=args.skim_region_flags,
+        weight_format=args.weight_format,
+        skim_dtypes=args.skim_dtypes,
+        pdf_dtype=args.pdf_dtype,
+    )
+
+
+def cap_chunks(preprocessed: dict, n_chunks: int) -> dict:
+    """
+    Keep only the first n_chunks chunks of each file (coffea max_chunks), with a warning for every
+    dataset that loses events
+    """
+    capped = max_chunks(preprocessed, n_chunks)
+    for dataset, dataset_spec in preprocessed.items():
+        n_before = sum(len(f.get("steps") or []) for f in dataset_spec["files"].values())
+        n_after = sum(len(f.get("steps") or []) for f in capped[dataset]["files"].values())
+        if n_after < n_before:
+            warnings.warn(
+                f"{dataset}: only {n_after} of {n_before} chunks are processed (--max-chunks {n_chunks})",
+                stacklevel=2,
+            )
+    return capped
+
+
+def tune_step_sizes(preprocessed: dict, year: str, args: argparse.Namespace) -> dict:
+    """
+    Choose the step size of each dataset from the memory and time per event of a probe chunk,
+    and rechunk the preprocessed fileset accordingly.
+    Measurements are read from (and new ones saved to) args.chunk_size_file.
+    """
+    stored = {} if args.retune_chunks else load_chunk_sizes(args.chunk_size_file)
+    concurrency = dask.config.get("num_workers", None) or os.cpu_count() or 1
+
+    measured = {}
+    tuned = {}
+    for dataset, dataset_spec in preprocessed.items():
+        measurement = stored.get(dataset)
+        if measurement is None:
+            probe, n_events = probe_dataset(dataset_spec, args.probe_events)
+            # the probe writes its skims to a temporary directory, discarded afterwards
+            probe_dir = Path(tempfile.mkdtemp(prefix="probe_", dir=Path().resolve()))
+            probe_p = get_processor(year, args, skim_outpath=str(probe_dir))
+
+            def probe_graph(spec, dataset=dataset, probe_p=probe_p):
+                return apply_to_fileset(
+                    data_manipulation=probe_p,
+                    fileset={dataset: spec},
+                    schemaclass=nanoevents.NanoAODSchema,
+                    uproot_options=apply_uproot_options,
+                )
+
+            # the first chunk also loads the corrections and models, which is not per-event work
+            warmup, _ = probe_dataset(dataset_spec, max(args.probe_events // 10, 100))
+            dask.compute(*probe_graph(warmup))
+            # building the graph (all shifts and regions) is a fixed cost: only the compute is measured
+            graph = probe_graph(probe)
+            measurement = measure_chunk(lambda graph=graph: dask.compute(*graph), n_events)
+            shutil.rmtree(probe_dir)
+            measured[dataset] = measurement
+
+        step_size = choose_step_size(
+            measurement,
+            memory_target=args.memory_target * 1e9,
+            target_time=args.target_chunk_time,
+            concurrency=concurrency,
+            min_step=args.min_step_size,
+            max_step=args.max_step_size,
+        )
+        measurement["step_size"] = step_size
+        print(
+            f"{dataset}: {measurement['mem_per_event'] / 1e3:.1f} kB/event, "
+            f"{measurement['time_per_event'] * 1e3:.2f} ms/event -> step size {step_size}"
+        )
+        tuned[dataset] = rechunk_dataset(dataset_spec, step_size)
+
+    if measured:
+        save_chunk_sizes(args.chunk_size_file, measured)
+        print("Saved chunk size measurements to ", args.chunk_size_file)
+    return tuned
+
 
 def run(year: str, fileset: dict, args: argparse.Namespace):
     """Run processor without fancy dask (outputs then need to be accumulated manually)"""
@@ -59,53 +181,98 @@ def run(year: str, fileset: dict, args: argparse.Namespace):
         dict_process_files = get_dataset_spec(fileset)
 
     # Use preprocess from coffea
-    preprocessed_available, preprocessed_total = preprocess(
-        dict_process_files,
-        align_clusters=True,
-        skip_bad_files=True,
-        recalculate_steps=False,
-        files_per_batch=1,
-        file_exceptions=(OSError,),
-        step_size=20_000,
-        save_form=False,
-        uproot_options={
+    preprocess_kwargs = {
+        "align_clusters": True,
+        "skip_bad_files": True,
+        "recalculate_steps": False,
+        "files_per_batch": 1,
+        "file_exceptions": (OSError,),
+        "step_size": args.step_size,
+        # with a cache, the forms are stored too so that the jobs do not open a file to get them
+        "save_form": args.preprocess_cache is not None,
+        "uproot_options": {
             "xrootd_handler": uproot.source.xrootd.MultithreadedXRootDSource,
             "allow_read_errors_with_report": True,
         },
-        step_size_safety_factor=0.5,
-    )
+        "step_size_safety_factor": 0.5,
+    }
+    if args.preprocess_cache is not None:
+        cache = PreprocessCache(
+            args.preprocess_cache,
+            step_size=args.step_size,
+            align_clusters=preprocess_kwargs["align_clusters"],
+            validate=args.preprocess_cache_validate,
+        )
+        preprocessed_available, preprocessed_total = cached_preprocess(
+            dict_process_files,
+            cache,
+            update=args.preprocess_cache_mode == "readwrite",
+            **preprocess_kwargs,
+        )
+    else:
+        preprocessed_available, preprocessed_total = preprocess(dict_process_files, **preprocess_kwargs)
     print(
         "Number of files preprocessed: ",
         len(preprocessed_available),
         " out of ",
         len(preprocessed_total),
     )
+    if args.preprocess_only:
+        return
 
-    # TODO: customize processor
-    from hbb.processors import categorizer
+    p = get_processor(year, args, skim_outpath="outparquet")
 
-    p = categorizer(
-        xsecs=xsecs,
-        year=year,
-        nano_version=args.nano_version,
-        save_skim=args.save_skim,
-        evaluate_BDT=args.BDT,
-        skim_outpath="outparquet",
-        btag_eff=args.btag_eff,
-        save_skim_nosysts=args.save_skim_nosysts,
-    )
+    # the cap is applied to the preprocessed chunks (--step-size), before they are rechunked,
+    # so that adaptive chunking processes the same events
+    preprocessed_available = cap_chunks(preprocessed_available, args.max_chunks)
+    if args.chunking == "adaptive":
+        preprocessed_available = tune_step_sizes(preprocessed_available, year, args)
 
+    tic = time.time()
     full_tg, rep = apply_to_fileset(
         data_manipulation=p,
-        fileset=max_chunks(preprocessed_available, 300),
+        fileset=preprocessed_available,
         schemaclass=nanoevents.NanoAODSchema,
-        uproot_options={
-            "allow_read_errors_with_report": (OSError, KeyError),
-            "xrootd_handler": uproot.source.xrootd.MultithreadedXRootDSource,
-            "timeout": 1800,
-        },
+        uproot_options=apply_uproot_options,
     )
-    output, _ = dask.compute(full_tg, rep)
+    construction_time = time.time() - tic
+    print(f"Graph construction: {construction_time:.1f} s")
+
+    # check the size of the task graph against the budget and report it per shift and region
+    for dataset, dataset_tg in full_tg.items():
+        collections, _ = dask.base.unpack_collections(dataset_tg)
+        size = graph_size(*collections)
+        print(f"{dataset}: task graph with {size['nodes']} nodes in {size['layers']} layers")
+        check_graph_budget(
+            size,
+            max_nodes=args.graph_max_nodes,
+            max_layers=args.graph_max_layers,
+            action=args.graph_budget_action,
+            name=dataset,
+        )
+        if args.graph_report:
+            print(f"Graph report for {dataset}")
+            print_graph_report(graph_report(dataset_tg))
+
+    # check that only the declared NanoAOD branches are read
+    # (the MC manifest is a superset of the data one)
+    if args.check_columns != "none":
+        manifest = p.branch_manifest(isRealData=False)
+        for dataset, dataset_tg in full_tg.items():
+            necessary_columns = dak.report_necessary_columns(dataset_tg)
+            check_necessary_columns(necessary_columns, manifest, strict=args.check_columns == "error")
+            n_columns = len(set().union(*[c for c in necessary_columns.values() if c is not None]))
+            print(f"{dataset}: reading {n_columns} branches")
+
+    tic = time.time()
+    output, report = dask.compute(full_tg, rep)
+    print(f"Graph execution: {time.time() - tic:.1f} s")
+
+    for dataset, summary in summarize_read_report(report).items():
+        print(
+            f"{dataset}: read {summary['bytes'] / 1e6:.1f} MB in {summary['chunks']} chunks "
+            f"({summary['bytes_per_chunk'] / 1e6:.1f} MB/chunk, {summary['failed']} failed)"
+        )
     # print("output ", output)
 
     # save the output to a pickle file
@@ -119,10 +286,6 @@ def run(year: str, fileset: dict, args: argparse.Namespace):
 
     if args.save_skim or args.save_skim_nosysts:
 
-        import pandas as pd
-        import pyarrow as pa
-        import pyarrow.parquet as pq
-
         jer_vars = []
         for entry in Path(local_parquet_dir).iterdir():
             if entry.is_dir():
@@ -140,13 +303,18 @@ def run(year: str, fileset: dict, args: argparse.Namespace):
                 full_path = Path(folder)
                 # This is the simpler, correct way to get the region name
                 region_name = full_path.name
-                pddf = pd.read_parquet(folder)
-
-                table = pa.Table.from_pandas(pddf)
                 # This saves the combined file as {local_var}_{region_name}.parquet locally
                 output_file = f"{local_dir}/{local_var}_{region_name}.parquet"
-                pq.write_table(table, output_file)
-                print("Saved parquet file to ", output_file)
+                # streamed row group by row group, the region is never fully loaded in memory
+                n_rows = compact_parquet(
+                    folder,
+                    output_file,
+                    compression=args.parquet_compression,
+                    compression_level=args.parquet_compression_level,
+                    row_group_size=args.parquet_row_group_size,
+                    dictionary=args.parquet_dictionary,
+                )
+                print(f"Saved parquet file to {output_file} ({n_rows} rows)")
 
         # remove subfolder
         print("Removing temporary folder: ", local_parquet_dir)
@@ -237,6 +405,125 @@ if __name__ == "__main__":
         help="Evaluate BDT scores and use for categorization",
         default=False,
     )
+    parser.add_argument(
+        "--check-columns",
+        default="warn",
+        choices=["none", "warn", "error"],
+        help="check that only branches declared in hbb/nano_branches.py are read",
+    )
+    parser.add_argument(
+        "--skim-region-flags",
+        action="store_true",
+        help="write each shift once per skim group (e.g. all signal regions), with the regions as boolean columns",
+        default=False,
+    )
+    parser.add_argument(
+        "--weight-format",
+        default="full",
+        choices=["full", "factors"],
+        help="store every systematic weight in the skims, or only the individual weight factors",
+    )
+    parser.add_argument(
+        "--skim-dtypes",
+        default="native",
+        choices=["native", "compact"],
+        help="store the skim columns with their awkward types, or with the compact policy of hbb/skim_schema.py",
+    )
+    parser.add_argument(
+        "--pdf-dtype",
+        default="float32",
+        choices=["float32", "float16"],
+        help="type of the PDF and scale variation weights with --skim-dtypes compact",
+    )
+    parser.add_argument(
+        "--graph-report",
+        action="store_true",
+        help="print the task graph size and build/optimization time per shift and region",
+        default=False,
+    )
+    parser.add_argument(
+        "--graph-max-nodes", default=None, type=int, help="budget on the number of task graph nodes per dataset"
+    )
+    parser.add_argument(
+        "--graph-max-layers", default=None, type=int, help="budget on the number of task graph layers per dataset"
+    )
+    parser.add_argument(
+        "--graph-budget-action",
+        default="warn",
+        choices=["warn", "error"],
+        help="what to do when the task graph is over budget",
+    )
+    parser.add_argument("--step-size", default=20_000, type=int, help="number of events per chunk in preprocessing")
+    parser.add_argument(
+        "--preprocess-cache",
+        default=None,
+        type=str,
+        help="json file (local or fsspec url, e.g. on EOS) caching the preprocessed steps and forms",
+    )
+    parser.add_argument(
+        "--preprocess-cache-mode",
+        default="readwrite",
+        choices=["readwrite", "read"],
+        help="add newly preprocessed files to the cache, or only read it (e.g. for concurrent condor jobs)",
+    )
+    parser.add_argument(
+        "--preprocess-cache-validate",
+        default="none",
+        choices=["none", "stat"],
+        help="reuse cached files by path, or only if their size and modification time did not change",
+    )
+    parser.add_argument(
+        "--preprocess-only",
+        action="store_true",
+        help="stop after preprocessing (e.g. to fill the preprocess cache)",
+        default=False,
+    )
+    parser.add_argument("--max-chunks", default=300, type=int, help="maximum number of --step-size chunks per file, applied before adaptive rechunking")
+    parser.add_argument(
+        "--chunking",
+        default="fixed",
+        choices=["fixed", "adaptive"],
+        help="fixed step size, or chosen per dataset from a probe chunk to fit the memory and time targets",
+    )
+    parser.add_argument(
+        "--memory-target", default=2.0, type=float, help="adaptive chunking: target RSS in GB"
+    )
+    parser.add_argument(
+        "--target-chunk-time", default=120.0, type=float, help="adaptive chunking: target time per chunk in s"
+    )
+    parser.add_argument("--probe-events", default=5_000, type=int, help="adaptive chunking: events in the probe chunk")
+    parser.add_argument("--min-step-size", default=1_000, type=int, help="adaptive chunking: minimum step size")
+    parser.add_argument("--max-step-size", default=500_000, type=int, help="adaptive chunking: maximum step size")
+    parser.add_argument(
+        "--chunk-size-file",
+        default="chunk_sizes.json",
+        type=str,
+        help="adaptive chunking: json file with the probe measurements per dataset, reused when present",
+    )
+    parser.add_argument(
+        "--retune-chunks",
+        action="store_true",
+        help="adaptive chunking: probe again even if the dataset is in the chunk size file",
+        default=False,
+    )
+    parser.add_argument(
+        "--parquet-compression",
+        default="zstd",
+        choices=["zstd", "snappy", "lz4", "gzip", "none"],
+        help="compression of the combined skim parquet files",
+    )
+    parser.add_argument(
+        "--parquet-compression-level", default=None, type=int, help="compression level, codec default if not set"
+    )
+    parser.add_argument(
+        "--parquet-row-group-size", default=128 * 1024, type=int, help="rows per row group of the combined skims"
+    )
+    parser.add_argument(
+        "--parquet-dictionary",
+        default="flags",
+        choices=["flags", "all", "none"],
+        help="dictionary encode the integer (flag, count) columns, all columns or none",
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "--save-skim",
@@ -0,0 +1,43 @@
+"""
+Reports the precision loss of the skim dtype policy (hbb/skim_schema.py) per column,
+on skims written with native types (run.py --skim-dtypes native):
+    python src/skim_precision.py --skims outparquet/nominal/2023/dataset/signal-ggf --pdf-dtype float16
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+
+import awkward as ak
+
+from hbb.skim_schema import get_dtype_policy, precision_report, print_precision_report
+
+
+def main(args):
+    events = ak.from_parquet(args.skims, columns=args.columns or None)
+    columns = {name: events[name] for name in events.fields}
+    rows = precision_report(columns, get_dtype_policy("compact", pdf_dtype=args.pdf_dtype))
+    print_precision_report(rows)
+
+    failed = [
+        row["column"] for row in rows if row["n_out_of_range"] or row["max_rel_diff"] > args.max_rel_diff
+    ]
+    if failed:
+        print(f"{len(failed)} columns over the tolerance: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--skims", required=True, type=str, help="parquet file or directory")
+    parser.add_argument("--columns", default=[], nargs="*", help="columns to check, all by default")
+    parser.add_argument("--pdf-dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument(
+        "--max-rel-diff",
+        default=1e-2,
+        type=float,
+        help="exit with an error if a column has a larger relative difference or values out of range",
+    )
+    args = parser.parse_args()
+    main(args)